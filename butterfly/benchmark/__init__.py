@@ -0,0 +1 @@
+'''Measure how fast butterfly serves synthetic data'''
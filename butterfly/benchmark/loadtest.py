@@ -0,0 +1,416 @@
+'''Replay viewer sessions against a butterfly server over HTTP'''
+
+import os
+import re
+import sys
+import json
+import time
+import yaml
+import urllib
+import urllib2
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+from butterfly.benchmark.run import percentiles
+
+'''Increase whenever the results change meaning'''
+RESULTS_VERSION = 1
+
+'''The experiment, sample, dataset and channel of the synthetic data'''
+CHANNEL = {
+    'experiment': 'load',
+    'sample': 'synthetic',
+    'dataset': 'volume',
+    'channel': 'image'
+}
+
+'''Chance of each move by a viewer after loading a viewport'''
+MOVES = (('pan', 0.5), ('z', 0.3), ('zoom', 0.2))
+
+'''Latency percentiles to report'''
+POINTS = (50, 95, 99)
+
+
+def free_port():
+    '''
+    Ask the system for an unused port
+    '''
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_config(root, datapath, dtype, shape, port):
+    '''
+    Write a butterfly config serving one synthetic channel
+
+    :param dtype: the name of the data type of the channel
+    '''
+    [depth, height, width] = shape
+    channel = {
+        'name': CHANNEL['channel'],
+        'path': datapath,
+        'data-type': dtype,
+        'dimensions': {'x': width, 'y': height, 'z': depth}
+    }
+    config = {
+        'bfly': {
+            'port': port,
+            'allowed-paths': [root],
+            'experiments': [{
+                'name': CHANNEL['experiment'],
+                'samples': [{
+                    'name': CHANNEL['sample'],
+                    'datasets': [{
+                        'name': CHANNEL['dataset'],
+                        'channels': [channel]
+                    }]
+                }]
+            }]
+        }
+    }
+    path = os.path.join(root, 'bfly.yaml')
+    with open(path, 'w') as fd:
+        fd.write(yaml.dump(config))
+    return path
+
+
+class Server(object):
+    '''Run bfly in a subprocess until the server answers'''
+
+    '''Seconds to wait for the server to start'''
+    TIMEOUT = 60
+
+    def __init__(self, config, port, log=None):
+        self.url = 'http://localhost:%d' % port
+        self._config = config
+        self._port = port
+        self._log = log
+        self._process = None
+
+    def __enter__(self):
+        command = [sys.executable, '-c',
+                   'from butterfly.cli import main; main()',
+                   str(self._port), '-e', self._config]
+        log = open(self._log or os.devnull, 'w')
+        self._process = subprocess.Popen(command, stdout=log, stderr=log)
+        start = time.time()
+        while time.time() - start < self.TIMEOUT:
+            if self._process.poll() is not None:
+                raise RuntimeError('bfly exited with %d' %
+                                   self._process.returncode)
+            try:
+                urllib2.urlopen(self.url + '/api/experiments', timeout=1)
+                return self
+            except (urllib2.URLError, socket.error):
+                time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError('bfly did not start in %d s' % self.TIMEOUT)
+
+    def __exit__(self, *args):
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+
+
+class Viewer(object):
+    '''Model the tile requests of one static/viz session
+
+    Like getTileUrl in source.js, each tile of a viewport is requested
+    from /api/data with the x and y at its zoom level and its width and
+    height clipped to the volume. The viewer starts zoomed out to fit
+    the volume on a random slice. After each viewport it pans by half a
+    viewport, steps one slice in z, or zooms in or out one level. Tiles
+    already seen in the session are not requested again, like the
+    OpenSeadragon cache.
+    '''
+
+    def __init__(self, rng, shape, tile, viewport, fmt):
+        [self._depth, self._height, self._width] = shape
+        self._tile = tile
+        self._viewport = viewport
+        self._fmt = fmt
+        self._rng = rng
+        self._seen = set()
+        # Zoom out no further than to fit the volume in the viewport
+        fit = max(np.log2(self._width / float(viewport[0])),
+                  np.log2(self._height / float(viewport[1])))
+        levels = np.log2(max(self._width, self._height) / float(tile))
+        self.max_w = int(max(min(np.ceil(fit), np.floor(levels)), 0))
+        self.w = self.max_w
+        self.z = rng.randint(self._depth)
+        # The center of the viewport in full resolution pixels
+        self.center = [self._width / 2.0, self._height / 2.0]
+
+    def urls(self):
+        '''
+        List the urls of the tiles in the viewport not yet seen
+        '''
+        scale = 2 ** self.w
+        [level_x, level_y] = [int(np.ceil(self._width / float(scale))),
+                              int(np.ceil(self._height / float(scale)))]
+        [view_x, view_y] = self._viewport
+        x0 = max(int(self.center[0] / scale - view_x / 2), 0)
+        y0 = max(int(self.center[1] / scale - view_y / 2), 0)
+        x1 = min(x0 + view_x, level_x)
+        y1 = min(y0 + view_y, level_y)
+
+        urls = []
+        for y in range(y0 - y0 % self._tile, y1, self._tile):
+            for x in range(x0 - x0 % self._tile, x1, self._tile):
+                key = (x, y, self.z, self.w)
+                if key in self._seen:
+                    continue
+                self._seen.add(key)
+                query = dict(CHANNEL, x=x, y=y, z=self.z,
+                             width=min(self._tile, level_x - x),
+                             height=min(self._tile, level_y - y),
+                             resolution=self.w, format=self._fmt)
+                urls.append('/api/data?' + urllib.urlencode(query))
+        return urls
+
+    def move(self):
+        '''
+        Pan, scroll in z, or zoom at random
+        '''
+        moves, chances = zip(*MOVES)
+        move = self._rng.choice(moves, p=chances)
+        scale = 2 ** self.w
+        if move == 'pan':
+            angle = self._rng.uniform(0, 2 * np.pi)
+            step = np.array(self._viewport) * scale / 2.0
+            self.center[0] += np.cos(angle) * step[0]
+            self.center[1] += np.sin(angle) * step[1]
+        elif move == 'z':
+            self.z += self._rng.choice([-1, 1])
+        else:
+            self.w += self._rng.choice([-1, 1])
+        self.center[0] = min(max(self.center[0], 0), self._width)
+        self.center[1] = min(max(self.center[1], 0), self._height)
+        self.z = min(max(self.z, 0), self._depth - 1)
+        self.w = min(max(self.w, 0), self.max_w)
+        return move
+
+
+def read_log(path):
+    '''
+    Get the url of each GET request in an access log or list of urls
+    '''
+    urls = []
+    with open(path, 'r') as fd:
+        for line in fd:
+            match = re.search(r'GET (\S+)', line)
+            url = match.group(1) if match else line.strip()
+            if url.startswith('/'):
+                urls.append(url)
+    return urls
+
+
+def endpoint(url):
+    return url.split('?')[0]
+
+
+class Recorder(object):
+    '''Collect the latency and size of each request by endpoint'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+
+    def fetch(self, server, url):
+        start = time.time()
+        error = None
+        nbytes = 0
+        try:
+            response = urllib2.urlopen(server + url)
+            nbytes = len(response.read())
+        except urllib2.HTTPError, http_error:
+            error = 'HTTP %d' % http_error.code
+        except (urllib2.URLError, socket.error), err:
+            error = type(err).__name__
+        duration = time.time() - start
+        with self._lock:
+            record = self.requests.setdefault(endpoint(url), {
+                'seconds': [], 'bytes': 0, 'errors': {}
+            })
+            record['seconds'].append(duration)
+            record['bytes'] += nbytes
+            if error:
+                record['errors'][error] = record['errors'].get(error, 0) + 1
+
+    def summary(self, wall):
+        '''
+        Summarize each endpoint over the wall time of the whole run
+        '''
+        result = {}
+        for name, record in self.requests.items():
+            count = len(record['seconds'])
+            errors = sum(record['errors'].values())
+            result[name] = {
+                'latency_ms': percentiles(record['seconds'], POINTS),
+                'requests_per_s': count / wall,
+                'mb_per_s': record['bytes'] / wall / 1024 ** 2,
+                'error_rate': errors / float(count),
+                'errors': record['errors']
+            }
+        return result
+
+
+def play_sessions(recorder, server, args, seed):
+    '''
+    Play viewer sessions one after another until the time is up
+    '''
+    rng = np.random.RandomState(seed)
+    stop = time.time() + args.duration
+    while time.time() < stop:
+        viewer = Viewer(rng, args.shape, args.tile, args.viewport,
+                        args.format)
+        for step in range(args.steps):
+            for url in viewer.urls():
+                recorder.fetch(server, url)
+            if time.time() >= stop:
+                return
+            time.sleep(args.think)
+            viewer.move()
+
+
+def play_log(recorder, server, urls, lock):
+    '''
+    Request the next url of a shared log until none are left
+    '''
+    while True:
+        with lock:
+            if not urls:
+                return
+            url = urls.pop()
+        recorder.fetch(server, url)
+
+
+def load(server, args):
+    '''
+    Run concurrent clients against a server and summarize the requests
+    '''
+    recorder = Recorder()
+    if args.log:
+        urls = read_log(args.log)
+        urls.reverse()
+        lock = threading.Lock()
+        targets = [(play_log, (recorder, server, urls, lock))
+                   for i in range(args.clients)]
+    else:
+        targets = [(play_sessions, (recorder, server, args, args.seed + i))
+                   for i in range(args.clients)]
+
+    threads = [threading.Thread(target=t, args=a) for t, a in targets]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+    return {
+        'wall_s': wall,
+        'endpoints': recorder.summary(wall)
+    }
+
+
+def main():
+    '''
+    Butterfly load test
+    '''
+    help = {
+        'load': 'Replay viewer sessions against a butterfly server',
+        'out': 'path to save the results as json',
+        'dir': 'folder for synthetic data (default temporary)',
+        'url': 'test a running server instead of starting one',
+        'log': 'replay the GET requests in an access log or list of urls',
+        'server_log': 'path to save the output of the started server',
+        'dataset': 'synthetic dataset to serve (see bfly_bench --only)',
+        'shape': 'z, y, x size of the synthetic volume',
+        'tile': 'width and height of each tile',
+        'viewport': 'width and height of each viewer in pixels',
+        'format': 'image format of each tile',
+        'clients': 'number of concurrent viewers',
+        'duration': 'seconds for each viewer to play sessions',
+        'steps': 'number of moves in each session',
+        'think': 'seconds each viewer waits after each viewport',
+        'seed': 'random seed of the first viewer'
+    }
+    parser = argparse.ArgumentParser(description=help['load'])
+    parser.add_argument('-o', '--out', metavar='out', help=help['out'])
+    parser.add_argument('-d', '--dir', metavar='dir', help=help['dir'])
+    parser.add_argument('--url', help=help['url'])
+    parser.add_argument('--log', help=help['log'])
+    parser.add_argument('--server-log', help=help['server_log'])
+    parser.add_argument('--dataset', default='mojo-png',
+                        help=help['dataset'])
+    parser.add_argument('--shape', nargs=3, type=int, default=[8, 4096, 4096],
+                        metavar=('Z', 'Y', 'X'), help=help['shape'])
+    parser.add_argument('--tile', type=int, default=512, help=help['tile'])
+    parser.add_argument('--viewport', nargs=2, type=int, default=[1920, 1080],
+                        metavar=('W', 'H'), help=help['viewport'])
+    parser.add_argument('--format', default='png', help=help['format'])
+    parser.add_argument('-c', '--clients', type=int, default=8,
+                        help=help['clients'])
+    parser.add_argument('--duration', type=float, default=30,
+                        help=help['duration'])
+    parser.add_argument('--steps', type=int, default=20, help=help['steps'])
+    parser.add_argument('--think', type=float, default=0.1,
+                        help=help['think'])
+    parser.add_argument('--seed', type=int, default=0, help=help['seed'])
+    parsed = parser.parse_args()
+
+    config = {
+        'clients': parsed.clients,
+        'duration': parsed.duration,
+        'log': parsed.log
+    }
+    if parsed.url:
+        results = load(parsed.url.rstrip('/'), parsed)
+    else:
+        from butterfly.benchmark import synthetic
+        config.update(dataset=parsed.dataset, shape=parsed.shape,
+                      tile=parsed.tile, viewport=parsed.viewport,
+                      format=parsed.format, steps=parsed.steps,
+                      think=parsed.think)
+        root = os.path.realpath(parsed.dir or
+                                tempfile.mkdtemp(prefix='bfly_load'))
+        levels = int(np.log2(max(parsed.shape[1:]) / parsed.tile)) + 1
+        try:
+            made = synthetic.make_all(root, parsed.shape, parsed.tile,
+                                      levels, [parsed.dataset])
+            if not made:
+                parser.error('Unknown dataset: ' + parsed.dataset)
+            port = free_port()
+            [_, _, datapath, dtype] = made[0]
+            yaml_path = write_config(root, datapath, dtype, parsed.shape,
+                                     port)
+            with Server(yaml_path, port, parsed.server_log) as server:
+                results = load(server.url, parsed)
+        finally:
+            if not parsed.dir:
+                shutil.rmtree(root)
+
+    output = json.dumps({
+        'version': RESULTS_VERSION,
+        'time': time.time(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'config': config,
+        'results': results
+    }, indent=2, sort_keys=True)
+    if parsed.out:
+        with open(parsed.out, 'w') as fd:
+            fd.write(output)
+    else:
+        print output
@@ -0,0 +1,236 @@
+'''Time cutouts from synthetic data for every datasource'''
+
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+'''Increase whenever the results change meaning'''
+RESULTS_VERSION = 2
+
+
+def percentiles(seconds, points=(50, 90, 99)):
+    '''
+    Summarize a list of durations in milliseconds
+    '''
+    ms = np.array(seconds) * 1000.0
+    if not len(ms):
+        return {}
+    summary = dict(('p%d' % p, float(np.percentile(ms, p)))
+                   for p in points)
+    summary.update(mean=float(ms.mean()), max=float(ms.max()), count=len(ms))
+    return summary
+
+
+def max_rss_mb():
+    '''
+    Get the peak memory of this process so far
+
+    A forked process starts from the memory its parent uses at the fork,
+    not from the parent's peak.
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes but macOS gives bytes
+    return rss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def hit_ratio(core):
+    total = core._cache.hits + core._cache.misses
+    return core._cache.hits / float(total) if total else None
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def sample_tiles(rng, shape, tile, w, count):
+    '''
+    Pick the x, y, z of random tiles at a zoom level
+    '''
+    [depth, height, width] = shape
+    nx = max(int(np.ceil(width / float(tile * 2 ** w))), 1)
+    ny = max(int(np.ceil(height / float(tile * 2 ** w))), 1)
+    xs = rng.randint(0, nx, count) * tile
+    ys = rng.randint(0, ny, count) * tile
+    zs = rng.randint(0, depth, count)
+    return zip(xs, ys, zs)
+
+
+def measure(core, datapath, shape, tile, levels, samples, seed=0):
+    '''
+    Time cold and warm tiles and throughput at each zoom level
+
+    :returns: a dictionary of measurements
+    '''
+    rng = np.random.RandomState(seed)
+    size = [tile, tile, 1]
+    result = {}
+
+    result['index_ms'] = timed(core.create_datasource, datapath)[0] * 1000
+
+    # Each cold tile starts with an empty cache
+    cold = []
+    warm = []
+    for x, y, z in sample_tiles(rng, shape, tile, 0, samples):
+        core.clear_cache()
+        cold.append(timed(core.get, datapath, [x, y, z], size)[0])
+        warm.append(timed(core.get, datapath, [x, y, z], size)[0])
+    result['cold_ms'] = percentiles(cold)
+    result['warm_ms'] = percentiles(warm)
+
+    # Each zoom level starts with an empty cache
+    result['levels'] = []
+    for w in range(levels + 1):
+        core.clear_cache()
+        tiles = sample_tiles(rng, shape, tile, w, samples)
+        seconds = []
+        nbytes = 0
+        for x, y, z in tiles:
+            duration, vol = timed(core.get, datapath, [x, y, z], size, w=w)
+            seconds.append(duration)
+            nbytes += vol.nbytes
+        total = sum(seconds)
+        result['levels'].append({
+            'w': w,
+            'tile_ms': percentiles(seconds),
+            'tiles_per_s': len(seconds) / total if total else None,
+            'mb_per_s': nbytes / total / 1024 ** 2 if total else None,
+            'cache_hit_ratio': hit_ratio(core)
+        })
+    result['max_rss_mb'] = max_rss_mb()
+    return result
+
+
+def measure_dataset(name, datasource, path, shape, tile, levels, samples):
+    '''
+    Measure one dataset with a new core
+
+    :returns: the measurements or the error
+    '''
+    from butterfly import core
+    result = {'name': name, 'datasource': datasource}
+    try:
+        result.update(measure(core.Core(), path, shape, tile, levels,
+                              samples))
+    except Exception, err:
+        result['error'] = '%s: %s' % (type(err).__name__, err)
+    return result
+
+
+def run(root, shape, tile, levels, samples, only=None):
+    '''
+    Write synthetic data to a root folder and measure each dataset
+
+    Each dataset is measured in its own process, so the peak memory of
+    one dataset doesn't carry over to the next.
+    '''
+    from butterfly.benchmark import synthetic
+
+    results = []
+    datasets = synthetic.make_all(root, shape, tile, levels, only)
+    for name, datasource, path, _ in datasets:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(measure_dataset, (
+                name, datasource, path, shape, tile, levels, samples)))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def compare(old, new):
+    '''
+    Print the ratio of each new median to each old median
+    '''
+    old = dict((r['name'], r) for r in old['results'])
+    for result in new['results']:
+        before = old.get(result['name'])
+        if not before or 'error' in result or 'error' in before:
+            continue
+        rows = [('cold', before['cold_ms'], result['cold_ms']),
+                ('warm', before['warm_ms'], result['warm_ms'])]
+        for a, b in zip(before['levels'], result['levels']):
+            rows.append(('w=%d' % a['w'], a['tile_ms'], b['tile_ms']))
+        for label, a, b in rows:
+            if a.get('p50') and b.get('p50'):
+                ratio = b['p50'] / a['p50']
+                print '%-16s %-6s p50 %8.2f ms -> %8.2f ms (x%.2f)' % (
+                    result['name'], label, a['p50'], b['p50'], ratio)
+
+
+def main():
+    '''
+    Butterfly benchmarks
+    '''
+    help = {
+        'bench': 'Time butterfly cutouts from synthetic data',
+        'out': 'path to save the results as json',
+        'dir': 'folder for synthetic data (default temporary)',
+        'shape': 'z, y, x size of each synthetic volume',
+        'tile': 'width and height of each tile',
+        'levels': 'number of zoom levels to measure above full size',
+        'samples': 'number of tiles to time for each measure',
+        'only': 'names of datasets to measure (default all)',
+        'compare': 'print the change from an old to a new results json'
+    }
+    parser = argparse.ArgumentParser(description=help['bench'])
+    parser.add_argument('-o', '--out', metavar='out', help=help['out'])
+    parser.add_argument('-d', '--dir', metavar='dir', help=help['dir'])
+    parser.add_argument('--shape', nargs=3, type=int, default=[8, 2048, 2048],
+                        metavar=('Z', 'Y', 'X'), help=help['shape'])
+    parser.add_argument('--tile', type=int, default=512, help=help['tile'])
+    parser.add_argument('--levels', type=int, default=2, help=help['levels'])
+    parser.add_argument('--samples', type=int, default=20,
+                        help=help['samples'])
+    parser.add_argument('--only', nargs='+', help=help['only'])
+    parser.add_argument('--compare', nargs=2, metavar=('old', 'new'),
+                        help=help['compare'])
+    parsed = parser.parse_args()
+
+    if parsed.compare:
+        old, new = [json.load(open(path)) for path in parsed.compare]
+        compare(old, new)
+        return
+
+    from rh_logger import logger
+    logger.start_process("bfly_bench", "Starting butterfly benchmarks", [])
+    # Only time the work, not the logs
+    logging.getLogger().setLevel(logging.WARNING)
+
+    root = parsed.dir or tempfile.mkdtemp(prefix='bfly_bench')
+    try:
+        results = run(root, parsed.shape, parsed.tile, parsed.levels,
+                      parsed.samples, parsed.only)
+    finally:
+        if not parsed.dir:
+            shutil.rmtree(root)
+
+    output = json.dumps({
+        'version': RESULTS_VERSION,
+        'time': time.time(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'config': {
+            'shape': parsed.shape,
+            'tile': parsed.tile,
+            'levels': parsed.levels,
+            'samples': parsed.samples
+        },
+        'results': results
+    }, indent=2, sort_keys=True)
+    if parsed.out:
+        with open(parsed.out, 'w') as fd:
+            fd.write(output)
+    else:
+        print output
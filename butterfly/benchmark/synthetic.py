@@ -0,0 +1,169 @@
+'''Write synthetic data for every datasource'''
+
+import os
+import cv2
+import json
+import h5py
+import numpy as np
+
+'''Default z, y, x shape of each synthetic volume'''
+SHAPE = (8, 2048, 2048)
+
+'''Default width and height of each tile'''
+TILE = 512
+
+
+def make_image(shape, seed):
+    '''
+    Make a uint8 plane of blurry noise like an EM image
+    '''
+    rng = np.random.RandomState(seed)
+    noise = rng.randint(0, 256, shape).astype(np.uint8)
+    return cv2.GaussianBlur(noise, (0, 0), 3)
+
+
+def make_labels(shape, seed, block=32):
+    '''
+    Make a uint32 plane of square blocks like a segmentation
+    '''
+    rng = np.random.RandomState(seed)
+    grid = [int(np.ceil(s / float(block))) for s in shape]
+    ids = rng.randint(1, 2 ** 31, grid).astype(np.uint32)
+    ids = np.repeat(np.repeat(ids, block, axis=0), block, axis=1)
+    return ids[:shape[0], :shape[1]]
+
+
+def make_plane(shape, z, labels=False):
+    if labels:
+        return make_labels(shape, z)
+    return make_image(shape, z)
+
+
+def tiles_of(plane, tile):
+    '''
+    Yield the y index, x index and contents of each tile in a plane
+    '''
+    for y in range(0, plane.shape[0], tile):
+        for x in range(0, plane.shape[1], tile):
+            yield y // tile, x // tile, plane[y:y + tile, x:x + tile]
+
+
+def make_mojo(root, shape=SHAPE, tile=TILE, levels=3, labels=False):
+    '''
+    Write a Mojo tree with a tile pyramid of png or hdf5 tiles
+    '''
+    ext = '.hdf5' if labels else '.png'
+    for z in range(shape[0]):
+        plane = make_plane(shape[1:], z, labels)
+        for w in range(levels):
+            folder = os.path.join(root, 'tiles', 'w=%08d' % w, 'z=%08d' % z)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            level = plane[::2 ** w, ::2 ** w]
+            for y, x, data in tiles_of(level, tile):
+                name = 'y=%08d,x=%08d' % (y, x) + ext
+                path = os.path.join(folder, name)
+                if labels:
+                    with h5py.File(path, 'w') as fd:
+                        fd.create_dataset('IdMap', data=data)
+                else:
+                    cv2.imwrite(path, data)
+    return root
+
+
+def make_stack(root, shape=SHAPE, tile=TILE, ext='.png'):
+    '''
+    Write a RegularImageStack of tiles with its .args file
+    '''
+    for z in range(shape[0]):
+        folder = os.path.join(root, 'z%04d' % z)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for y, x, data in tiles_of(make_image(shape[1:], z), tile):
+            name = 'tile_%d_%d' % (y, x) + ext
+            cv2.imwrite(os.path.join(folder, name), data)
+    tiles = [int(np.ceil(s / float(tile))) for s in shape[1:]]
+    with open(os.path.join(root, 'stack.args'), 'w') as fd:
+        fd.write("--filename 'tile_%(y)d_%(x)d" + ext + "'\n")
+        fd.write("--folderpaths 'z%(z)04d'\n")
+        fd.write("--x_ind 0-%d\n" % (tiles[1] - 1))
+        fd.write("--y_ind 0-%d\n" % (tiles[0] - 1))
+        fd.write("--z_ind 0-%d\n" % (shape[0] - 1))
+    return root
+
+
+def make_hdf5(path, shape=SHAPE, chunks=None, labels=False):
+    '''
+    Write a volume to one dataset of an HDF5 file
+
+    :param chunks: the z, y, x shape of each chunk or None if contiguous
+    '''
+    dtype = np.uint32 if labels else np.uint8
+    with h5py.File(path, 'w') as fd:
+        dataset = fd.create_dataset('stack', shape, dtype=dtype,
+                                    chunks=chunks)
+        for z in range(shape[0]):
+            dataset[z] = make_plane(shape[1:], z, labels)
+    return path
+
+
+def make_tilespecs(root, shape=SHAPE, tile=TILE):
+    '''
+    Write a folder of tilespec json for each layer and the tile images
+    '''
+    for z in range(shape[0]):
+        folder = os.path.join(root, 'images', '%04d' % z)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tilespecs = []
+        for y, x, data in tiles_of(make_image(shape[1:], z), tile):
+            path = os.path.join(folder, 'tile_%d_%d.png' % (y, x))
+            cv2.imwrite(path, data)
+            [x0, y0] = [x * tile, y * tile]
+            tilespecs.append({
+                'layer': z,
+                'width': data.shape[1],
+                'height': data.shape[0],
+                'bbox': [x0, x0 + data.shape[1], y0, y0 + data.shape[0]],
+                'mipmapLevels': {'0': {'imageUrl': 'file://' + path}},
+                'transforms': [{
+                    'className':
+                        'mpicbg.trakem2.transform.TranslationModel2D',
+                    'dataString': '%d %d' % (x0, y0)
+                }]
+            })
+        with open(os.path.join(root, '%04d.json' % z), 'w') as fd:
+            json.dump(tilespecs, fd)
+    return root
+
+
+def make_all(root, shape=SHAPE, tile=TILE, levels=3, names=None):
+    '''
+    Write synthetic data for every datasource under a root folder
+
+    :param names: the names of the datasets to write (default all)
+    :returns: a list of the name, datasource, path and data type of each
+        dataset
+    '''
+    chunks = (1, min(tile, shape[1]), min(tile, shape[2]))
+    datasets = [
+        ('mojo-png', 'mojo', 'uint8', make_mojo, (shape, tile, levels)),
+        ('mojo-labels', 'mojo', 'uint32', make_mojo,
+         (shape, tile, levels, True)),
+        ('stack-png', 'regularimagestack', 'uint8', make_stack,
+         (shape, tile)),
+        ('stack-jpg', 'regularimagestack', 'uint8', make_stack,
+         (shape, tile, '.jpg')),
+        ('hdf5-contiguous.h5', 'hdf5', 'uint8', make_hdf5, (shape,)),
+        ('hdf5-chunked.h5', 'hdf5', 'uint8', make_hdf5, (shape, chunks)),
+        ('hdf5-labels.h5', 'hdf5', 'uint32', make_hdf5,
+         (shape, chunks, True)),
+        ('tilespecs', 'tilespecs', 'uint8', make_tilespecs, (shape, tile)),
+    ]
+    made = []
+    for name, datasource, dtype, maker, args in datasets:
+        if names and name not in names:
+            continue
+        path = maker(os.path.join(root, name), *args)
+        made.append((name, datasource, path, dtype))
+    return made
@@ -0,0 +1,306 @@
+'''A butterfly-native format of compressed chunks with a mip pyramid'''
+
+import os
+import json
+import zlib
+import struct
+import tempfile
+import threading
+import numpy as np
+from tilecache import bypassed
+
+from .datasource import DataSource
+
+'''The name of the JSON header in the folder of a chunked volume'''
+HEADER = 'bfly.json'
+
+'''Increase whenever the layout of chunked volumes changes'''
+FORMAT_VERSION = 1
+
+'''Ways to compress each chunk'''
+COMPRESSIONS = ('zlib', 'none')
+
+'''The offset and byte count of each chunk in the index of a shard'''
+SHARD_ENTRY = struct.Struct('<QQ')
+
+
+def read_header(folder):
+    with open(os.path.join(folder, HEADER), 'r') as fd:
+        return json.load(fd)
+
+
+def write_header(folder, header):
+    with open(os.path.join(folder, HEADER), 'w') as fd:
+        json.dump(header, fd, indent=2, sort_keys=True)
+
+
+def make_header(shape, dtype, chunk, levels, shard=1,
+                compression='zlib', level=1):
+    '''
+    Describe a chunked volume
+
+    :param shape: the z, y, x size of the full resolution volume
+    :param chunk: the height and width of each chunk
+    :param levels: the number of stored zoom levels
+    :param shard: the rows and columns of chunks in each file
+    :param level: the zlib compression level
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression: %s' % compression)
+    return {
+        'version': FORMAT_VERSION,
+        'shape': [int(s) for s in shape],
+        'dtype': np.dtype(dtype).str,
+        'chunk': [int(c) for c in chunk],
+        'levels': int(levels),
+        'shard': int(shard),
+        'compression': compression,
+        'level': int(level)
+    }
+
+
+def level_shape(header, w):
+    '''
+    Get the y, x size of a zoom level
+    '''
+    [_, y, x] = header['shape']
+    return (-(-y // 2 ** w), -(-x // 2 ** w))
+
+
+def grid_shape(header, w):
+    '''
+    Get the rows and columns of chunks of a zoom level
+    '''
+    [y, x] = level_shape(header, w)
+    [cy, cx] = header['chunk']
+    return (-(-y // cy), -(-x // cx))
+
+
+def chunk_file(folder, header, w, z, row, col):
+    '''
+    Get the file holding a chunk and the chunk's index in that file
+
+    Each file is a shard of shard x shard chunks, or one chunk if the
+    shard is 1, under a folder for each zoom level and plane.
+    '''
+    shard = header['shard']
+    path = os.path.join(folder, str(w), str(z),
+                        '%d_%d' % (row // shard, col // shard))
+    if shard == 1:
+        return path + '.chunk', None
+    return path + '.shard', (row % shard) * shard + col % shard
+
+
+def encode_chunk(header, chunk):
+    '''
+    Pad a chunk to the full chunk size and compress it
+    '''
+    full = np.zeros(header['chunk'], dtype=header['dtype'])
+    full[:chunk.shape[0], :chunk.shape[1]] = chunk
+    data = full.tostring()
+    if header['compression'] == 'zlib':
+        return zlib.compress(data, header['level'])
+    return data
+
+
+def decode_chunk(header, data):
+    if header['compression'] == 'zlib':
+        data = zlib.decompress(data)
+    return np.frombuffer(data, header['dtype']).reshape(header['chunk'])
+
+
+def write_file(path, *parts):
+    '''
+    Write the parts of a file at once, so readers never see part of it
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for data in parts:
+                tmp.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def write_shard(path, chunks):
+    '''
+    Write encoded chunks to a shard after an index of their offsets
+
+    :param chunks: the encoded bytes of each chunk, or None if empty
+    '''
+    index = []
+    offset = SHARD_ENTRY.size * len(chunks)
+    for data in chunks:
+        nbytes = len(data) if data else 0
+        index.append(SHARD_ENTRY.pack(offset, nbytes))
+        offset += nbytes
+    write_file(path, ''.join(index), *[data for data in chunks if data])
+
+
+class ChunkDataSource(DataSource):
+    '''A data source of a folder of compressed chunks
+
+    The folder has a bfly.json header and the chunks of each zoom level
+    and plane, as written by bfly_convert. Each chunk is read with one
+    open and decoded into the tile cache. Zoom levels above the stored
+    pyramid are subsampled from its smallest level.
+    '''
+
+    def __init__(self, core, datapath):
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        super(ChunkDataSource, self).__init__(core, datapath)
+
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+        '''
+        return int(os.path.isfile(os.path.join(datapath, HEADER)))
+
+    def index(self):
+        '''
+        @override
+        '''
+        self._header = read_header(self._datapath)
+        if self._header.get('version') != FORMAT_VERSION:
+            raise IndexError("%s has an unknown chunk format version" %
+                             self._datapath)
+        [self._size_z, self._size_y, self._size_x] = self._header['shape']
+        self.blocksize = tuple(self._header['chunk'][::-1])
+        self.max_zoom = self._header['levels'] - 1
+        self._dtype = np.dtype(self._header['dtype'])
+        super(ChunkDataSource, self).index()
+
+    def get_sources(self):
+        '''
+        @override
+        '''
+        return [os.path.join(self._datapath, HEADER)]
+
+    def get_state(self):
+        '''
+        @override
+        '''
+        state = super(ChunkDataSource, self).get_state()
+        del state['_shards_lock']
+        state['_shards'] = {}
+        return state
+
+    def set_state(self, state):
+        '''
+        @override
+        '''
+        super(ChunkDataSource, self).set_state(state)
+        self._shards_lock = threading.Lock()
+
+    def get_type(self):
+        '''
+        @override
+        '''
+        return self._dtype
+
+    def get_boundaries(self):
+        '''
+        @override
+        '''
+        return (self._size_x, self._size_y, self._size_z)
+
+    def _shard_index(self, path, count):
+        '''
+        Read the offsets and byte counts of the chunks of a shard once
+        until the shard is written again
+        '''
+        mtime = os.path.getmtime(path)
+        with self._shards_lock:
+            if self._shards.get(path, (None,))[0] == mtime:
+                return self._shards[path][1]
+        with open(path, 'rb') as fd:
+            data = fd.read(SHARD_ENTRY.size * count)
+        index = [SHARD_ENTRY.unpack_from(data, i * SHARD_ENTRY.size)
+                 for i in range(count)]
+        with self._shards_lock:
+            self._shards[path] = (mtime, index)
+        return index
+
+    def _read_chunk(self, w, z, row, col):
+        '''
+        Read the encoded bytes of a chunk
+
+        :returns: the bytes or None if the chunk is empty
+        '''
+        header = self._header
+        path, i = chunk_file(self._datapath, header, w, z, row, col)
+        if not os.path.isfile(path):
+            return None
+        if i is None:
+            with open(path, 'rb') as fd:
+                return fd.read()
+        offset, nbytes = self._shard_index(path, header['shard'] ** 2)[i]
+        if not nbytes:
+            return None
+        with open(path, 'rb') as fd:
+            fd.seek(offset)
+            return fd.read(nbytes)
+
+    def _chunk(self, w, z, row, col):
+        '''
+        Load a chunk through the tile cache
+        '''
+        key = (self._datapath, w, z, row, col)
+        chunk = self._core._cache.get(key)
+        if chunk is not None:
+            self._core._stats.count('cache_hit')
+            return chunk
+        self._core._stats.count('cache_miss')
+        with self._core._stats.timer('read'):
+            data = self._read_chunk(w, z, row, col)
+        if data is None:
+            return np.zeros(self._header['chunk'], dtype=self._dtype)
+        with self._core._stats.timer('decode'):
+            chunk = decode_chunk(self._header, data)
+        if not bypassed():
+            self._core._cache.put(key, chunk)
+        return chunk
+
+    def load_cutout(self, x0, x1, y0, y1, z, w, out=None):
+        '''
+        @override
+        '''
+        scale = 2 ** w
+        shape = ((y1 - y0) // scale, (x1 - x0) // scale)
+        if out is None:
+            out = np.zeros(shape, dtype=self._dtype)
+        if z < 0 or z >= self._size_z:
+            out[:] = 0
+            return out
+        # Cut from the nearest stored level, then subsample the rest
+        level = min(w, self.max_zoom)
+        step = 2 ** (w - level)
+        factor = 2 ** level
+        [ly0, ly1, lx0, lx1] = [c // factor for c in (y0, y1, x0, x1)]
+        [height, width] = level_shape(self._header, level)
+        [ch, cw] = self._header['chunk']
+        region = np.zeros((ly1 - ly0, lx1 - lx0), dtype=self._dtype)
+        for row in range(max(ly0, 0) // ch, -(-min(ly1, height) // ch)):
+            for col in range(max(lx0, 0) // cw, -(-min(lx1, width) // cw)):
+                chunk = self._chunk(level, z, row, col)
+                # The overlap of the chunk and the region
+                ya, yb = max(ly0, row * ch), min(ly1, (row + 1) * ch)
+                xa, xb = max(lx0, col * cw), min(lx1, (col + 1) * cw)
+                region[ya - ly0:yb - ly0, xa - lx0:xb - lx0] = \
+                    chunk[ya - row * ch:yb - row * ch,
+                          xa - col * cw:xb - col * cw]
+        return self.write_out(region[::step, ::step], out)
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+        (bx, by) = self.blocksize
+        [x0, y0] = [x * bx * 2 ** w, y * by * 2 ** w]
+        return self.load_cutout(x0, x0 + bx * 2 ** w, y0, y0 + by * 2 ** w,
+                                z, w)
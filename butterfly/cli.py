@@ -1,6 +1,7 @@
 import re
 import os
 import cv2
+import copy
 import yaml
 import logging
 import argparse
@@ -17,13 +18,17 @@ def main():
         'bfly': 'Host a butterfly server!',
         'folder': 'relative, absolute, or user path/of/all/experiments',
         'save': 'path of output yaml file indexing experiments',
-        'port': 'port >1024 for hosting this server'
+        'port': 'port >1024 for hosting this server',
+        'warm': 'index all experiments before hosting this server',
+        'workers': 'number of server processes sharing one cache (0 for one per cpu)'
     }
 
     parser = argparse.ArgumentParser(description=help['bfly'])
     parser.add_argument('port', type=int, nargs='?', help=help['port'])
     parser.add_argument('-e','--exp', metavar='exp', help= help['folder'])
     parser.add_argument('-o','--out', metavar='out', help= help['save'])
+    parser.add_argument('-w','--warm', action='store_true', help= help['warm'])
+    parser.add_argument('-n','--workers', type=int, help= help['workers'])
     parsed = parser.parse_args()
     [homefolder,port,outyaml] = [getattr(parsed,s) for s in ['exp','port','out']]
     home = os.path.realpath(os.path.expanduser(homefolder if homefolder else '~'))
@@ -32,7 +37,7 @@ def main():
 
     if os.path.isfile(home):
         os.environ['RH_CONFIG_FILENAME'] = home
-    from butterfly import settings,core,webserver
+    from butterfly import settings,core,webserver,discovery
     from rh_logger import logger
 
     port = port if port else settings.PORT
@@ -50,15 +55,14 @@ def main():
     path_root.reverse()
 
     def sourcer(tmp_path, my_path):
-        try: c.create_datasource(tmp_path)
-        except: return new_kid(my_path)
-        source = c.get_datasource(tmp_path)
-        return source.get_channel(tmp_path)
+        channel = found[tmp_path]['channel']
+        if channel is None: return new_kid(my_path)
+        return copy.deepcopy(channel)
 
     def path_walk(root, parent):
-        [fold,folds,files] = next(os.walk(root), [[]]*3)
-        for my_path in folds+files:
-            tmp_path = os.path.join(fold, my_path)
+        for my_path in found.get(root, {}).get('kids') or []:
+            tmp_path = os.path.join(root, my_path)
+            if tmp_path not in found: continue
             myself = sourcer(tmp_path, my_path)
             parent['kids'].append(myself)
             if 'kids' in myself:
@@ -104,6 +108,16 @@ def main():
 
     experiments = settings.bfly_config.setdefault('experiments',[])
     if homefolder and os.path.isdir(home):
+        # Only rescan paths changed since the last output yaml
+        cached = {}
+        if outyaml and os.path.isfile(saveyaml):
+            try:
+                with open(saveyaml,'r') as old_yaml:
+                    old_bfly = (yaml.safe_load(old_yaml) or {}).get('bfly',{})
+                    cached = old_bfly.get('discovery',{})
+            except yaml.YAMLError:
+                logger.report_event("Can't reuse paths in " + saveyaml)
+        found = discovery.Discovery(c, cached).walk(home)
         path_tree = path_walk(home, path_root[-1])
         min_depth = min(depth_walk(0, path_tree), len(cat_name)-2)
         path_tree = flat_walk(0, path_root[min_depth])
@@ -114,13 +128,17 @@ def main():
             indexed.write(yaml.dump({
                 'bfly': {
                     'allowed-paths': [home],
-                    'datasource': ['mojo','tilespec','hdf5'],
+                    'datasource': ['mojo','tilespecs','hdf5'],
                     'experiments': experiments,
+                    'discovery': found,
                     'port': port
                 }
             }))
             indexed.close()
-    ws = webserver.WebServer(c, port)
+    if parsed.warm or settings.WARM_START:
+        c.warm(experiments)
+    workers = parsed.workers if parsed.workers is not None else settings.WORKERS
+    ws = webserver.WebServer(c, port, workers)
     ws.start()
 
 
@@ -264,8 +282,9 @@ def query():
     # future
     ris.blocksize = args.blocksize
 
-    # Grab the sample volume
-    volume = c.get(datapath, start_coord, vol_size, w=zoom_level)
+    # Grab the sample volume without filling the cache
+    volume = c.get(datapath, start_coord, vol_size, w=zoom_level,
+                   bypass_cache=True)
 
     if vol_size[2] == 1:
         # Is there a better way to catch errors?
@@ -0,0 +1,236 @@
+'''Convert any datapath butterfly can serve to the chunk format'''
+
+import os
+import math
+import time
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+
+import chunks
+
+'''The core, datapath, output folder and header of each worker'''
+_worker = {}
+
+
+def count_levels(shape, chunk):
+    '''
+    Count the zoom levels until a plane fits in one chunk
+
+    :param shape: the z, y, x size of the volume
+    :param chunk: the height and width of each chunk
+    '''
+    ratio = max(float(shape[1]) / chunk[0], float(shape[2]) / chunk[1])
+    return 1 + max(int(math.ceil(math.log(ratio, 2))), 0)
+
+
+def downsample(plane, dtype):
+    '''
+    Halve a plane the way datasources scale down zoom levels
+
+    :returns: the plane with half the rows and columns, rounded up
+    '''
+    import settings
+    if settings.ALWAYS_SUBSAMPLE or dtype == np.uint32:
+        return plane[::2, ::2]
+    size = (-(-plane.shape[1] // 2), -(-plane.shape[0] // 2))
+    return cv2.resize(plane, size, interpolation=settings.IMAGE_RESIZE_METHOD)
+
+
+def _start(datapath, output, header, band):
+    '''
+    Open the datapath once in each worker
+    '''
+    from core import Core
+    core = Core()
+    core.create_datasource(datapath)
+    _worker.update(core=core, datapath=datapath, output=output,
+                   header=header, band=band)
+
+
+def _read_rows(z, y, height):
+    '''
+    Read rows of a plane at full resolution
+    '''
+    width = _worker['header']['shape'][2]
+    vol = _worker['core'].get(_worker['datapath'], [0, y, z],
+                              [width, height, 1], bypass_cache=True)
+    return vol[:height, :width, 0]
+
+
+def _write_rows(z, w, s_row, rows):
+    '''
+    Write the shards of one row of shards of a zoom level
+
+    :param s_row: the first row of chunks in the rows
+    :param rows: the rows of the level from the first row of chunks
+    '''
+    header = _worker['header']
+    output = _worker['output']
+    shard = header['shard']
+    [ch, cw] = header['chunk']
+    [n_rows, n_cols] = chunks.grid_shape(header, w)
+    folder = os.path.join(output, str(w), str(z))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for s_col in range(0, n_cols, shard):
+        shard_chunks = []
+        for i in range(shard ** 2):
+            row, col = s_row + i // shard, s_col + i % shard
+            data = None
+            if row < n_rows and col < n_cols:
+                y = (row - s_row) * ch
+                chunk = rows[y:y + ch, col * cw:(col + 1) * cw]
+                if chunk.any():
+                    data = chunks.encode_chunk(header, chunk)
+            shard_chunks.append(data)
+        path, index = chunks.chunk_file(output, header, w, z, s_row, s_col)
+        if index is not None:
+            chunks.write_shard(path, shard_chunks)
+        elif shard_chunks[0] is not None:
+            chunks.write_file(path, shard_chunks[0])
+
+
+def _add_rows(z, w, rows, levels, last):
+    '''
+    Write each full row of shards of a zoom level, then halve the rows
+    for the next zoom level
+
+    :param rows: the next rows of the zoom level
+    :param levels: the rows of each zoom level not yet written or halved
+    :param last: whether these are the last rows of the plane
+    '''
+    header = _worker['header']
+    shard = header['shard']
+    tall = header['chunk'][0] * shard
+    level = levels[w]
+    level['rows'] = np.concatenate((level['rows'], rows))
+    while len(level['rows']) >= tall or (last and len(level['rows'])):
+        _write_rows(z, w, level['row'], level['rows'][:tall])
+        level['rows'] = level['rows'][tall:]
+        level['row'] += shard
+    if w + 1 >= len(levels):
+        return
+    # Halve rows in pairs until the last rows of the plane
+    level['half'] = np.concatenate((level['half'], rows))
+    count = len(level['half'])
+    count = count if last else count - count % 2
+    halved = levels[w + 1]['rows'][:0]
+    if count:
+        halved = downsample(level['half'][:count], halved.dtype)
+        level['half'] = level['half'][count:]
+    _add_rows(z, w + 1, halved, levels, last)
+
+
+def convert_plane(z):
+    '''
+    Write all chunks of a plane at all zoom levels
+
+    The plane is read once in bands of whole rows of shards, and each
+    zoom level is halved from the one before it.
+
+    :param z: the plane
+    :returns: the plane
+    '''
+    header = _worker['header']
+    band = _worker['band']
+    dtype = np.dtype(header['dtype'])
+    height = header['shape'][1]
+    levels = []
+    for w in range(header['levels']):
+        empty = np.zeros((0, chunks.level_shape(header, w)[1]), dtype)
+        levels.append({'rows': empty, 'half': empty, 'row': 0})
+    for y in range(0, height, band):
+        rows = _read_rows(z, y, min(band, height - y))
+        _add_rows(z, 0, rows, levels, y + band >= height)
+    return z
+
+
+def convert(datapath, output, chunk=(512, 512), levels=None, shard=1,
+            compression='zlib', level=1, workers=1):
+    '''
+    Write the planes of a datapath at all zoom levels as chunks
+
+    Each worker process opens the datapath and writes whole planes.
+    Each band of rows is as tall as a row of shards, or a whole number
+    of them at least as tall as the source's tiles, so each source tile
+    is read about once. The header is written last, so an unfinished
+    output can't be served.
+
+    :param levels: the zoom levels to store (default until one chunk)
+    :param workers: the number of processes, or 0 for one per cpu
+    :returns: the header of the output
+    '''
+    from core import Core
+    from rh_logger import logger
+    core = Core()
+    core.create_datasource(datapath)
+    source = core._datasources[datapath]
+    [x, y, z] = source.get_boundaries()[:3]
+    shape = [z, y, x]
+    if levels is None:
+        levels = count_levels(shape, chunk)
+    header = chunks.make_header(shape, source.dtype, chunk, levels, shard,
+                                compression, level)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    tall = chunk[0] * shard
+    band = tall * max(-(-int(source.blocksize[1]) // tall), 1)
+    tasks = range(z)
+    args = (datapath, output, header, band)
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        _start(*args)
+        done = (convert_plane(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(workers, _start, args)
+        done = pool.imap_unordered(convert_plane, tasks)
+    start = time.time()
+    for count, plane in enumerate(done, 1):
+        logger.report_event("Wrote z=%d (%d of %d) in %.1f s" % (
+            plane, count, len(tasks), time.time() - start),
+            log_level=logging.INFO)
+    if workers != 1:
+        pool.close()
+        pool.join()
+    chunks.write_header(output, header)
+    return header
+
+
+def main():
+    '''
+    Butterfly chunk conversion
+    '''
+    help = {
+        'convert': 'Write a datapath as butterfly chunks',
+        'datapath': 'any datapath bfly can serve',
+        'output': 'folder to write the chunks and bfly.json to',
+        'chunk': 'height and width of each chunk',
+        'levels': 'zoom levels to store (default until one chunk)',
+        'shard': 'rows and columns of chunks in each file',
+        'compression': 'how to compress each chunk',
+        'level': 'zlib compression level from 1 to 9',
+        'workers': 'number of processes (default one per cpu)'
+    }
+    parser = argparse.ArgumentParser(description=help['convert'])
+    parser.add_argument('datapath', help=help['datapath'])
+    parser.add_argument('output', help=help['output'])
+    parser.add_argument('--chunk', nargs=2, type=int, default=[512, 512],
+                        metavar=('Y', 'X'), help=help['chunk'])
+    parser.add_argument('--levels', type=int, help=help['levels'])
+    parser.add_argument('--shard', type=int, default=1, help=help['shard'])
+    parser.add_argument('--compression', default='zlib',
+                        choices=chunks.COMPRESSIONS, help=help['compression'])
+    parser.add_argument('--level', type=int, default=1, help=help['level'])
+    parser.add_argument('-j', '--workers', type=int, default=0,
+                        help=help['workers'])
+    parsed = parser.parse_args()
+
+    from rh_logger import logger
+    logger.start_process("bfly_convert", "Starting butterfly conversion",
+                         [parsed.datapath])
+    convert(parsed.datapath, parsed.output, parsed.chunk, parsed.levels,
+            parsed.shard, parsed.compression, parsed.level, parsed.workers)
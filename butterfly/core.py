@@ -3,7 +3,19 @@ import numpy as np
 import urllib2
 
 import settings
-from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from indexcache import IndexCache
+from tilecache import TileCache, CompressedTileCache, SharedTileCache
+from tilecache import bypass
+from diskcache import DiskTileCache
+from prefetch import Live, Prefetcher
+from stats import Stats
+from encoder import Encoder
+from projection import Projection
+from labelindex import LabelIndex, index_folder
+import labeltile
+from eventlog import log
+import registry
 import rh_logger
 
 
@@ -15,23 +27,173 @@ class Core(object):
         self._datasources = {}
         self.vol_xy_start = [0, 0]
         self.tile_xy_start = [0, 0]
-        self._cache = OrderedDict()
-        self._max_cache_size = settings.MAX_CACHE_SIZE
-        self._current_cache_size = 0
-
-    def load_view(self,datasource,view,bounds):
-        plane = datasource.load_cutout(*bounds)
-        if view == 'rgb':
-            color_plane = plane.astype(np.uint32).view(np.uint8)
-            return color_plane.reshape(plane.shape+(4,))[:,:,:3]
-        elif view == 'colormap':
-            return datasource.seg_to_color(plane.astype(np.uint32))
-        else:
-            return plane
+        cache = TileCache
+        if settings.CACHE_COMPRESSION:
+            cache = CompressedTileCache
+        self._cache = cache(settings.MAX_CACHE_SIZE, settings.CACHE_POLICY)
+        self._disk_cache = None
+        if settings.DISK_CACHE_PATH:
+            self._disk_cache = DiskTileCache(settings.DISK_CACHE_PATH,
+                                             settings.DISK_CACHE_SIZE)
+        self._registry = registry.Registry()
+        self._index_cache = None
+        if settings.INDEX_CACHE_PATH:
+            self._index_cache = IndexCache(settings.INDEX_CACHE_PATH)
+        self._stats = Stats(settings.STATS)
+        self._encoder = Encoder(settings.ENCODER_THREADS,
+                                settings.ENCODER_PROFILES,
+                                settings.ENCODER_PROFILE)
+        self._label_indexes = {}
+        self._live = Live()
+        self._prefetcher = Prefetcher(self, settings.PREFETCH_DEPTH,
+                                      settings.PREFETCH_QUEUE_SIZE,
+                                      settings.PREFETCH_BUDGET)
+
+    def clear_cache(self):
+        '''
+        Remove all tiles from the cache and reset its counts
+        '''
+        self._cache.clear()
+
+    def share_cache(self):
+        '''
+        Keep tiles in memory shared with worker processes forked later
+
+        The shared cache keeps tiles raw and removes the oldest first,
+        so cache-compression and cache-policy do not apply to it.
+        '''
+        ignored = []
+        if settings.CACHE_COMPRESSION:
+            ignored.append('cache-compression')
+        if settings.CACHE_POLICY != 'lru':
+            ignored.append('cache-policy')
+        if ignored:
+            rh_logger.logger.report_event(
+                "%s ignored by the cache shared by workers" %
+                ' and '.join(ignored), log_level=logging.WARNING)
+        self._cache = SharedTileCache(settings.MAX_CACHE_SIZE)
+
+    def get_labels(self, datapath, w=0):
+        '''
+        Get the stats labels for the datasource of a datapath
+        '''
+        datasource = self._datasources.get(datapath)
+        name = type(datasource).__name__ if datasource else 'unknown'
+        return {'datasource': name, 'w': w}
+
+    def get_label_index(self, datapath):
+        '''
+        Get the label index written by bfly_index for a datapath
+
+        :returns: the LabelIndex or None if there is none or if the
+            datapath changed since it was indexed
+        '''
+        if not settings.LABEL_INDEX_PATH:
+            return None
+        if datapath not in self._datasources:
+            self.create_datasource(datapath)
+        datasource = self._datasources[datapath]
+        label_index = self._label_indexes.get(datapath)
+        if label_index is not None and label_index.is_current(datasource):
+            return label_index
+        # Look again in case the index is written or rebuilt later
+        self._label_indexes.pop(datapath, None)
+        folder = index_folder(settings.LABEL_INDEX_PATH, datapath)
+        try:
+            label_index = LabelIndex(folder)
+        except IOError:
+            return None
+        if not label_index.is_current(datasource):
+            rh_logger.logger.report_event(
+                "Label index of %s is out of date" % datapath,
+                log_level=logging.WARNING)
+            return None
+        self._label_indexes[datapath] = label_index
+        return label_index
+
+    def get_mask(self, datapath, start_coord, vol_size, ids, **kwargs):
+        '''
+        Find where a plane of the datapath has any of the label ids
+
+        With a label index, only the tiles holding the ids are read.
+
+        :returns: a boolean array of the height and width of vol_size
+        '''
+        w = int(kwargs.get('w', 0))
+        [x, y, z] = start_coord
+        [width, height] = vol_size[:2]
+        label_index = self.get_label_index(datapath)
+        if label_index is None:
+            vol = self.get(datapath, start_coord, [width, height, 1],
+                           view='grayscale', **kwargs)
+            return labeltile.mask(vol[:,:,0], ids)
+        scale = 2 ** w
+        mask = np.zeros((height, width), dtype=bool)
+        bounds = [x * scale, (x + width) * scale,
+                  y * scale, (y + height) * scale]
+        for x0, x1, y0, y1 in label_index.regions(ids, z, *bounds):
+            # Read each part at zoom w, rounding out to whole pixels
+            [left, top] = [x0 // scale - x, y0 // scale - y]
+            [right, down] = [-(-x1 // scale) - x, -(-y1 // scale) - y]
+            vol = self.get(datapath, [x + left, y + top, z],
+                           [right - left, down - top, 1],
+                           view='grayscale', **kwargs)
+            mask[top:down, left:right] |= labeltile.mask(vol[:,:,0], ids)
+        return mask
+
+    def load_view(self,datasource,view,bounds,out=None):
+        '''
+        Load a plane in a view, writing it into out if given
+
+        :param out: an array of the shape of the plane in the view
+        '''
+        if view not in ['rgb', 'colormap']:
+            with self._stats.timer('fetch'):
+                return datasource.load_cutout(*bounds, out=out)
+        with self._stats.timer('fetch'):
+            plane = datasource.load_cutout(*bounds)
+        return self.color_view(datasource, view, plane, out)
+
+    def color_view(self, datasource, view, plane, out=None):
+        '''
+        Color a plane for a view, unless the view is grayscale
+        '''
+        if view not in ['rgb', 'colormap']:
+            return datasource.write_out(plane, out)
+        with self._stats.timer('colormap'):
+            if view == 'rgb':
+                # View the bytes of each pixel without copying them
+                plane = np.ascontiguousarray(plane, dtype=np.uint32)
+                color_plane = plane.view(np.uint8)
+                color_plane = color_plane.reshape(plane.shape+(4,))[:,:,:3]
+                if out is None:
+                    return color_plane
+                out[:] = color_plane
+                return out
+            return datasource.seg_to_color(plane.astype(np.uint32), out)
+
+    def make_volume(self, datasource, view, vol_size):
+        '''
+        Allocate the output of a request once for all its planes
+
+        :returns: the volume and the channels of each plane
+        '''
+        [width, height, depth] = vol_size
+        channels, dtype = 1, datasource.dtype
+        if view in ['rgb', 'colormap']:
+            channels, dtype = 3, np.uint8
+        return np.zeros((height, width, channels * depth), dtype), channels
 
     def get(self, datapath, start_coord, vol_size, **kwargs):
         '''
         Request a subvolume of the datapath at a given zoomlevel.
+
+        Pass bypass_cache=True for bulk reads that should not add
+        their tiles to the caches.
+
+        Pass reduce as one of projection.REDUCTIONS to get one plane
+        that reduces all planes over z. Each plane is reduced as it
+        loads, so only one plane is kept besides the result.
         '''
         w = 0
         view = settings.DEFAULT_VIEW
@@ -40,26 +202,110 @@ class Core(object):
         if 'w' in kwargs:
             w = int(kwargs['w'])
 
-        # if datapath is not indexed (knowing the meta information),
-        # do it now
-        if datapath not in self._datasources:
-            self.create_datasource(datapath)
+        # The prefetcher waits for all live requests
+        with self._live, bypass(kwargs.get('bypass_cache', False)):
+            # if datapath is not indexed (knowing the meta information),
+            # do it now
+            if datapath not in self._datasources:
+                self.create_datasource(datapath)
 
-        datasource = self._datasources[datapath]
+            datasource = self._datasources[datapath]
 
-        planes = []
-        scale = 2 ** w
-        [x0,y0] = np.array(start_coord[:-1]) * scale
-        [x1,y1] = np.array(vol_size[:-1])*scale + [x0,y0]
-        rh_logger.logger.report_event('Loading tiles:')
-        for z in range(start_coord[2], start_coord[2] + vol_size[2]):
-            bounds = [x0, x1, y0, y1, z, w]
-            plane = self.load_view(datasource, view, bounds)
-            planes.append(plane)
-        return np.dstack(planes)
+            scale = 2 ** w
+            [x0,y0] = np.array(start_coord[:-1]) * scale
+            [x1,y1] = np.array(vol_size[:-1])*scale + [x0,y0]
+            log.event('request', logging.DEBUG, 'Loading tiles of %s',
+                      datapath)
+            # Label the stats of every stage with the datasource and w
+            with self._stats.context(**self.get_labels(datapath, w)):
+                if kwargs.get('reduce'):
+                    bounds = [x0, x1, y0, y1, w]
+                    return self.get_projection(datasource, view, bounds,
+                                               start_coord[2], vol_size[2],
+                                               kwargs['reduce'])
+                # Each plane is written straight into the output
+                with self._stats.timer('assemble'):
+                    vol, channels = self.make_volume(datasource, view,
+                                                     vol_size)
+                for i in range(vol_size[2]):
+                    bounds = [x0, x1, y0, y1, start_coord[2] + i, w]
+                    out = vol[:, :, channels * i:channels * (i + 1)]
+                    if channels == 1:
+                        out = out[:, :, 0]
+                    self.load_view(datasource, view, bounds, out)
+                return vol
 
-    def create_datasource(self, datapath):
+    def get_projection(self, datasource, view, bounds, z, depth, how):
         '''
+        Reduce the planes of a cutout over z as they load
+
+        :param bounds: the x0, x1, y0, y1 and w of each plane
+        :param how: one of projection.REDUCTIONS
+        :returns: the reduced plane in the given view
+        '''
+        [x0, x1, y0, y1, w] = bounds
+        projection = Projection(how)
+        for plane_z in range(z, z + depth):
+            with self._stats.timer('fetch'):
+                plane = datasource.load_cutout(x0, x1, y0, y1, plane_z, w)
+            with self._stats.timer('reduce'):
+                projection.add(plane)
+        plane = self.color_view(datasource, view, projection.result())
+        # Add the axis of planes without copying
+        if plane.ndim == 2:
+            return plane[:, :, np.newaxis]
+        return plane
+
+    def prefetch(self, datapath, start_coord, tile_size, w):
+        '''
+        Load the neighbors of a requested tile while the server is idle
+
+        :param start_coord: the x, y, z of the tile at zoomlevel w
+        :param tile_size: the width and height of the tile
+        '''
+        if settings.PREFETCH_DEPTH > 0:
+            self._prefetcher.request(datapath, start_coord, tile_size, w)
+
+    def get_batch(self, datapath, tiles, tile_size, **kwargs):
+        '''
+        Request many tiles of the same size from the datapath.
+
+        Nearby tiles with the same z and zoomlevel are cut from one
+        subvolume covering them all, so each source tile loads once.
+
+        :param tiles: the x, y, z, w of each tile
+        :param tile_size: the width and height of all tiles
+        :returns: the subvolume of each tile in order
+        '''
+        [width, height] = tile_size
+        groups = {}
+        for i, tile in enumerate(tiles):
+            groups.setdefault(tuple(tile[2:]), []).append(i)
+
+        vols = [None] * len(tiles)
+        for (z, w), group in groups.items():
+            starts = np.array([tiles[i][:2] for i in group])
+            [x0, y0] = starts.min(0)
+            [x1, y1] = starts.max(0) + [width, height]
+            # Only cut one subvolume if the tiles mostly fill it
+            area = (x1 - x0) * (y1 - y0)
+            if area > 2 * len(group) * width * height:
+                for i, [x, y] in zip(group, starts):
+                    vols[i] = self.get(datapath, [x, y, z],
+                                       [width, height, 1], w=w, **kwargs)
+                continue
+            vol = self.get(datapath, [x0, y0, z],
+                           [x1 - x0, y1 - y0, 1], w=w, **kwargs)
+            # Encoders view the bytes of each tile, so copy it out
+            for i, [x, y] in zip(group, starts - [x0, y0]):
+                vols[i] = np.ascontiguousarray(vol[y:y + height, x:x + width])
+        return vols
+
+    def create_datasource(self, datapath, datasources=None):
+        '''
+        Index the best of the datasources able to load the datapath
+
+        :param datasources: names to try (default all in settings)
         '''
 
         for allowed_path in settings.ALLOWED_PATHS:
@@ -70,37 +316,22 @@ class Core(object):
                 None, 403, datapath + " is not an allowed datapath. " +
                 "Contact the butterfly admin to configure a new datapath",
                 [], None)
-        for datasource in settings.DATASOURCES:
+        # Only try datasources with probes matching the datapath
+        for datasource in self._registry.rank(datapath, datasources):
             try:
-                if datasource == 'mojo':
-                    from mojo import Mojo
-                    ds = Mojo(self, datapath)
-                    break
-                elif datasource == 'regularimagestack':
-                    from regularimagestack import RegularImageStack
-                    ds = RegularImageStack(self, datapath)
-                    break
-                elif datasource in ("tilespecs"):
-                    from tilespecs import Tilespecs
-                    ds = Tilespecs(self, datapath)
-                    break
-                elif datasource in ("comprimato", "multibeam"):
-                    from multibeam import MultiBeam
-                    ds = MultiBeam(self, datapath)
-                    break
-                elif datasource == 'hdf5':
-                    from hdf5 import HDF5DataSource
-                    ds = HDF5DataSource(self, datapath)
-                    break
-            except ImportError, err:
-                rh_logger.logger.report_event(
-                    "%s needed by %s" % (err, datasource),
-                    log_level=logging.WARNING)
-            except:
-                rh_logger.logger.report_event(
-                    "Can't load %s with %s" % (datapath, datasource),
-                    log_level=logging.DEBUG)
-                continue
+                ds = registry.get_class(datasource)(self, datapath)
+                # call index unless a current snapshot exists
+                with self._stats.timer('index',
+                                       datasource=type(ds).__name__):
+                    if not self._index_cache or \
+                            not self._index_cache.load(ds):
+                        ds.index()
+                        if self._index_cache:
+                            self._index_cache.save(ds)
+                break
+            except Exception:
+                rh_logger.logger.report_exception(
+                    msg="Can't load %s with %s" % (datapath, datasource))
         else:
             rh_logger.logger.report_event(
                 "Failed to find datasource for %s" % datapath,
@@ -108,10 +339,36 @@ class Core(object):
             raise urllib2.HTTPError(
                 None, 404, "Can't find a loader for datapath=%s" % datapath,
                 [], None)
-        # call index
-        ds.index()
-
+        self._registry.remember(datapath, datasource)
         self._datasources[datapath] = ds
 
+    def warm(self, experiments, threads=settings.WARM_START_THREADS):
+        '''
+        Index the datasource of every channel in the experiments
+        '''
+        datapaths = set()
+        for experiment in experiments:
+            for sample in experiment.get('samples', []):
+                for dataset in sample.get('datasets', []):
+                    for channel in dataset.get('channels', []):
+                        if 'path' in channel:
+                            datapaths.add(channel['path'])
+        datapaths -= set(self._datasources)
+
+        def index(datapath):
+            try:
+                self.create_datasource(datapath)
+            except Exception:
+                rh_logger.logger.report_event(
+                    "Can't index %s at startup" % datapath,
+                    log_level=logging.WARNING)
+
+        rh_logger.logger.report_event(
+            "Indexing %d datapaths" % len(datapaths))
+        pool = ThreadPool(max(threads, 1))
+        pool.map(index, sorted(datapaths))
+        pool.close()
+        pool.join()
+
     def get_datasource(self,datapath):
         return self._datasources[datapath]
@@ -2,8 +2,12 @@ import os
 import re
 import cv2
 import h5py
+import logging
 import settings
 import numpy as np
+from eventlog import log
+from tilecache import bypassed
+import decoder
 
 class DataSource(object):
 
@@ -20,6 +24,15 @@ class DataSource(object):
         self.blocksize = (0, 0)
         self._color_map = None
 
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        Judge quickly and without side effects if this can load a path
+
+        :returns: 0 if not, or a higher number for a better match
+        '''
+        return 0
+
     def index(self):
         '''
         Index all files without loading to
@@ -30,34 +43,62 @@ class DataSource(object):
     def get_type(self):
         return self.load(0,0,0,0).dtype
 
-    def load_cutout(self, x0, x1, y0, y1, z, w):
+    def get_sources(self):
+        '''
+        List the files whose changes would change the index
+        '''
+        return [self._datapath]
+
+    def get_state(self):
+        '''
+        Get all attributes set by the index
+        '''
+        state = self.__dict__.copy()
+        del state['_core']
+        return state
+
+    def set_state(self, state):
+        '''
+        Restore all attributes set by the index
+        '''
+        self.__dict__.update(state)
+
+    def load_cutout(self, x0, x1, y0, y1, z, w, out=None):
         '''
         Load a cutout from a plane
+
+        :param out: an array of the cutout's shape to write into
+        '''
+        scale = 2 ** w
+        [bx, by] = self.blocksize
+        [cx0, cy0] = [x0 // scale, y0 // scale]
+        [cx1, cy1] = [x1 // scale, y1 // scale]
+        if out is None:
+            out = np.zeros((cy1 - cy0, cx1 - cx0), dtype=self.dtype)
+        # Copy the part of each tile in the cutout
+        for ty in range(cy0 // by, -(-cy1 // by)):
+            for tx in range(cx0 // bx, -(-cx1 // bx)):
+                tile = self.load(tx, ty, z, w)
+                [ty0, tx0] = [ty * by, tx * bx]
+                ya, yb = max(cy0, ty0), min(cy1, ty0 + tile.shape[0])
+                xa, xb = max(cx0, tx0), min(cx1, tx0 + tile.shape[1])
+                out[ya - cy0:yb - cy0, xa - cx0:xb - cx0] = \
+                    tile[ya - ty0:yb - ty0, xa - tx0:xb - tx0]
+        return out
+
+    def write_out(self, plane, out):
         '''
-        scale = float(2 ** w)
-        blockshape = np.array(self.blocksize)
-        x0y0 = np.array([x0,y0]) // scale
-        x1y1 = np.array([x1,y1]) // scale
-        top_left = np.floor(x0y0 / blockshape).astype(int)
-        lo_right = np.ceil(x1y1 / blockshape).astype(int)
-        origin = top_left * blockshape
-        [left,top] = (x0y0 - origin).astype(int)
-        [right,down] = (x1y1 - origin).astype(int)
-        gridshape = lo_right-top_left
-        grid = np.indices(gridshape).T
-
-        cutshape = blockshape*grid.shape[:-1]
-        cutout = np.zeros(cutshape, dtype=self.dtype)
-        fixed = [z,w]
-        for row in grid:
-            for where in row:
-                here = top_left + where
-                [i0,j0] = blockshape*(where)
-                [i1,j1] = blockshape*(where+1)
-                one_tile = list(here)+fixed
-                tile = self.load(*one_tile)
-                cutout[j0:j1,i0:i1] = tile
-        return cutout[top:down,left:right]
+        Copy a loaded plane into out, if given, cropping or padding it
+
+        :returns: out or the plane if out is None
+        '''
+        if out is None:
+            return plane
+        [height, width] = [min(a, b) for a, b in zip(out.shape, plane.shape)]
+        out[:height, :width] = plane[:height, :width]
+        out[height:] = 0
+        out[:, width:] = 0
+        return out
 
     def load(self, cur_path, w):
         '''
@@ -67,58 +108,74 @@ class DataSource(object):
         cache_index = (cur_path, w)
 
         # Check if image in cache
-        if cache_index in self._core._cache:
-            # Move most recently accesed items to the top
-            self._core._cache[cache_index] = self._core._cache.pop(cache_index)
-            print 'Loading from cache!'
-            return self._core._cache[cache_index]
+        cached = self._core._cache.get(cache_index)
+        if cached is not None:
+            log.event('cache', logging.DEBUG, 'Cached %s', cur_path)
+            self._core._stats.count('cache_hit')
+            return cached
+        self._core._stats.count('cache_miss')
+
+        # Check the local disk before the source filesystem
+        disk_cache = self._core._disk_cache
+        if disk_cache:
+            with self._core._stats.timer('disk'):
+                tmp_image = disk_cache.get(cur_path, w)
+            if tmp_image is not None:
+                self._core._stats.count('disk_hit')
+                if not bypassed():
+                    self._core._cache.put(cache_index, tmp_image)
+                return tmp_image
+            self._core._stats.count('disk_miss')
 
         # Load image from given path, check extension
         tile_ext = cur_path.rpartition('.')[2]
-        if tile_ext == 'hdf5':
-            with h5py.File(cur_path, 'r') as f:
-                datasets = []
-                f.visit(datasets.append)
-                tmp_image = f[datasets[0]][()]
-        else:
-            print 'Current path', cur_path
-            tmp_image = cv2.imread(cur_path, 0)
+        # Zoom levels left to scale down after reading
+        levels = w
+        with self._core._stats.timer('read'):
+            if tile_ext == 'hdf5':
+                with h5py.File(cur_path, 'r') as f:
+                    datasets = []
+                    f.visit(datasets.append)
+                    tmp_image = f[datasets[0]][()]
+            else:
+                log.event('tile', logging.DEBUG, 'Reading %s', cur_path)
+                # Decode some formats at a reduced scale for zoom levels
+                tmp_image, levels = decoder.imread(cur_path, w,
+                                                   settings.REDUCED_DECODE)
+                if levels < w:
+                    self._core._stats.count('reduced_decode')
 
         # Resize if necessary, then also store to cache
-        if w > 0:
-            # We will use subsampling for all requests right now for speed
-            if settings.ALWAYS_SUBSAMPLE or self.dtype == np.uint32:
-                # Subsample to preserve accuracy for segmentations
-                tmp_image = tmp_image[::2 ** w, ::2 ** w]
-            else:
-                factor = 0.5 ** w
-                tmp_image = cv2.resize(
-                    tmp_image,
-                    (0,
-                     0),
-                    fx=factor,
-                    fy=factor,
-                    interpolation=settings.IMAGE_RESIZE_METHOD)
-
-        self._core._current_cache_size += tmp_image.size
-
-        # If we don't care to exceed the max cache size temporarily:
-        # self._core._cache[cur_path] = cv2.imread(cur_path, 0)
-        # self._core._current_cache_size += self._core._cache[cur_path].size
-
-        # Remove items in cache until everything fits
-        while self._core._current_cache_size > self._core._max_cache_size:
-            oldest_item = self._core._cache.keys()[0]
-            self._core._current_cache_size -= self._core._cache[
-                oldest_item].size
-            del self._core._cache[oldest_item]
-
-        self._core._cache[cache_index] = tmp_image
+        if levels > 0:
+            with self._core._stats.timer('resize'):
+                # We will use subsampling for all requests right now for speed
+                if settings.ALWAYS_SUBSAMPLE or self.dtype == np.uint32:
+                    # Subsample to preserve accuracy for segmentations
+                    tmp_image = tmp_image[::2 ** levels, ::2 ** levels]
+                else:
+                    factor = 0.5 ** levels
+                    tmp_image = cv2.resize(
+                        tmp_image,
+                        (0,
+                         0),
+                        fx=factor,
+                        fy=factor,
+                        interpolation=settings.IMAGE_RESIZE_METHOD)
+
+        # Bulk reads leave the caches to interactive viewers
+        if bypassed():
+            self._core._stats.count('cache_bypass')
+            return tmp_image
+        self._core._cache.put(cache_index, tmp_image)
+        if disk_cache:
+            disk_cache.put(cur_path, w, tmp_image)
 
         return tmp_image
 
-    def seg_to_color(self, slice):
-        colors = np.zeros(slice.shape+(3,),dtype=np.uint8)
+    def seg_to_color(self, slice, out=None):
+        colors = out
+        if colors is None:
+            colors = np.zeros(slice.shape+(3,),dtype=np.uint8)
         colors[:,:,0] = np.mod(107*slice[:,:],700).astype(np.uint8)
         colors[:,:,1] = np.mod(509*slice[:,:],900).astype(np.uint8)
         colors[:,:,2] = np.mod(200*slice[:,:],777).astype(np.uint8)
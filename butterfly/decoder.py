@@ -0,0 +1,35 @@
+'''Decode image tiles at a reduced scale where the format allows'''
+
+import cv2
+
+'''The cv2 flag to decode a grayscale image at 1 / 2 ** k for each k'''
+REDUCED = {
+    1: 'IMREAD_REDUCED_GRAYSCALE_2',
+    2: 'IMREAD_REDUCED_GRAYSCALE_4',
+    3: 'IMREAD_REDUCED_GRAYSCALE_8'
+}
+
+'''Extensions of formats that decode with less work at a reduced scale'''
+REDUCIBLE = ('jpg', 'jpeg', 'jpe')
+
+
+def imread(path, w, reduced=True):
+    '''
+    Read a grayscale tile, scaled down by as much of 2 ** w as possible
+
+    JPEG decoders can skip most of the inverse DCT to give 1/2, 1/4 or
+    1/8 of the full size. Other formats like PNG would decode at full
+    size anyway, so they are read at full size.
+
+    :param reduced: whether to decode at a reduced scale if possible
+    :returns: the image and the number of zoom levels left to scale it
+    '''
+    ext = path.rpartition('.')[2].lower()
+    k = 0
+    if reduced and ext in REDUCIBLE:
+        k = min(w, max(REDUCED))
+    # Skip any flag this version of cv2 lacks
+    flag = getattr(cv2, REDUCED.get(k, ''), None)
+    if flag is None:
+        return cv2.imread(path, 0), w
+    return cv2.imread(path, flag), w - k
@@ -0,0 +1,104 @@
+'''Find the datasources in all folders under a path'''
+
+import os
+import logging
+from multiprocessing.pool import ThreadPool
+from rh_logger import logger
+import settings
+
+
+class Discovery(object):
+    '''Walk a folder with many threads to find all datasources
+
+    Only paths matching the probe of some datasource are indexed.
+    Every path is recorded with its modification time, its channel
+    if a datasource can load it, and its contents if it is a folder
+    of other paths. Given the record of an earlier walk, all paths
+    with the same modification time are not loaded or listed again.
+    The record of a channel also keeps the modification times of all
+    the files its datasource reads, as a folder's own time does not
+    change when files deeper within it change.
+    '''
+
+    def __init__(self, core, found=None, threads=None):
+        '''
+        :param core: the butterfly.core instance used to index channels
+        :param found: the records of an earlier walk
+        '''
+        self._core = core
+        self._cache = found or {}
+        self._threads = threads or settings.DISCOVERY_THREADS
+        self.found = {}
+
+    def walk(self, root):
+        '''
+        Record all paths under the root one level at a time
+
+        :returns: the record of each path by path
+        '''
+        pool = ThreadPool(max(self._threads, 1))
+        level = [(root, True)]
+        while level:
+            folders = pool.map(self._scan, level)
+            level = [(f, False) for kids in folders for f in kids]
+        pool.close()
+        pool.join()
+        return self.found
+
+    def _scan(self, args):
+        '''
+        Record one path and return all paths within it to scan
+        '''
+        path, is_root = args
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return []
+        record = self._cache.get(path)
+        if not record or record['mtime'] != mtime or self._changed(record):
+            names = None
+            if os.path.isdir(path):
+                names = sorted(os.listdir(path))
+            channel, sources = None, None
+            if not is_root:
+                channel, sources = self._source(path)
+            kids = names if channel is None else None
+            record = {'mtime': mtime, 'channel': channel, 'kids': kids,
+                      'sources': sources}
+        self.found[path] = record
+        return [os.path.join(path, k) for k in record['kids'] or []]
+
+    def _changed(self, record):
+        '''
+        Check if any file read by the datasource of a channel changed
+        '''
+        if not record.get('channel'):
+            return False
+        sources = record.get('sources')
+        if not sources:
+            return True
+        try:
+            return any(os.path.getmtime(s) != m for s, m in sources.items())
+        except OSError:
+            return True
+
+    def _source(self, path):
+        '''
+        Index the datasource for a path if any probe matches it
+
+        :returns: the channel and the modification time of each file
+            its datasource reads, or None and None
+        '''
+        kinds = self._core._registry.rank(path)
+        if not kinds:
+            return None, None
+        try:
+            self._core.create_datasource(path, kinds)
+            datasource = self._core.get_datasource(path)
+            sources = dict((s, os.path.getmtime(s))
+                           for s in datasource.get_sources())
+        except Exception:
+            logger.report_event("Can't load %s" % path,
+                                log_level=logging.DEBUG)
+            return None, None
+        return datasource.get_channel(path), sources
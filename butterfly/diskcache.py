@@ -0,0 +1,126 @@
+'''Keep decoded tiles on a local disk below the memory cache'''
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
+from rh_logger import logger
+
+
+class DiskTileCache(object):
+    '''Save decoded tiles of slow filesystems to a fast local folder
+
+    Each tile is a .npy file named by the hash of its source path, zoom
+    level and the modification time of its source, so a changed source
+    never matches an old tile. Files are written to a temporary name
+    and renamed, so many processes can share the folder. Reading a tile
+    touches its file, and once the files may exceed the max size, the
+    least recently touched files are removed.
+    '''
+
+    '''Fraction of the max size to keep after removing files'''
+    TRIM = 0.9
+
+    def __init__(self, folder, max_size):
+        '''
+        :param folder: the local folder to keep tiles in
+        :param max_size: the most bytes of tiles to keep
+        '''
+        self._folder = os.path.realpath(os.path.expanduser(folder))
+        if not os.path.isdir(self._folder):
+            os.makedirs(self._folder)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Check the size of the folder before the first write
+        self._added = max_size
+
+    def _tile_path(self, path, w):
+        '''
+        Get the file for a tile or None if its source is missing
+        '''
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        key = repr((path, w, mtime))
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._folder, name[:2], name + '.npy')
+
+    def get(self, path, w):
+        '''
+        Load the tile for a source path and zoom level
+
+        :returns: the tile or None if not on disk
+        '''
+        tile_path = self._tile_path(path, w)
+        if tile_path is None:
+            return None
+        try:
+            tile = np.load(tile_path)
+            os.utime(tile_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return tile
+
+    def put(self, path, w, tile):
+        '''
+        Save the tile for a source path and zoom level
+        '''
+        tile_path = self._tile_path(path, w)
+        if tile_path is None:
+            return
+        folder = os.path.dirname(tile_path)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        except OSError:
+            # Another process may have made the folder
+            pass
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp:
+                np.save(tmp, tile)
+            # Replace any old tile at once
+            os.rename(tmp_path, tile_path)
+        except (IOError, OSError), err:
+            logger.report_event("Can't save tile to %s: %s" % (
+                self._folder, err), log_level=logging.WARNING)
+            return
+        with self._lock:
+            self._added += tile.nbytes
+            # Only scan the folder after writing a share of the max size
+            if self._added < self.max_size // 16:
+                return
+            self._added = 0
+        self.trim()
+
+    def trim(self):
+        '''
+        Remove the least recently used tiles beyond the max size
+        '''
+        files = []
+        for root, dirs, names in os.walk(self._folder):
+            for name in names:
+                # Skip tiles other processes are writing
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(f[1] for f in files)
+        if total <= self.max_size:
+            return
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size * self.TRIM:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process may have removed the file
+                pass
+            total -= size
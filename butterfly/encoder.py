@@ -0,0 +1,247 @@
+'''Encode tiles with per-format profiles on a pool of threads'''
+
+import sys
+import json
+import zlib
+import StringIO
+import tifffile
+import numpy as np
+import cv2
+from multiprocessing.pool import ThreadPool
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import labeltile
+from profiler import profiled
+
+'''Options of each image format for each named profile'''
+PROFILES = {
+    'default': {
+        'png': {'compression': 1},
+        'jpg': {'quality': 90},
+        'webp': {'quality': 90},
+        'avif': {'quality': 80, 'speed': 8},
+        'jxl': {'quality': 90, 'effort': 3}
+    },
+    'fast': {
+        'png': {'compression': 0},
+        'jpg': {'quality': 80},
+        'webp': {'quality': 75},
+        'avif': {'quality': 70, 'speed': 10},
+        'jxl': {'quality': 80, 'effort': 1}
+    },
+    'small': {
+        'png': {'compression': 9, 'strategy': 'filtered'},
+        'jpg': {'quality': 75, 'optimize': 1},
+        'webp': {'quality': 60},
+        'avif': {'quality': 50, 'speed': 6},
+        'jxl': {'quality': 70, 'effort': 7}
+    },
+    'lossless': {
+        'png': {'compression': 1},
+        'webp': {'quality': 101},
+        'avif': {'quality': 100, 'speed': 8},
+        'jxl': {'quality': 100, 'effort': 3}
+    }
+}
+
+'''The cv2 flag of each option of each image format'''
+OPTIONS = {
+    'png': {
+        'compression': 'IMWRITE_PNG_COMPRESSION',
+        'strategy': 'IMWRITE_PNG_STRATEGY'
+    },
+    'jpg': {
+        'quality': 'IMWRITE_JPEG_QUALITY',
+        'optimize': 'IMWRITE_JPEG_OPTIMIZE',
+        'progressive': 'IMWRITE_JPEG_PROGRESSIVE'
+    },
+    'webp': {
+        'quality': 'IMWRITE_WEBP_QUALITY'
+    },
+    'avif': {
+        'quality': 'IMWRITE_AVIF_QUALITY',
+        'speed': 'IMWRITE_AVIF_SPEED'
+    },
+    'jxl': {
+        'quality': 'IMWRITE_JPEGXL_QUALITY',
+        'effort': 'IMWRITE_JPEGXL_EFFORT',
+        'distance': 'IMWRITE_JPEGXL_DISTANCE'
+    }
+}
+
+'''The format of the options for each other name of a format'''
+ALIASES = {'jpeg': 'jpg'}
+
+'''The formats of masks and their content types'''
+MASK_FORMATS = {
+    'png': 'image/png',
+    'rle': 'application/json',
+    'bits': 'application/octet-stream'
+}
+
+'''The cv2 png filter strategy for each name'''
+STRATEGIES = {
+    'default': 'IMWRITE_PNG_STRATEGY_DEFAULT',
+    'filtered': 'IMWRITE_PNG_STRATEGY_FILTERED',
+    'huffman': 'IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY',
+    'rle': 'IMWRITE_PNG_STRATEGY_RLE',
+    'fixed': 'IMWRITE_PNG_STRATEGY_FIXED'
+}
+
+
+def merge_profiles(profiles):
+    '''
+    Add or update the built-in PROFILES with more profiles
+    '''
+    merged = dict((name, dict((fmt, dict(options))
+                              for fmt, options in profile.items()))
+                  for name, profile in PROFILES.items())
+    for name, profile in (profiles or {}).items():
+        for fmt, options in profile.items():
+            merged.setdefault(name, {}).setdefault(fmt, {}).update(options)
+    return merged
+
+
+class Encoder(object):
+    '''Encode tiles in each output format
+
+    Image formats are written by cv2 with the options of a named
+    profile. Encoding runs on a pool of threads, as cv2 releases the
+    GIL while it compresses.
+    '''
+
+    def __init__(self, threads=4, profiles=None, default='default'):
+        '''
+        :param threads: the number of encoding threads, or 0 for none
+        :param profiles: more profiles to add to the built-in PROFILES
+        :param default: the profile to use if none is given
+        '''
+        self.profiles = merge_profiles(profiles)
+        self.default = default
+        self._threads = threads
+        self._pool = None
+        self._params = {}
+
+    def get_params(self, fmt, profile=None):
+        '''
+        Get the cv2.imencode flags for a format and profile
+        '''
+        profile = profile or self.default
+        key = (fmt, profile)
+        if key not in self._params:
+            fmt = ALIASES.get(fmt, fmt)
+            options = self.profiles.get(profile, {}).get(fmt, {})
+            params = []
+            for name, value in sorted(options.items()):
+                # Skip any option this version of cv2 lacks
+                flag = getattr(cv2, OPTIONS.get(fmt, {}).get(name, ''), None)
+                if name == 'strategy':
+                    value = getattr(cv2, STRATEGIES.get(value, ''), None)
+                if flag is not None and value is not None:
+                    params += [flag, int(value)]
+            self._params[key] = params
+        return self._params[key]
+
+    def encode_image(self, image, fmt, profile=None):
+        '''
+        Encode a 2D or color image in a format written by cv2
+        '''
+        params = self.get_params(fmt, profile)
+        ok, output = cv2.imencode('.' + fmt, image, params)
+        if not ok:
+            raise ValueError('Could not encode tile as %s' % fmt)
+        return output.tostring()
+
+    def encode(self, vol, fmt, profile=None):
+        '''
+        Encode the first plane of a volume for /api/data
+
+        :param vol: the y, x, z array or y, x, z, color array
+        '''
+        if fmt in ['label']:
+            return labeltile.encode(vol[:,:,0])
+        elif fmt in ['zip']:
+            volstring = vol[:,:,0].T.astype(np.uint32).tostring('F')
+            return zlib.compress(volstring)
+        elif fmt in ['tif','tiff']:
+            output = StringIO.StringIO()
+            tiffvol = vol[:,:,0].astype(np.uint32)
+            tifffile.imsave(output, tiffvol)
+            return output.getvalue()
+        if vol.dtype.itemsize == 4:
+            vol = vol.view(np.uint8).reshape(vol.shape[0], vol.shape[1], 4)
+        return self.encode_image(vol, fmt, profile)
+
+    def encode_mask(self, mask, fmt, profile=None):
+        '''
+        Encode a 2D boolean mask for /api/mask
+
+        "png" is a 1-bit png if cv2 can write one, "rle" is json of the
+        width, height and runs.counts, and "bits" is the row-major bits
+        of the mask, eight to a byte with the first pixel highest.
+        '''
+        if fmt in ['rle']:
+            [height, width] = mask.shape
+            counts = labeltile.runs(mask)
+            return json.dumps({
+                'width': width,
+                'height': height,
+                'counts': counts.tolist()
+            })
+        elif fmt in ['bits']:
+            return np.packbits(mask).tostring()
+        elif fmt not in ['png']:
+            raise ValueError('Could not encode mask as %s' % fmt)
+        params = list(self.get_params(fmt, profile))
+        bilevel = getattr(cv2, 'IMWRITE_PNG_BILEVEL', None)
+        if bilevel is not None:
+            params += [bilevel, 1]
+        image = mask.astype(np.uint8) * 255
+        ok, output = cv2.imencode('.png', image, params)
+        if not ok:
+            raise ValueError('Could not encode mask as %s' % fmt)
+        return output.tostring()
+
+    def submit(self, vol, fmt, profile=None):
+        '''
+        Encode a volume like encode on the thread pool
+
+        :returns: a tornado Future for the encoded bytes
+        '''
+        return self._submit(self.encode, vol, fmt, profile)
+
+    def submit_image(self, image, fmt, profile=None):
+        '''
+        Encode an image like encode_image on the thread pool
+
+        :returns: a tornado Future for the encoded bytes
+        '''
+        return self._submit(self.encode_image, image, fmt, profile)
+
+    def submit_mask(self, mask, fmt, profile=None):
+        '''
+        Encode a mask like encode_mask on the thread pool
+
+        :returns: a tornado Future for the encoded bytes
+        '''
+        return self._submit(self.encode_mask, mask, fmt, profile)
+
+    def _submit(self, function, *args):
+        future = Future()
+        if not self._threads:
+            future.set_result(function(*args))
+            return future
+        if self._pool is None:
+            self._pool = ThreadPool(self._threads)
+        ioloop = IOLoop.current()
+
+        def work():
+            try:
+                result = profiled(function, *args)
+                ioloop.add_callback(future.set_result, result)
+            except Exception:
+                ioloop.add_callback(future.set_exc_info, sys.exc_info())
+
+        self._pool.apply_async(work)
+        return future
@@ -0,0 +1,108 @@
+'''Log frequent events by category without slowing requests'''
+
+import os
+import time
+import atexit
+import logging
+import threading
+import collections
+from rh_logger import logger
+
+import settings
+
+
+class EventLog(object):
+    '''Write sampled events to the rh_logger from a background thread
+
+    Each event has a category such as "tile" or "request" and a level
+    from the logging module. Events below the level of their category
+    are dropped before their message is formatted, so disabled events
+    cost one dictionary lookup. A category can also keep only one of
+    every few events. Kept events wait in a bounded queue for a thread
+    that formats and reports them in batches.
+    '''
+
+    '''Seconds between writes of queued events'''
+    INTERVAL = 0.5
+
+    def __init__(self, level=logging.INFO, levels=None, samples=None,
+                 size=10000):
+        '''
+        :param level: the least level of categories not in levels
+        :param levels: the least level of each category
+        :param samples: the fraction of events to keep in each category
+        :param size: the most events to queue before dropping the oldest
+        '''
+        self._level = level
+        self._levels = dict(levels or {})
+        self._every = dict((category, max(int(round(1 / rate)), 1))
+                           for category, rate in (samples or {}).items()
+                           if rate > 0)
+        self._seen = collections.Counter()
+        self._queue = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    def enabled(self, category, level=logging.DEBUG):
+        return level >= self._levels.get(category, self._level)
+
+    def event(self, category, level, msg, *args):
+        '''
+        Queue an event unless its category is disabled at its level
+
+        :param msg: a format string for the args, formatted only if kept
+        '''
+        if level < self._levels.get(category, self._level):
+            return
+        every = self._every.get(category)
+        if every:
+            self._seen[category] += 1
+            if self._seen[category] % every:
+                return
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((category, level, msg, args))
+            # Forked processes need their own writer thread
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        '''
+        Report all queued events now
+        '''
+        with self._lock:
+            batch = list(self._queue)
+            self._queue.clear()
+        for category, level, msg, args in batch:
+            try:
+                text = msg % args if args else msg
+            except (TypeError, ValueError):
+                text = '%s %r' % (msg, args)
+            logger.report_event('[%s] %s' % (category, text),
+                                log_level=level)
+
+    def _run(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            self.flush()
+
+
+def _level(name):
+    '''
+    Get the number of a level given by name or number
+    '''
+    if isinstance(name, int):
+        return name
+    return logging.getLevelName(name.upper())
+
+
+log = EventLog(_level(settings.LOG_LEVEL),
+               dict((c, _level(l)) for c, l in settings.LOG_LEVELS.items()),
+               settings.LOG_SAMPLES, settings.LOG_QUEUE_SIZE)
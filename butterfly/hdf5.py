@@ -44,6 +44,15 @@ class HDF5DataSource(DataSource):
             raise IndexError(warn)
         super(HDF5DataSource, self).__init__(core, datapath)
 
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+        '''
+        ext = os.path.splitext(datapath)[1]
+        return int(ext in ('.h5', '.hdf5', '.json') and
+                   os.path.isfile(datapath))
+
     def loadFolder(self,path):
         if path.endswith('.json'):
             result = json.load(open(path, "r"))
@@ -57,7 +66,7 @@ class HDF5DataSource(DataSource):
                     self._dtype = fd[d[K_DATASET_PATH]].dtype
             return result
 
-        elif path.endswith('.h5'):
+        elif path.endswith(('.h5', '.hdf5')):
             with h5py.File(path, "r") as fd:
                 key0 = fd.keys()[0]
                 self._dtype = fd[key0].dtype
@@ -80,6 +89,13 @@ class HDF5DataSource(DataSource):
 
         super(HDF5DataSource, self).index()
 
+    def get_sources(self):
+        '''
+        @override
+        '''
+        filenames = [d[K_FILENAME] for d in self._dataset]
+        return [self._datapath] + filenames
+
     def get_plane_info(self, z):
         '''Get the filename, dataset path and z-index for a given plane
 
@@ -94,12 +110,16 @@ class HDF5DataSource(DataSource):
                 return d[K_FILENAME], d[K_DATASET_PATH], z-z_offset
         return (None, None, None)
 
-    def load_cutout(self, x0, x1, y0, y1, z, w):
+    def load_cutout(self, x0, x1, y0, y1, z, w, out=None):
         '''
         @override
         '''
         filename, dataset_path, z_idx = self.get_plane_info(z)
-        result = np.zeros(((y1- y0) / (2**w), (x1-x0) / (2**w)), dtype=self._dtype)
+        if out is None:
+            result = np.zeros(((y1- y0) / (2**w), (x1-x0) / (2**w)), dtype=self._dtype)
+        else:
+            result = out
+            result[:] = 0
         if filename is not None:
             with h5py.File(filename, "r") as fd:
                 ds = fd[dataset_path]
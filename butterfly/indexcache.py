@@ -0,0 +1,83 @@
+'''On-disk snapshots of indexed datasources'''
+
+import os
+import hashlib
+import logging
+import tempfile
+import cPickle as pickle
+from rh_logger import logger
+
+'''Increase whenever the indexed state of any datasource changes'''
+INDEX_VERSION = 1
+
+
+class IndexCache(object):
+    '''Save and restore the state of DataSource.index
+
+    Each snapshot is a pickle named by the hash of the datapath holding
+    the INDEX_VERSION, the datasource class, the modification times of
+    all the datasource's sources, and the indexed attributes. A snapshot
+    is only restored if all of these still match.
+    '''
+
+    def __init__(self, folder):
+        self._folder = os.path.realpath(os.path.expanduser(folder))
+        if not os.path.isdir(self._folder):
+            os.makedirs(self._folder)
+
+    def _snapshot_path(self, datapath):
+        name = hashlib.sha1(datapath.encode('utf-8')).hexdigest()
+        name += '.pickle'
+        return os.path.join(self._folder, name)
+
+    def _mtimes(self, datasource):
+        sources = datasource.get_sources()
+        return dict((s, os.path.getmtime(s)) for s in sources)
+
+    def _header(self, datasource):
+        return {
+            'version': INDEX_VERSION,
+            'kind': type(datasource).__name__,
+            'mtimes': self._mtimes(datasource)
+        }
+
+    def load(self, datasource):
+        '''
+        Restore the index of a datasource if its snapshot is current
+
+        :returns: True if the datasource no longer needs an index
+        '''
+        path = self._snapshot_path(datasource._datapath)
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, 'rb') as fd:
+                header = pickle.load(fd)
+                if header != self._header(datasource):
+                    return False
+                datasource.set_state(pickle.load(fd))
+        except Exception, err:
+            logger.report_event(
+                "Can't restore index of %s: %s" % (datasource._datapath, err),
+                log_level=logging.WARNING)
+            return False
+        logger.report_event("Restored index of " + datasource._datapath)
+        return True
+
+    def save(self, datasource):
+        '''
+        Write a snapshot of an indexed datasource
+        '''
+        path = self._snapshot_path(datasource._datapath)
+        fd, tmp_path = tempfile.mkstemp(dir=self._folder)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                pickle.dump(self._header(datasource), tmp, -1)
+                pickle.dump(datasource.get_state(), tmp, -1)
+            # Replace any old snapshot at once
+            os.rename(tmp_path, path)
+        except Exception, err:
+            os.remove(tmp_path)
+            logger.report_event(
+                "Can't save index of %s: %s" % (datasource._datapath, err),
+                log_level=logging.WARNING)
@@ -0,0 +1,316 @@
+'''Find the bounds and tiles of each label id of a segmentation'''
+
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+
+'''Increase whenever the layout of label indexes changes'''
+INDEX_VERSION = 2
+
+'''The bounds and voxel count of each label, sorted by id
+
+The x1, y1 and z1 bounds are one past the last voxel, and the tiles of
+each label are the count of tiles after start in the tiles array.'''
+LABEL = np.dtype([
+    ('id', '<u8'),
+    ('voxels', '<u8'),
+    ('x0', '<u4'), ('x1', '<u4'),
+    ('y0', '<u4'), ('y1', '<u4'),
+    ('z0', '<u4'), ('z1', '<u4'),
+    ('start', '<u8'),
+    ('count', '<u4')
+])
+
+'''The column, row and plane of a tile holding a label'''
+TILE = np.dtype([('x', '<u4'), ('y', '<u4'), ('z', '<u4')])
+
+'''The files of each label index'''
+HEADER = 'index.json'
+LABELS = 'labels.npy'
+TILES = 'tiles.npy'
+
+'''The core, datapath and tile size of each worker'''
+_worker = {}
+
+
+def index_folder(root, datapath):
+    '''
+    Get the folder in root for the label index of a datapath
+    '''
+    name = hashlib.sha1(datapath.encode('utf-8')).hexdigest()
+    return os.path.join(os.path.realpath(os.path.expanduser(root)), name)
+
+
+def source_mtimes(source):
+    '''
+    Get the modification times of the files a datasource reads
+    '''
+    return dict((s, os.path.getmtime(s)) for s in source.get_sources())
+
+
+def tile_labels(tile, x, y, z):
+    '''
+    Find the bounds and voxel count of each nonzero label in a tile
+
+    :param x, y, z: the offset of the tile in the volume
+    :returns: a LABEL array of the labels in the tile, sorted by id
+    '''
+    ids, inverse, voxels = np.unique(tile, return_inverse=True,
+                                     return_counts=True)
+    labels = np.zeros(len(ids), LABEL)
+    labels['id'] = ids
+    labels['voxels'] = voxels
+    # Bounds of each label from the rows and columns it is found in
+    for dim, low, high, offset in ((0, 'y0', 'y1', y), (1, 'x0', 'x1', x)):
+        where = np.indices(tile.shape)[dim].ravel()
+        first = np.full(len(ids), tile.shape[dim], where.dtype)
+        last = np.zeros(len(ids), where.dtype)
+        np.minimum.at(first, inverse.ravel(), where)
+        np.maximum.at(last, inverse.ravel(), where)
+        labels[low] = first + offset
+        labels[high] = last + 1 + offset
+    labels['z0'] = z
+    labels['z1'] = z + 1
+    return labels[ids != 0]
+
+
+def _start(datapath, tile_size):
+    '''
+    Open the datapath once in each worker
+    '''
+    from core import Core
+    core = Core()
+    core.create_datasource(datapath)
+    _worker.update(core=core, datapath=datapath, tile_size=tile_size)
+
+
+def index_plane(z):
+    '''
+    Find the labels of each tile of a plane
+
+    :returns: the LABEL array and TILE array for each label in each tile
+    '''
+    core = _worker['core']
+    datapath = _worker['datapath']
+    size = _worker['tile_size']
+    source = core._datasources[datapath]
+    [width, height] = source.get_boundaries()[:2]
+    all_labels = []
+    all_tiles = []
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            shape = [min(size, width - x), min(size, height - y), 1]
+            vol = core.get(datapath, [x, y, z], shape, bypass_cache=True)
+            labels = tile_labels(vol[:,:,0], x, y, z)
+            tiles = np.zeros(len(labels), TILE)
+            tiles['x'] = x // size
+            tiles['y'] = y // size
+            tiles['z'] = z
+            all_labels.append(labels)
+            all_tiles.append(tiles)
+    return np.concatenate(all_labels), np.concatenate(all_tiles)
+
+
+def merge(labels, tiles):
+    '''
+    Merge the labels found in each tile into one record per id
+
+    :param labels: a LABEL array for each label in each tile
+    :param tiles: the TILE of each of the labels
+    :returns: the LABEL array sorted by id and the TILE array by label
+    '''
+    if not len(labels):
+        return np.zeros(0, LABEL), np.zeros(0, TILE)
+    order = np.argsort(labels['id'], kind='mergesort')
+    labels = labels[order]
+    tiles = tiles[order]
+    ids = labels['id']
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    merged = np.zeros(len(starts), LABEL)
+    merged['id'] = ids[starts]
+    merged['voxels'] = np.add.reduceat(labels['voxels'], starts)
+    for low, high in (('x0', 'x1'), ('y0', 'y1'), ('z0', 'z1')):
+        merged[low] = np.minimum.reduceat(labels[low], starts)
+        merged[high] = np.maximum.reduceat(labels[high], starts)
+    merged['start'] = starts
+    merged['count'] = np.diff(np.r_[starts, len(labels)])
+    return merged, tiles
+
+
+def build(datapath, output, tile_size=512, workers=1):
+    '''
+    Index the labels of every plane of a segmentation
+
+    :param output: the folder to write the index to
+    :param workers: the number of processes, or 0 for one per cpu
+    '''
+    from rh_logger import logger
+    _start(datapath, tile_size)
+    source = _worker['core']._datasources[datapath]
+    # Taken before reading, so edits made while indexing are noticed
+    mtimes = source_mtimes(source)
+    [width, height, depth] = source.get_boundaries()[:3]
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        done = (index_plane(z) for z in range(depth))
+    else:
+        pool = multiprocessing.Pool(workers, _start, (datapath, tile_size))
+        done = pool.imap(index_plane, range(depth))
+    start = time.time()
+    all_labels = []
+    all_tiles = []
+    for z, (labels, tiles) in enumerate(done):
+        all_labels.append(labels)
+        all_tiles.append(tiles)
+        logger.report_event("Indexed z=%d (%d of %d) in %.1f s" % (
+            z, z + 1, depth, time.time() - start), log_level=logging.INFO)
+    if workers != 1:
+        pool.close()
+        pool.join()
+    labels, tiles = merge(np.concatenate(all_labels),
+                          np.concatenate(all_tiles))
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    np.save(os.path.join(output, LABELS), labels)
+    np.save(os.path.join(output, TILES), tiles)
+    # Write the header last, so an unfinished index is never loaded
+    with open(os.path.join(output, HEADER), 'w') as fd:
+        json.dump({
+            'version': INDEX_VERSION,
+            'datapath': datapath,
+            'tile-size': tile_size,
+            'shape': [depth, height, width],
+            'labels': len(labels),
+            'mtimes': mtimes
+        }, fd, indent=2, sort_keys=True)
+
+
+class LabelIndex(object):
+    '''Look up the bounds and tiles of label ids in a saved index
+
+    The arrays are memory mapped, so loading is instant and lookups
+    only read the pages of the ids they find. The index keeps the
+    modification times of the files it was built from, so an index of
+    an edited segmentation can be found out of date.
+    '''
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, HEADER), 'r') as fd:
+            header = json.load(fd)
+        if header.get('version') != INDEX_VERSION:
+            raise IOError("%s has an unknown label index version" % folder)
+        self.tile_size = header['tile-size']
+        self.mtimes = header['mtimes']
+        self._labels = np.load(os.path.join(folder, LABELS), mmap_mode='r')
+        self._tiles = np.load(os.path.join(folder, TILES), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._labels)
+
+    def is_current(self, source):
+        '''
+        Check that the files of a datasource are unchanged since indexing
+        '''
+        try:
+            return source_mtimes(source) == self.mtimes
+        except OSError:
+            return False
+
+    def find(self, label_id):
+        '''
+        Get the record of a label id
+
+        :returns: the LABEL record or None if the id is not found
+        '''
+        ids = self._labels['id']
+        i = int(np.searchsorted(ids, label_id))
+        if i >= len(ids) or ids[i] != label_id:
+            return None
+        return self._labels[i]
+
+    def tiles(self, label_id):
+        '''
+        Get the TILE array of the tiles holding a label id
+        '''
+        label = self.find(label_id)
+        if label is None:
+            return np.zeros(0, TILE)
+        start = int(label['start'])
+        return self._tiles[start:start + int(label['count'])]
+
+    def describe(self, label_id):
+        '''
+        Get the bounds, voxels and tile origins of a label id as json
+
+        :returns: the dictionary or None if the id is not found
+        '''
+        label = self.find(label_id)
+        if label is None:
+            return None
+        size = self.tile_size
+        tiles = self.tiles(label_id)
+        return {
+            'id': int(label['id']),
+            'voxels': int(label['voxels']),
+            'bounds': dict((k, int(label[k])) for k in
+                           ('x0', 'x1', 'y0', 'y1', 'z0', 'z1')),
+            'tile-size': size,
+            'tiles': [[int(t['x']) * size, int(t['y']) * size, int(t['z'])]
+                      for t in tiles]
+        }
+
+    def regions(self, ids, z, x0, x1, y0, y1):
+        '''
+        Get the parts of a region of a plane in tiles with any of the ids
+
+        :returns: the x0, x1, y0, y1 of each part
+        '''
+        size = self.tile_size
+        found = set()
+        for label_id in ids:
+            tiles = self.tiles(label_id)
+            tiles = tiles[tiles['z'] == z]
+            found.update(zip(tiles['x'].tolist(), tiles['y'].tolist()))
+        parts = []
+        for tx, ty in sorted(found):
+            part = [max(x0, tx * size), min(x1, (tx + 1) * size),
+                    max(y0, ty * size), min(y1, (ty + 1) * size)]
+            if part[0] < part[1] and part[2] < part[3]:
+                parts.append(part)
+        return parts
+
+
+def main():
+    '''
+    Butterfly label indexing
+    '''
+    help = {
+        'index': 'Index the bounds and tiles of each label id',
+        'datapath': 'a segmentation datapath bfly can serve',
+        'output': 'root folder of label indexes (default label-index-path)',
+        'tile': 'width and height of each indexed tile',
+        'workers': 'number of processes (default one per cpu)'
+    }
+    parser = argparse.ArgumentParser(description=help['index'])
+    parser.add_argument('datapath', help=help['datapath'])
+    parser.add_argument('-o', '--out', metavar='out', help=help['output'])
+    parser.add_argument('--tile', type=int, default=512, help=help['tile'])
+    parser.add_argument('-j', '--workers', type=int, default=0,
+                        help=help['workers'])
+    parsed = parser.parse_args()
+
+    import settings
+    from rh_logger import logger
+    logger.start_process("bfly_index", "Starting butterfly label index",
+                         [parsed.datapath])
+    root = parsed.out or settings.LABEL_INDEX_PATH
+    if not root:
+        parser.error('Give --out or set label-index-path')
+    output = index_folder(root, parsed.datapath)
+    build(parsed.datapath, output, parsed.tile, parsed.workers)
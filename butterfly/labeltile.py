@@ -0,0 +1,72 @@
+'''Compact label tiles as a palette of ids and an index image'''
+
+import struct
+import zlib
+import numpy as np
+
+'''The width, height, palette length and index bytes as uint32'''
+HEADER = struct.Struct('<4I')
+
+
+def pack(plane):
+    '''
+    Split a label plane into its palette and an index into the palette
+
+    :param plane: a 2D array of label ids
+    :returns: the sorted palette and the smallest uint index image
+    '''
+    palette, index = np.unique(plane, return_inverse=True)
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if len(palette) <= np.iinfo(dtype).max + 1:
+            break
+    return palette, index.astype(dtype).reshape(plane.shape)
+
+
+def unpack(palette, index):
+    '''
+    Get the label plane from its palette and index image
+    '''
+    return palette[index]
+
+
+def encode(plane, level=6):
+    '''
+    Compress a label plane for the viewer
+
+    The zlib stream has the HEADER, the palette as little-endian
+    uint32, and then the row-major index image as little-endian uint8,
+    uint16 or uint32 given by the index bytes in the HEADER.
+    '''
+    palette, index = pack(plane)
+    [height, width] = plane.shape
+    header = HEADER.pack(width, height, len(palette), index.itemsize)
+    palette = palette.astype('<u4').tostring()
+    index = index.astype(index.dtype.newbyteorder('<')).tostring()
+    return zlib.compress(header + palette + index, level)
+
+
+def mask(plane, ids):
+    '''
+    Find where a label plane has any of the ids
+
+    :returns: a boolean array the shape of the plane
+    '''
+    ids = np.unique(ids)
+    if len(ids) == 1:
+        return plane == ids[0]
+    return np.in1d(plane.ravel(), ids).reshape(plane.shape)
+
+
+def runs(mask):
+    '''
+    Count the lengths of the runs of a mask in row-major order
+
+    The runs alternate between False and True, starting with False,
+    so the first count is 0 if the first pixel is True.
+    '''
+    flat = mask.ravel()
+    edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], edges, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts
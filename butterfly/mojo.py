@@ -2,7 +2,8 @@ import os
 import glob
 import h5py
 import numpy as np
-from rh_logger import logger
+import logging
+from eventlog import log
 from datasource import DataSource
 
 class Mojo(DataSource):
@@ -15,6 +16,13 @@ class Mojo(DataSource):
             raise IndexError("Datapath %s is not a Mojo data path" % datapath)
         super(Mojo, self).__init__(core, datapath)
 
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+        '''
+        return int(os.path.isdir(os.path.join(datapath, 'tiles')))
+
     def index(self):
         '''
         @override
@@ -55,6 +63,15 @@ class Mojo(DataSource):
 
         super(Mojo, self).index()
 
+    def get_sources(self):
+        '''
+        @override
+        '''
+        base_path = os.path.join(self._datapath, 'tiles')
+        slice_path = os.path.join(base_path, 'w=00000000')
+        first_slice = sorted(glob.glob(os.path.join(slice_path, 'z=*')))[:1]
+        return [base_path, slice_path] + first_slice
+
     def load_info(self, folderpaths, filename, indices):
         self._folderpaths = folderpaths
         self._filename = filename
@@ -70,7 +87,7 @@ class Mojo(DataSource):
             'y': self._indices[1][y]
         }
 
-        logger.report_event("Mojo loading " + cur_filename)
+        log.event('tile', logging.DEBUG, 'Mojo loading %s', cur_filename)
 
         if w <= self.max_zoom:
             cur_path = os.path.join(
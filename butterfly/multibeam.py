@@ -1,7 +1,12 @@
 from datasource import DataSource
 import dataspec
+import glob
+import os
+import threading
 import numpy as np
+import logging
 from rh_logger import logger
+from eventlog import log
 from rh_renderer.models import AffineModel, Transforms
 from rh_renderer.single_tile_renderer import SingleTileRendererBase
 from rh_renderer.multiple_tiles_renderer import MultipleTilesRenderer
@@ -11,6 +16,11 @@ from urllib2 import HTTPError
 
 class MultiBeam(DataSource):
 
+    '''The attributes of the index that are known to pickle'''
+    STATE = ('coords', 'bboxes', 'layer_files', 'min_x', 'max_x', 'min_y',
+             'max_y', 'min_z', 'max_z', 'tile_width', 'tile_height',
+             'blocksize', 'dtype')
+
     def __init__(self, core, datapath):
         '''
         @override
@@ -22,8 +32,21 @@ class MultiBeam(DataSource):
                 "Failed to load %s as multibeam data source" % datapath,
                 [], None)
 
+        self._ts_lock = threading.Lock()
         super(MultiBeam, self).__init__(core, datapath)
 
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+
+        Only a weak match, as dataspec may load many kinds of path
+        '''
+        if os.path.isdir(datapath):
+            ts_fnames = os.path.join(datapath, '*.json')
+            return 0.5 * bool(glob.glob(ts_fnames))
+        return 0.5 * datapath.endswith('.json')
+
     def index(self):
         '''
         @override
@@ -31,6 +54,9 @@ class MultiBeam(DataSource):
 
         self.ts = {}
         self.coords = {}
+        self.bboxes = {}
+        self.layer_files = {}
+        self._file_ts = {}
         self.kdtrees = {}
         self.min_x = np.inf
         self.max_x = - np.inf
@@ -38,30 +64,35 @@ class MultiBeam(DataSource):
         self.max_y = - np.inf
         self.min_z = np.inf
         self.max_z = - np.inf
-        for tilespec in dataspec.load(self._datapath):
-            for ts in tilespec:
-                bbox = ts.bbox
-                x0 = bbox.x0
-                x1 = bbox.x1
-                y0 = bbox.y0
-                y1 = bbox.y1
-                center_x = (x0 + x1) / 2
-                center_y = (y0 + y1) / 2
-                layer = ts.layer
+        for fname in self._spec_files():
+            for layer, layer_ts in self._load_file(fname).items():
                 if layer not in self.coords:
                     self.coords[layer] = []
+                    self.bboxes[layer] = []
+                    self.layer_files[layer] = []
                     self.ts[layer] = []
-                self.coords[layer].append((center_x, center_y))
-                self.ts[layer].append(ts)
-                self.min_x = min(self.min_x, x0)
-                self.max_x = max(self.max_x, x1)
-                self.min_y = min(self.min_y, y0)
-                self.max_y = max(self.max_y, y1)
+                self.layer_files[layer].append(fname)
+                for ts in layer_ts:
+                    bbox = ts.bbox
+                    x0 = bbox.x0
+                    x1 = bbox.x1
+                    y0 = bbox.y0
+                    y1 = bbox.y1
+                    center_x = (x0 + x1) / 2
+                    center_y = (y0 + y1) / 2
+                    self.coords[layer].append((center_x, center_y))
+                    self.bboxes[layer].append((x0, y0, x1, y1))
+                    self.ts[layer].append(ts)
+                    self.min_x = min(self.min_x, x0)
+                    self.max_x = max(self.max_x, x1)
+                    self.min_y = min(self.min_y, y0)
+                    self.max_y = max(self.max_y, y1)
                 self.min_z = min(self.min_z, layer)
                 self.max_z = max(self.max_z, layer)
         for layer in self.coords:
-            coords = self.coords[layer] = np.array(self.coords[layer])
-            self.kdtrees[layer] = KDTree(np.array(coords))
+            self.coords[layer] = np.array(self.coords[layer])
+            self.bboxes[layer] = np.array(self.bboxes[layer])
+        self._make_kdtrees()
         self.tile_width = ts.width
         self.tile_height = ts.height
         self.blocksize = np.array((4096, 4096))
@@ -73,17 +104,88 @@ class MultiBeam(DataSource):
 
         super(MultiBeam, self).index()
 
-    def load_cutout(self, x0, x1, y0, y1, z, w):
+    def _spec_files(self):
+        '''
+        List the files of tilespecs in the datapath in a fixed order
+        '''
+        if os.path.isdir(self._datapath):
+            ts_fnames = glob.glob(os.path.join(self._datapath, '*.json'))
+            if ts_fnames:
+                return sorted(ts_fnames)
+        return [self._datapath]
+
+    def _load_file(self, fname):
+        '''
+        Read the tilespecs of one file by layer, only once
+        '''
+        if fname not in self._file_ts:
+            file_ts = {}
+            for tilespec in dataspec.load(fname):
+                for ts in tilespec:
+                    file_ts.setdefault(ts.layer, []).append(ts)
+            self._file_ts[fname] = file_ts
+        return self._file_ts[fname]
+
+    def _make_kdtrees(self):
+        self.kdtrees = {}
+        for layer in self.coords:
+            self.kdtrees[layer] = KDTree(self.coords[layer])
+
+    def get_layer(self, z):
+        '''
+        Get the tilespecs of a layer, reading its files on first use
+
+        :returns: the tilespecs in the order of the layer's kdtree
+        '''
+        with self._ts_lock:
+            if z not in self.ts:
+                layer_ts = []
+                for fname in self.layer_files.get(z, []):
+                    layer_ts += self._load_file(fname).get(z, [])
+                self.ts[z] = layer_ts
+            return self.ts[z]
+
+    def get_sources(self):
         '''
         @override
         '''
-        if z not in self.ts or len(self.ts[z]) == 0:
-            return np.zeros((int((x1 - x0) / 2**w),
-                             int((y1 - y0) / 2**w)), np.uint8)
-        if hasattr(self.ts[z][0], "section"):
-            section = self.ts[z][0].section
-            return section.imread(x0, y0, x1, y1, w)
-        return self.load_tilespec_cutout(x0, x1, y0, y1, z, w)
+        if os.path.isdir(self._datapath):
+            return [self._datapath] + self._spec_files()
+        return [self._datapath]
+
+    def get_state(self):
+        '''
+        @override
+
+        The tilespecs from dataspec may not pickle, so each layer reads
+        them again on its first use. The bounds and centers of all tiles
+        and the type are kept, so the kdtrees rebuild without them.
+        '''
+        return dict((key, getattr(self, key)) for key in self.STATE)
+
+    def set_state(self, state):
+        '''
+        @override
+        '''
+        super(MultiBeam, self).set_state(state)
+        self.ts = {}
+        self._file_ts = {}
+        self._make_kdtrees()
+
+    def load_cutout(self, x0, x1, y0, y1, z, w, out=None):
+        '''
+        @override
+        '''
+        layer_ts = self.get_layer(z)
+        if len(layer_ts) == 0:
+            plane = np.zeros((int((x1 - x0) / 2**w),
+                              int((y1 - y0) / 2**w)), np.uint8)
+        elif hasattr(layer_ts[0], "section"):
+            section = layer_ts[0].section
+            plane = section.imread(x0, y0, x1, y1, w)
+        else:
+            plane = self.load_tilespec_cutout(x0, x1, y0, y1, z, w)
+        return self.write_out(plane, out)
 
     def load_tilespec_cutout(self, x0, x1, y0, y1, z, w):
         '''Load a cutout from tilespecs'''
@@ -101,8 +203,9 @@ class MultiBeam(DataSource):
         d, idxs = kdtree.query(coords)
         idxs = np.unique(idxs)
         single_renderers = []
+        layer_ts = self.get_layer(z)
         for idx in idxs:
-            ts = self.ts[z][idx]
+            ts = layer_ts[idx]
             transformation_models = []
             for ts_transform in ts.get_transforms():
                 model = Transforms.from_tilespec(ts_transform)
@@ -136,8 +239,8 @@ class MultiBeam(DataSource):
         y0 = y * self.blocksize[0]
         x1 = x0 + self.blocksize[0]
         y1 = y0 + self.blocksize[1]
-        logger.report_event(
-            "Fetching x=%d:%d, y=%d:%d, z=%d" % (x0, x1, y0, y1, z))
+        log.event('tile', logging.DEBUG,
+                  "Fetching x=%d:%d, y=%d:%d, z=%d", x0, x1, y0, y1, z)
 
         kdtree = self.kdtrees[z]
         assert isinstance(kdtree, KDTree)
@@ -152,8 +255,9 @@ class MultiBeam(DataSource):
         d, idxs = kdtree.query(coords)
         idxs = np.unique(idxs)
         single_renderers = []
+        layer_ts = self.get_layer(z)
         for idx in idxs:
-            ts = self.ts[z][idx]
+            ts = layer_ts[idx]
             renderer = TilespecSingleTileRenderer(
                 ts, compute_distances=False,
                 mipmap_level=w)
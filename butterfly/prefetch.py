@@ -0,0 +1,141 @@
+'''Load tiles near recent requests while the server is idle'''
+
+import time
+import logging
+import threading
+import collections
+from rh_logger import logger
+
+
+class Live(object):
+    '''Count the requests running now'''
+
+    def __init__(self):
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self._count += 1
+
+    def __exit__(self, *args):
+        with self._lock:
+            self._count -= 1
+
+    def idle(self):
+        return self._count == 0
+
+
+class Prefetcher(object):
+    '''Load the neighbors of requested tiles in a background thread
+
+    Each requested tile queues the same tile up to depth slices above
+    and below, the tile covering it at the next zoom level, and the
+    tiles it covers at the last zoom level. Newer tiles load first and
+    the oldest tiles are dropped from a full queue. Any tile more than
+    depth slices from the newest request for its datapath is dropped.
+    Tiles only load while no live request is running, checked again
+    just before each load. After each load the thread rests so that
+    loading takes at most the budget share of its time.
+    '''
+
+    '''Seconds to wait before checking if the server is idle'''
+    WAIT = 0.05
+
+    def __init__(self, core, depth, size, budget=0.5):
+        '''
+        :param core: the butterfly.core instance to fill with tiles
+        :param depth: the number of slices to load above and below
+        :param size: the most tiles to queue
+        :param budget: the most share of time to spend loading tiles
+        '''
+        if not 0 < budget <= 1:
+            raise ValueError('The prefetch budget must be in (0, 1]')
+        self._core = core
+        self._depth = depth
+        self._size = size
+        self._budget = budget
+        self._queue = collections.deque()
+        self._queued = set()
+        self._latest = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def request(self, datapath, start, size, w):
+        '''
+        Queue the neighbors of a tile just requested
+
+        :param start: the x, y, z of the tile at zoom level w
+        :param size: the width and height of the tile
+        '''
+        [x, y, z] = start
+        [width, height] = size
+        tiles = []
+        for k in range(1, self._depth + 1):
+            tiles += [(x, y, z + k, width, height, w),
+                      (x, y, z - k, width, height, w)]
+        tiles.append((x // 2, y // 2, z, width, height, w + 1))
+        if w > 0:
+            tiles.append((2 * x, 2 * y, z, 2 * width, 2 * height, w - 1))
+
+        with self._cond:
+            self._latest[datapath] = z
+            # Load the nearest tiles first
+            for tile in reversed(tiles):
+                task = (datapath,) + tile
+                if task in self._queued or tile[2] < 0:
+                    continue
+                self._queue.appendleft(task)
+                self._queued.add(task)
+            while len(self._queue) > self._size:
+                self._queued.discard(self._queue.pop())
+            self._cond.notify()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _next(self):
+        '''
+        Wait for a tile to load while the server is idle
+        '''
+        with self._cond:
+            while not self._queue or not self._core._live.idle():
+                self._cond.wait(self.WAIT)
+            task = self._queue.popleft()
+            self._queued.discard(task)
+            # Drop tiles far from the newest request
+            distance = abs(task[3] - self._latest[task[0]])
+            return task if distance <= self._depth else None
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                continue
+            datapath, x, y, z, width, height, w = task
+            datasource = self._core._datasources.get(datapath)
+            if datasource is None:
+                continue
+            scale = 2 ** w
+            bounds = [x * scale, (x + width) * scale,
+                      y * scale, (y + height) * scale, z, w]
+            # Give way to any request that started since the task left
+            # the queue, and try the task again once idle
+            with self._cond:
+                if not self._core._live.idle():
+                    if task not in self._queued:
+                        self._queue.appendleft(task)
+                        self._queued.add(task)
+                    continue
+            start = time.time()
+            try:
+                datasource.load_cutout(*bounds)
+            except Exception:
+                logger.report_event(
+                    "Can't prefetch %s at %s" % (datapath, bounds),
+                    log_level=logging.DEBUG)
+            # Rest in proportion to the load to keep to the budget
+            spent = time.time() - start
+            time.sleep(spent * (1 - self._budget) / self._budget)
@@ -0,0 +1,164 @@
+'''Profile the running server without restarting it'''
+
+import os
+import re
+import sys
+import pstats
+import cProfile
+import StringIO
+import threading
+
+'''Seconds between samples of every thread'''
+INTERVAL = 0.005
+
+'''Most functions to list in cProfile output'''
+LIMIT = 50
+
+'''The profiler running cProfile, if any'''
+_running = None
+
+
+def profiled(function, *args):
+    '''
+    Call a function in a pool thread, under cProfile while it runs
+    '''
+    profiler = _running
+    if profiler is None:
+        return function(*args)
+    return profiler._runcall(function, *args)
+
+
+class Profiler(object):
+    '''Sample the stacks of all threads or run cProfile for a window
+
+    In "sample" mode, a thread records the stack of every other thread
+    each interval and stop returns the stacks in the collapsed format
+    of flamegraph.pl, one "thread;outer;...;inner count" per line.
+
+    In "cprofile" mode, cProfile runs in the thread that calls start.
+    Started from a request handler, that is the tornado IOLoop thread
+    running all handlers. Work passed to profiled in other threads, like
+    the encoder pool, runs under one cProfile for each thread, and stop
+    returns the pstats table of all of them merged.
+
+    Each process has its own profiler, so only profile a server with
+    one worker.
+    '''
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mode = None
+        self._done = None
+        self._thread = None
+        self._stacks = {}
+        self._profile = None
+        self._ident = None
+        self._local = None
+        self._profiles = []
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def start(self, mode='sample', interval=INTERVAL):
+        '''
+        Start profiling unless already running
+        '''
+        global _running
+        if mode not in self.MODES:
+            raise ValueError('Unknown profile mode: %s' % mode)
+        with self._lock:
+            if self._mode:
+                raise ValueError('Already profiling with %s' % self._mode)
+            self._mode = mode
+            if mode == 'cprofile':
+                self._ident = threading.current_thread().ident
+                self._local = threading.local()
+                self._profiles = []
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+                _running = self
+                return
+            self._stacks = {}
+            self._done = threading.Event()
+            self._thread = threading.Thread(target=self._sample,
+                                            args=(interval,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, focus=None, limit=LIMIT):
+        '''
+        Stop profiling and get the results as text
+
+        :param focus: a regex that must match a function in each stack
+        :param limit: most functions to list from cProfile
+        '''
+        global _running
+        try:
+            pattern = re.compile(focus or '')
+        except re.error:
+            raise ValueError('Bad focus: %s' % focus)
+        with self._lock:
+            mode = self._mode
+            if mode is None:
+                raise ValueError('Not profiling')
+            self._mode = None
+            if mode == 'cprofile':
+                _running = None
+                self._profile.disable()
+                return self._pstats(focus, limit)
+            self._done.set()
+            self._thread.join()
+            return self._collapse(pattern)
+
+    def _runcall(self, function, *args):
+        '''
+        Call a function under the cProfile of the current thread
+        '''
+        # The thread that started cProfile is already profiled
+        if threading.current_thread().ident == self._ident:
+            return function(*args)
+        local = self._local
+        if not hasattr(local, 'profile'):
+            local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(local.profile)
+        return local.profile.runcall(function, *args)
+
+    def _sample(self, interval):
+        me = threading.current_thread().ident
+        while not self._done.wait(interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack = ';'.join(reversed(stack))
+                self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+    def _collapse(self, pattern):
+        lines = []
+        for stack, count in sorted(self._stacks.items()):
+            if not pattern.search(stack):
+                continue
+            lines.append('%s %d' % (stack, count))
+        return '\n'.join(lines) + '\n'
+
+    def _pstats(self, focus, limit):
+        output = StringIO.StringIO()
+        stats = pstats.Stats(self._profile, stream=output)
+        for profile in self._profiles:
+            stats.add(profile)
+        restrictions = [focus] if focus else []
+        stats.sort_stats('cumulative').print_stats(*restrictions + [limit])
+        self._profile = None
+        self._profiles = []
+        return output.getvalue()
@@ -0,0 +1,82 @@
+'''Reduce the planes of a cutout over z as they load'''
+
+import numpy as np
+
+'''The ways to reduce planes over z'''
+REDUCTIONS = ('max', 'min', 'mean', 'sum', 'any')
+
+
+def _wide(dtype):
+    '''
+    Get the dtype to add many planes of a dtype without overflow
+    '''
+    if dtype.kind in 'ub':
+        return np.dtype(np.uint64)
+    if dtype.kind == 'i':
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+class Projection(object):
+    '''Keep one plane that reduces all planes added to it
+
+    "max", "min" and "mean" keep the dtype of the planes. "sum" adds
+    in 64 bits and gives 32 bits, clipped to fit, except that uint8
+    images stay uint8 and saturate at 255 so they encode as images.
+    "any" is 255 where any plane is nonzero and 0 elsewhere, as uint8.
+    '''
+
+    def __init__(self, how):
+        if how not in REDUCTIONS:
+            raise ValueError('Unknown reduction: %s' % how)
+        self.how = how
+        self._plane = None
+        self._dtype = None
+        self._count = 0
+
+    def add(self, plane):
+        '''
+        Reduce one more plane into the result
+        '''
+        self._count += 1
+        if self._plane is None:
+            self._dtype = plane.dtype
+            if self.how == 'any':
+                self._plane = plane != 0
+            elif self.how in ('sum', 'mean'):
+                self._plane = plane.astype(_wide(plane.dtype))
+            else:
+                self._plane = plane.copy()
+        elif self.how == 'max':
+            np.maximum(self._plane, plane, out=self._plane)
+        elif self.how == 'min':
+            np.minimum(self._plane, plane, out=self._plane)
+        elif self.how == 'any':
+            np.logical_or(self._plane, plane, out=self._plane)
+        else:
+            np.add(self._plane, plane, out=self._plane, casting='unsafe')
+
+    def result(self):
+        '''
+        Get the reduction of all planes added so far
+        '''
+        plane = self._plane
+        if plane is None or self.how in ('max', 'min'):
+            return plane
+        if self.how == 'any':
+            return plane.astype(np.uint8) * 255
+        if self.how == 'mean':
+            mean = plane / float(self._count)
+            if self._dtype.kind in 'uib':
+                mean = np.round(mean)
+            return mean.astype(self._dtype)
+        # Keep images in the dtype their views and formats are chosen by
+        if self._dtype == np.uint8:
+            return np.minimum(plane, 255).astype(np.uint8)
+        # Give 32 bits to encode like other labels
+        if self._dtype.kind in 'ub':
+            return np.minimum(plane, np.iinfo(np.uint32).max).astype(np.uint32)
+        if self._dtype.kind == 'i':
+            info = np.iinfo(np.int32)
+            return np.clip(plane, info.min, info.max).astype(np.int32)
+        return plane.astype(np.float32)
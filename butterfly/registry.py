@@ -0,0 +1,131 @@
+'''Choose the datasource for each datapath'''
+
+import os
+import logging
+import threading
+import importlib
+from rh_logger import logger
+import settings
+
+'''The module and class of each datasource by name'''
+DATASOURCES = {
+    'mojo': ('.mojo', 'Mojo'),
+    'regularimagestack': ('.regularimagestack', 'RegularImageStack'),
+    'tilespecs': ('.tilespecs', 'Tilespecs'),
+    'tilespec': ('.tilespecs', 'Tilespecs'),
+    'multibeam': ('.multibeam', 'MultiBeam'),
+    'comprimato': ('.multibeam', 'MultiBeam'),
+    'hdf5': ('.hdf5', 'HDF5DataSource'),
+    'tiff': ('.tiff', 'TiffDataSource'),
+    'chunks': ('.chunks', 'ChunkDataSource'),
+}
+
+_package = __name__.rpartition('.')[0]
+_classes = {}
+_classes_lock = threading.Lock()
+
+
+def register(name, module, classname):
+    '''
+    Allow settings.DATASOURCES to name another datasource
+
+    :param module: the full name of a module, or a name starting with a
+        dot for a module within butterfly
+    :param classname: the name of the DataSource subclass in the module
+    '''
+    with _classes_lock:
+        DATASOURCES[name] = (module, classname)
+        _classes.pop(name, None)
+
+
+def get_class(name):
+    '''
+    Import the DataSource subclass for a name only once
+
+    :returns: the class or None if it can't be imported
+    '''
+    # Other threads wait for the import rather than skip the name
+    with _classes_lock:
+        if name not in _classes:
+            _classes[name] = _import(name)
+        return _classes[name]
+
+
+def _import(name):
+    if name not in DATASOURCES:
+        logger.report_event("Unknown datasource: " + name,
+                            log_level=logging.WARNING)
+        return None
+    module, classname = DATASOURCES[name]
+    try:
+        if not _package:
+            module = module.lstrip('.')
+        module = importlib.import_module(module, _package)
+        return getattr(module, classname)
+    except ImportError, err:
+        logger.report_event("%s needed by %s" % (err, name),
+                            log_level=logging.WARNING)
+    return None
+
+
+# Add the datasources named in settings
+for _name, _path in settings.DATASOURCE_CLASSES.items():
+    register(_name, *_path.rsplit('.', 1))
+
+
+class Registry(object):
+    '''Rank datasources by their probes of each datapath
+
+    Each datasource with a nonzero probe of a datapath is a candidate.
+    Candidates are ranked by their probe, then in the given order. The
+    first datasource to load any datapath is first to try for all other
+    datapaths in the same folder and its subfolders.
+    '''
+
+    def __init__(self):
+        self._decisions = {}
+        self._lock = threading.Lock()
+
+    def rank(self, datapath, names=None):
+        '''
+        List all datasources that may load a datapath, best first
+
+        :param names: the names to rank (default all in settings)
+        '''
+        if names is None:
+            names = settings.DATASOURCES
+        scores = []
+        for order, name in enumerate(names):
+            datasource = get_class(name)
+            if datasource is None:
+                continue
+            score = datasource.probe(datapath)
+            if score > 0:
+                scores.append((-score, order, name))
+        ranked = [name for _, _, name in sorted(scores)]
+
+        decision = self.recall(datapath)
+        if decision in ranked:
+            ranked.remove(decision)
+            ranked.insert(0, decision)
+        return ranked
+
+    def recall(self, datapath):
+        '''
+        Get the datasource used last in the nearest parent folder
+        '''
+        prefix = os.path.dirname(datapath)
+        with self._lock:
+            while prefix not in self._decisions:
+                parent = os.path.dirname(prefix)
+                if parent == prefix:
+                    return None
+                prefix = parent
+            return self._decisions[prefix]
+
+    def remember(self, datapath, name):
+        '''
+        Try the datasource first for datapaths in the same folder
+        '''
+        with self._lock:
+            self._decisions[os.path.dirname(datapath)] = name
@@ -1,5 +1,7 @@
+import logging
 import argparse
 from datasource import DataSource
+from eventlog import log
 import os
 import re
 import glob
@@ -17,12 +19,24 @@ def parseNumRange(num_arg):
     if not match:
         raise argparse.ArgumentTypeError(
             "'" + num_arg + "' must be a number or range (ex. '5' or '0-10').")
-    start = match.group(1)
-    end = match.group(2) or match.group(1)
+    start = int(match.group(1))
+    end = int(match.group(2) or match.group(1))
     step = 1
     if end < start:
         step = -1
-    return list(range(int(start), int(end) + step, step))
+    return list(range(start, end + step, step))
+
+
+# Parser for the paths and indices given in the args file
+d_inf = argparse.ArgumentParser(add_help=False)
+# EM stack filenames in sprintf format
+d_inf.add_argument('--filename', required=True)
+# Folder names for each vertical slice in sprintf format
+d_inf.add_argument('--folderpaths', required=True)
+# Row, column, and slice indices of the filenames
+d_inf.add_argument('--x_ind', nargs='+', type=parseNumRange, required=True)
+d_inf.add_argument('--y_ind', nargs='+', type=parseNumRange, required=True)
+d_inf.add_argument('--z_ind', nargs='+', type=parseNumRange, required=True)
 
 
 class RegularImageStack(DataSource):
@@ -34,6 +48,14 @@ class RegularImageStack(DataSource):
 
         super(RegularImageStack, self).__init__(core, datapath)
 
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+        '''
+        args_file = os.path.join(datapath, '*.args')
+        return int(os.path.isdir(datapath) and bool(glob.glob(args_file)))
+
     def index(self):
         '''
         @override
@@ -46,7 +68,7 @@ class RegularImageStack(DataSource):
             args_list = [
                 arg for line in f for arg in convert_arg_line_to_args(line)]
 
-        args = d_inf.parse_args(args_list)
+        args = d_inf.parse_known_args(args_list)[0]
         filename = args.filename
         folderpaths = args.folderpaths
         # blocksize = args.blocksize
@@ -66,6 +88,13 @@ class RegularImageStack(DataSource):
 
         super(RegularImageStack, self).index()
 
+    def get_sources(self):
+        '''
+        @override
+        '''
+        args_file = os.path.join(self._datapath, '*.args')
+        return [self._datapath] + glob.glob(args_file)
+
     def load_info(self, folderpaths, filename, indices):
         self._folderpaths = folderpaths
         self._filename = filename
@@ -84,8 +113,7 @@ class RegularImageStack(DataSource):
             'x': self._indices[0][x],
             'y': self._indices[1][y],
             'z': self._indices[2][z]}
-        print '\n'
-        print cur_filename
+        log.event('tile', logging.DEBUG, 'Stack loading %s', cur_filename)
         cur_path = os.path.join(
             self._datapath,
             self._folderpaths % {
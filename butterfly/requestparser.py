@@ -1,7 +1,8 @@
 import urlparse
 import os
 import re
-from rh_logger import logger
+import logging
+from eventlog import log
 import urllib
 import settings
 
@@ -40,8 +41,9 @@ class RequestParser(object):
 
             try:
                 # Debug output in console for OCP request
-                logger.report_event('OCP request: ' + str(request[ind:]))
-                logger.report_event('Datapath: ' + datapath)
+                log.event('request', logging.DEBUG, 'OCP request: %s',
+                          request[ind:])
+                log.event('request', logging.DEBUG, 'Datapath: %s', datapath)
 
                 w = int(float(request[ind + 2]))
                 x_range = [int(i) - 1 for i in request[ind + 3].split(',')]
@@ -70,7 +72,8 @@ class RequestParser(object):
             parsed_query = urlparse.parse_qs(query)
 
             # Console output for parsed query
-            logger.report_event('Parsed query: ' + repr(parsed_query))
+            log.event('request', logging.DEBUG, 'Parsed query: %r',
+                      parsed_query)
 
             # Parse essential parameters
             datapath = parsed_query['datapath'][0]
@@ -1,14 +1,17 @@
 from tornado.web import RequestHandler
 from urllib2 import HTTPError
-import tifffile
+import tornado.gen
 import numpy as np
-import StringIO
-import zlib
+import struct
 import json
-import cv2
+import time
+import logging
 
 import rh_logger
 import settings
+from eventlog import log
+from encoder import MASK_FORMATS
+from projection import REDUCTIONS
 
 
 class RestAPIHandler(RequestHandler):
@@ -23,12 +26,24 @@ class RestAPIHandler(RequestHandler):
     '''Encode image/mask in this image format (e.g. "tif")'''
     Q_FORMAT = "format"
     Q_VIEW = "view"
+    '''Encode images with the options of this profile (e.g. "small")'''
+    Q_PROFILE = "profile"
     Q_X = "x"
     Q_Y = "y"
     Q_Z = "z"
     Q_WIDTH = "width"
     Q_HEIGHT = "height"
     Q_RESOLUTION = "resolution"
+    '''Reduce this many planes from z with the reduce param'''
+    Q_DEPTH = "depth"
+    '''Reduce planes over z as one of max, min, mean, sum or any'''
+    Q_REDUCE = "reduce"
+    '''List tiles as x,y,z,resolution;x,y,z,resolution;...'''
+    Q_TILES = "tiles"
+    '''Read bulk exports through the caches with "bypass"'''
+    Q_CACHE = "cache"
+    '''List label ids to mask as id,id,...'''
+    Q_ID = "id"
     #
     # Hierarchy of data organization in config file
     #
@@ -58,10 +73,12 @@ class RestAPIHandler(RequestHandler):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
+    @tornado.gen.coroutine
     def get(self, command):
         '''Handle an HTTP GET request'''
 
-        rh_logger.logger.report_event("GET " + self.request.uri)
+        log.event('request', logging.DEBUG, "GET %s", self.request.uri)
+        self._command = command
         try:
             if command == "experiments":
                 result = self.get_experiments()
@@ -73,11 +90,18 @@ class RestAPIHandler(RequestHandler):
                 result = self.get_channels()
             elif command == "channel_metadata":
                 result = self.get_channel_metadata()
+            elif command == "stats":
+                result = self.get_stats()
+            elif command == "label":
+                result = self.get_label()
             elif command == "data":
-                self.get_data()
+                yield self.get_data()
+                return
+            elif command == "batch":
+                yield self.get_batch()
                 return
             elif command == "mask":
-                self.get_mask()
+                yield self.get_mask()
                 return
             else:
                 raise HTTPError(self.request.uri, 400,
@@ -91,6 +115,13 @@ class RestAPIHandler(RequestHandler):
             self.set_header('Content-Type', "text/plain")
             self.write(http_error.msg)
 
+    def on_finish(self):
+        '''Time the whole request for each command'''
+        command = getattr(self, '_command', None)
+        if command:
+            self.core._stats.observe('request', self.request.request_time(),
+                                     command=command)
+
     def _get_config(self,kind):
         '''Get the config dictionary for a named kind'''
         target = self._get_necessary_param(kind['param'])
@@ -154,6 +185,18 @@ class RestAPIHandler(RequestHandler):
             'name': 'channel'
         })
 
+    def get_stats(self):
+        '''Handle the /api/stats GET request'''
+        stats = self.core._stats.to_json()
+        stats['cache'] = {
+            'size': self.core._cache.size,
+            'max_size': self.core._cache.max_size,
+            'tiles': len(self.core._cache),
+            'hits': self.core._cache.hits,
+            'misses': self.core._cache.misses
+        }
+        return stats
+
     def get_channel_metadata(self):
         '''Handle the /api/channel_metadata GET request'''
         channel = self._get_channel_config().copy()
@@ -201,8 +244,7 @@ class RestAPIHandler(RequestHandler):
         result = self.get_query_argument(qparam, 0)
         return self._try_typecast_int(qparam, result)
 
-    def get_data(self):
-        channel = self._get_channel_config()
+    def _get_format_and_view(self, channel):
         dtype = channel[self.DATA_TYPE]
 
         defaultFormat = settings.DEFAULT_OUTPUT
@@ -210,40 +252,211 @@ class RestAPIHandler(RequestHandler):
         views = settings.SUPPORTED_IMAGE_VIEWS
         formats = settings.SUPPORTED_IMAGE_FORMATS
 
+        # Choose from the Accept header for images without a format
+        if 'uint8' in dtype and self.get_query_argument(self.Q_FORMAT, None) is None:
+            defaultFormat = self._negotiate_format(defaultFormat)
+
         fmt = self._get_list_query_argument(self.Q_FORMAT, defaultFormat, formats)
         if 'float' not in dtype and 'uint8' not in dtype:
             if fmt in ['png']:
                 defaultView = 'colormap'
 
+        view = self._get_list_query_argument(self.Q_VIEW, defaultView, views)
+        return fmt, view
+
+    def _negotiate_format(self, default):
+        '''Get the first negotiated format named in the Accept header'''
+        accepted = {}
+        for accept in self.request.headers.get('Accept', '').split(','):
+            params = accept.strip().split(';')
+            quality = 1.0
+            for param in params[1:]:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try: quality = float(value)
+                    except ValueError: quality = 0.0
+            accepted[params[0].strip().lower()] = quality
+        self.set_header('Vary', 'Accept')
+        for fmt in settings.NEGOTIATED_FORMATS:
+            if fmt not in settings.SUPPORTED_IMAGE_FORMATS:
+                continue
+            # Only choose formats named exactly, not by a wildcard
+            if accepted.get('image/' + fmt, 0) > 0:
+                return fmt
+        return default
+
+    def _get_tiles_param(self):
+        tiles = []
+        for tile in self._get_necessary_param(self.Q_TILES).split(';'):
+            tile = [self._try_typecast_int(self.Q_TILES, t) for t in tile.split(',')]
+            self._match_condition(tile, {
+                'condition': len(tile) != 4,
+                'msg': "Each of the %s must be x,y,z,resolution" % self.Q_TILES
+            })
+            tiles.append(tile)
+        return self._match_condition(tiles, {
+            'condition': len(tiles) > settings.MAX_BATCH_TILES,
+            'msg': "Request at most %d %s" % (settings.MAX_BATCH_TILES, self.Q_TILES)
+        })
+
+    def _get_profile(self, channel):
+        '''Get the encoder profile from the query or the channel'''
+        encoder = self.core._encoder
+        default = channel.get('profile', encoder.default)
+        profiles = encoder.profiles.keys()
+        return self._get_list_query_argument(self.Q_PROFILE, default, profiles)
+
+    def _get_ids_param(self):
+        '''Get the label ids to mask'''
+        ids = self._get_necessary_param(self.Q_ID).split(',')
+        return [self._try_typecast_int(self.Q_ID, i) for i in ids]
+
+    def _get_reduce_and_depth(self):
+        '''Get the reduction and the number of planes to reduce'''
+        depth = self._try_typecast_int(self.Q_DEPTH,
+                                       self.get_query_argument(self.Q_DEPTH, 1))
+        reduce = None
+        if self.get_query_argument(self.Q_REDUCE, None) is not None:
+            reduce = self._get_list_query_argument(self.Q_REDUCE, None,
+                                                   REDUCTIONS)
+        self._match_condition(depth, {
+            'condition': depth < 1,
+            'msg': "The %s must be at least 1" % self.Q_DEPTH
+        })
+        self._match_condition(depth, {
+            'condition': depth > 1 and reduce is None,
+            'msg': "A %s over 1 needs a %s" % (self.Q_DEPTH, self.Q_REDUCE)
+        })
+        return reduce, depth
+
+    def _get_bypass_cache(self):
+        '''Check if the query asks not to add tiles to the caches'''
+        cache = self._get_list_query_argument(self.Q_CACHE, 'keep',
+                                              ['keep', 'bypass'])
+        return cache == 'bypass'
+
+    def _encode(self, vol, fmt, profile=None):
+        return self.core._encoder.encode(vol, fmt, profile)
+
+    @tornado.gen.coroutine
+    def get_data(self):
+        start = time.time()
+        channel = self._get_channel_config()
+        dtype = channel[self.DATA_TYPE]
+        fmt, view = self._get_format_and_view(channel)
+        profile = self._get_profile(channel)
+
         x = self._get_int_necessary_param(self.Q_X)
         y = self._get_int_necessary_param(self.Q_Y)
         z = self._get_int_necessary_param(self.Q_Z)
         width = self._get_int_necessary_param(self.Q_WIDTH)
         height = self._get_int_necessary_param(self.Q_HEIGHT)
         resolution = self._get_int_query_argument(self.Q_RESOLUTION)
-        view = self._get_list_query_argument(self.Q_VIEW, defaultView, views)
-
-        slice_define = [channel[self.PATH], [x, y, z], [width, height, 1]]
-        rh_logger.logger.report_event("Encoding image as dtype %s" % repr(dtype))
-        vol = self.core.get(*slice_define, w=resolution, view=view)
+        reduce, depth = self._get_reduce_and_depth()
+        bypass_cache = self._get_bypass_cache()
+
+        slice_define = [channel[self.PATH], [x, y, z], [width, height, depth]]
+        parsed = time.time() - start
+        log.event('request', logging.DEBUG, "Encoding image as dtype %r", dtype)
+        vol = self.core.get(*slice_define, w=resolution, view=view,
+                            bypass_cache=bypass_cache, reduce=reduce)
+
+        stats = self.core._stats
+        labels = self.core.get_labels(channel[self.PATH], resolution)
+        stats.observe('parse', parsed, **labels)
+        with stats.timer('encode', **labels):
+            content = yield self.core._encoder.submit(vol, fmt, profile)
         self.set_header("Content-Type", "image/"+fmt)
-        if fmt in ['zip']:
-            output = StringIO.StringIO()
-            volstring = vol[:,:,0].T.astype(np.uint32).tostring('F')
-            output.write(zlib.compress(volstring))
-            content = output.getvalue()
-        elif fmt in ['tif','tiff']:
-            output = StringIO.StringIO()
-            tiffvol = vol[:,:,0].astype(np.uint32)
-            tifffile.imsave(output, tiffvol)
-            content = output.getvalue()
-        else:
-            if vol.dtype.itemsize == 4:
-                vol = vol.view(np.uint8).reshape(vol.shape[0], vol.shape[1], 4)
-            content = cv2.imencode(  "." + fmt, vol)[1].tostring()
+        with stats.timer('write', **labels):
+            self.write(content)
+        # Bulk exports have no viewer to prefetch for
+        if not bypass_cache:
+            self.core.prefetch(channel[self.PATH], [x, y, z], [width, height], resolution)
+
+    @tornado.gen.coroutine
+    def get_batch(self):
+        '''Handle the /api/batch GET request
+
+        Each of the tiles is x,y,z,resolution like /api/data and all
+        tiles have the same width and height. The response has each
+        encoded tile in order after its length as a big-endian uint32.
+        '''
+        channel = self._get_channel_config()
+        fmt, view = self._get_format_and_view(channel)
+        profile = self._get_profile(channel)
 
-        self.write(content)
+        tiles = self._get_tiles_param()
+        width = self._get_int_necessary_param(self.Q_WIDTH)
+        height = self._get_int_necessary_param(self.Q_HEIGHT)
+        bypass_cache = self._get_bypass_cache()
+
+        vols = self.core.get_batch(channel[self.PATH], tiles,
+                                   [width, height], view=view,
+                                   bypass_cache=bypass_cache)
+        self.set_header("Content-Type", "application/octet-stream")
+        self.set_header("X-Tile-Type", "image/"+fmt)
+        # Encode all tiles at once on the encoder threads
+        labels = self.core.get_labels(channel[self.PATH], 'batch')
+        with self.core._stats.timer('encode', **labels):
+            contents = yield [self.core._encoder.submit(vol, fmt, profile)
+                              for vol in vols]
+        for content in contents:
+            self.write(struct.pack('>I', len(content)))
+            self.write(content)
+
+    def get_label(self):
+        '''Handle the /api/label GET request
+
+        Get the bounds, voxel count and tiles of one label id from the
+        label index of the channel.
+        '''
+        channel = self._get_channel_config()
+        label_id = self._get_int_necessary_param(self.Q_ID)
+        label_index = self.core.get_label_index(channel[self.PATH])
+        if label_index is None:
+            raise HTTPError(self.request.uri, 404,
+                            "No label index for " + channel[self.NAME],
+                            [], None)
+        result = label_index.describe(label_id)
+        if result is None:
+            raise HTTPError(self.request.uri, 404,
+                            "No label %d" % label_id, [], None)
+        return result
 
+    @tornado.gen.coroutine
     def get_mask(self):
-        # TODO: implement this
-        raise HTTPError(self.request.uri, 501, "The server does not yet support /api/mask requests", [], None)
+        '''Handle the /api/mask GET request
+
+        The mask of a cutout like /api/data is true wherever the
+        segmentation has any of the ids. With a label index, only the
+        tiles holding the ids are read. The format is "png" for a
+        1-bit png, "rle" for json of the run lengths, or "bits" for
+        the packed bits with the width and height in headers.
+        '''
+        channel = self._get_channel_config()
+        formats = sorted(MASK_FORMATS.keys())
+        fmt = self._get_list_query_argument(self.Q_FORMAT, 'png', formats)
+        ids = self._get_ids_param()
+
+        x = self._get_int_necessary_param(self.Q_X)
+        y = self._get_int_necessary_param(self.Q_Y)
+        z = self._get_int_necessary_param(self.Q_Z)
+        width = self._get_int_necessary_param(self.Q_WIDTH)
+        height = self._get_int_necessary_param(self.Q_HEIGHT)
+        resolution = self._get_int_query_argument(self.Q_RESOLUTION)
+        bypass_cache = self._get_bypass_cache()
+
+        stats = self.core._stats
+        labels = self.core.get_labels(channel[self.PATH], resolution)
+        with stats.timer('mask', **labels):
+            mask = self.core.get_mask(channel[self.PATH], [x, y, z],
+                                      [width, height], ids, w=resolution,
+                                      bypass_cache=bypass_cache)
+        with stats.timer('encode', **labels):
+            content = yield self.core._encoder.submit_mask(mask, fmt)
+        self.set_header("Content-Type", MASK_FORMATS[fmt])
+        if fmt == 'bits':
+            self.set_header("X-Mask-Width", str(mask.shape[1]))
+            self.set_header("X-Mask-Height", str(mask.shape[0]))
+        with stats.timer('write', **labels):
+            self.write(content)
@@ -8,13 +8,59 @@ bfly_config = rh_config.config.get("bfly", {})
 '''HTTP port for server'''
 PORT = int(bfly_config.get("port", 2001))
 
+'''Number of server processes, or 0 for one per cpu'''
+WORKERS = int(bfly_config.get("workers", 1))
+
 '''Maximum size of the cache: 1G by default'''
 MAX_CACHE_SIZE = int(bfly_config.get("max-cache-size", 1024)) * 1024 * 1024
 
+'''Keep label tiles compressed in the cache of each process'''
+CACHE_COMPRESSION = bool(bfly_config.get("cache-compression", False))
+'''Policy to choose the tiles to keep: lru, slru or tinylfu'''
+CACHE_POLICY = bfly_config.get("cache-policy", "lru")
+
+'''Local folder to keep tiles read from other folders (off if empty)'''
+DISK_CACHE_PATH = bfly_config.get("disk-cache-path", "")
+'''Maximum size of the local disk cache: 10G by default'''
+DISK_CACHE_SIZE = int(bfly_config.get("disk-cache-size", 10240)) * 1024 * 1024
+
 '''Queries that will enable flags'''
 ASSENT_LIST = bfly_config.get("assent-list", ('yes', 'y', 'true'))
 
+'''Time each stage of each request for /api/stats'''
+STATS = bool(bfly_config.get("stats", True))
+'''Also serve the stats as Prometheus text at /metrics'''
+STATS_PROMETHEUS = bool(bfly_config.get("stats-prometheus", False))
+
+'''Serve /profile/ to profile the running server'''
+PROFILER = bool(bfly_config.get("profiler", False))
+
+'''Least level of events to log for all or each category'''
+LOG_LEVEL = bfly_config.get("log-level", "INFO")
+LOG_LEVELS = bfly_config.get("log-levels", {})
+'''Fraction of events to log for each category'''
+LOG_SAMPLES = bfly_config.get("log-sample", {})
+'''Most events to queue before dropping the oldest'''
+LOG_QUEUE_SIZE = int(bfly_config.get("log-queue-size", 10000))
+
+'''Threads to encode tiles, or 0 to encode in the request thread'''
+ENCODER_THREADS = int(bfly_config.get("encoder-threads", 4))
+'''Profile of image options used unless a channel or request names one'''
+ENCODER_PROFILE = bfly_config.get("encoder-profile", "default")
+'''More profiles of options for each image format'''
+ENCODER_PROFILES = bfly_config.get("encoder-profiles", {})
+
+'''Slices above and below each requested tile to load when idle (0 for off)'''
+PREFETCH_DEPTH = int(bfly_config.get("prefetch-depth", 0))
+PREFETCH_QUEUE_SIZE = int(bfly_config.get("prefetch-queue-size", 64))
+'''Most share of the time the prefetcher may spend loading tiles'''
+PREFETCH_BUDGET = float(bfly_config.get("prefetch-budget", 0.5))
+
 ALWAYS_SUBSAMPLE = bool(bfly_config.get("always-subsample", True))
+
+'''Decode JPEG tiles at 1/2, 1/4 or 1/8 scale for zoom levels'''
+REDUCED_DECODE = bool(bfly_config.get("reduced-decode", True))
+
 _image_resize_method = bfly_config.get("image-resize-method", "linear")
 
 '''Interpolation method to use upon resizing'''
@@ -28,20 +74,58 @@ IMAGE_RESIZE_METHOD = \
 DEFAULT_OUTPUT = 'png'
 DEFAULT_VIEW = 'grayscale'
 # Using cv2 - please check if supported before adding!
-SUPPORTED_IMAGE_FORMATS = ('png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'zip')
+SUPPORTED_IMAGE_FORMATS = ('png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'zip',
+                           'label')
+# Only offer formats cv2 was built to write
+_have_writer = getattr(cv2, 'haveImageWriter', None)
+if _have_writer is None or _have_writer('.webp'):
+    SUPPORTED_IMAGE_FORMATS += ('webp',)
+if _have_writer is not None:
+    SUPPORTED_IMAGE_FORMATS += tuple(f for f in ('avif', 'jxl')
+                                     if _have_writer('.' + f))
+'''Formats to send uint8 images in if accepted and no format is given
+
+Off by default, as browsers accept webp for every image and the webp
+of the encoder profiles is lossy.'''
+NEGOTIATED_FORMATS = bfly_config.get("negotiated-formats", [])
 SUPPORTED_IMAGE_VIEWS = ('grayscale','colormap','rgb')
 
+'''Most tiles to send in one /api/batch request'''
+MAX_BATCH_TILES = int(bfly_config.get("max-batch-tiles", 256))
+
 '''List of datasources to try, in order, given a path'''
 DATASOURCES = bfly_config.get(
     "datasource",
-    ["hdf5", "tilespecs", "multibeam", "mojo", "regularimagestack"])
+    ["chunks", "hdf5", "tiff", "tilespecs", "multibeam", "mojo", "regularimagestack"])
+
+'''More datasources to name in DATASOURCES, each as "module.Class"'''
+DATASOURCE_CLASSES = dict(bfly_config.get("datasource-classes", {}))
 
 '''Paths must start with one of the following allowed paths'''
 ALLOWED_PATHS = bfly_config.get("allowed-paths", [os.sep])
 
+'''Folder to save snapshots of each datasource index (off if empty)'''
+INDEX_CACHE_PATH = bfly_config.get("index-cache-path", "")
+
+'''Folder of label indexes written by bfly_index (off if empty)'''
+LABEL_INDEX_PATH = bfly_config.get("label-index-path", "")
+
+'''Index all configured experiments before starting the server'''
+WARM_START = bool(bfly_config.get("warm-start", False))
+WARM_START_THREADS = int(bfly_config.get("warm-start-threads", 4))
+
+'''Number of threads used to find datasources for bfly -e folder'''
+DISCOVERY_THREADS = int(bfly_config.get("discovery-threads", 8))
+
 if bfly_config.get("suppress-tornado-logging", True):
     import logging
     logging.getLogger("tornado.access").setLevel(logging.ERROR)
 
-all = [PORT, MAX_CACHE_SIZE, ALWAYS_SUBSAMPLE, IMAGE_RESIZE_METHOD,
-       DEFAULT_OUTPUT, DATASOURCES, ALLOWED_PATHS]
+all = [PORT, WORKERS, MAX_CACHE_SIZE, CACHE_COMPRESSION, CACHE_POLICY,
+       DISK_CACHE_PATH, DISK_CACHE_SIZE, STATS, STATS_PROMETHEUS, PROFILER,
+       LOG_LEVEL, LOG_LEVELS, LOG_SAMPLES, LOG_QUEUE_SIZE,
+       ENCODER_THREADS, ENCODER_PROFILE, ENCODER_PROFILES,
+       PREFETCH_DEPTH, PREFETCH_QUEUE_SIZE, PREFETCH_BUDGET,
+       ALWAYS_SUBSAMPLE, REDUCED_DECODE, IMAGE_RESIZE_METHOD,
+       DEFAULT_OUTPUT, NEGOTIATED_FORMATS, MAX_BATCH_TILES, DATASOURCES, DATASOURCE_CLASSES, ALLOWED_PATHS,
+       INDEX_CACHE_PATH, LABEL_INDEX_PATH, WARM_START, WARM_START_THREADS, DISCOVERY_THREADS]
@@ -74,6 +74,7 @@ DOJO.Input.prototype = {
     stack.hideLayer(0);
     stack.z ++;
     stack.zBuff = stack.updateBuff(stack.zBuff,'up');
+    stack.subscribe();
     this.findings[0].childNodes[0].innerHTML = stack.z;
   },
   down: function(stack){
@@ -81,6 +82,7 @@ DOJO.Input.prototype = {
     stack.hideLayer(0);
     stack.z --;
     stack.zBuff = stack.updateBuff(stack.zBuff,'down');
+    stack.subscribe();
     this.findings[0].childNodes[0].innerHTML = stack.z;
   }
 }
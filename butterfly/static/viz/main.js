@@ -27,6 +27,8 @@ window.onload = function(e){
   });
   SCOPE.openSD.world.addHandler('add-item', SCOPE.stack.refresher.bind(SCOPE.stack));
   SCOPE.openSD.addHandler('zoom',SCOPE.stack.zoomer.bind(SCOPE.stack));
+  SCOPE.openSD.addHandler('viewport-change',SCOPE.stack.subscribe.bind(SCOPE.stack));
+  SCOPE.openSD.addHandler('animation-finish',SCOPE.stack.subscribe.bind(SCOPE.stack,null));
   // Link everything to WebGL
   SCOPE.stack.init(SCOPE.openSD);
   SCOPE.link = new DOJO.Input(SCOPE);
@@ -16,7 +16,7 @@ DOJO.Source.prototype = {
     var maxLevel = source.width/source.tileSize;
     source.maxLevel = Math.floor(Math.log2(maxLevel));
     if (source.target){
-      source.datapath += '&format=zip';
+      source.datapath += '&format=label';
     }
     return {tileSource: source};
   },
@@ -28,6 +28,8 @@ DOJO.Stack.prototype = {
   w: null,
   vp: null,
   maxBuff: 3,
+  subWait: 100,
+  subscribed: 0,
   level: 0,
   z: 0,
   flip: {
@@ -76,8 +78,40 @@ DOJO.Stack.prototype = {
   init: function(osd){
     this.vp = osd.viewport;
     this.w = osd.world;
+    this.socket = osd.imageLoader.socket;
     return this;
   },
+  // Stream tiles in view for the current slice
+  subscribe: function(e){
+    var now = Date.now();
+    var often = now - this.subscribed < this.subWait;
+    if (!this.socket || (often && e && e.eventSource)){
+      return;
+    }
+    this.subscribed = now;
+    var vp = this.vp;
+    var parse = ZipJob.prototype.parse;
+    this.findLayer(0).map(function(image){
+      if (!image){
+        return;
+      }
+      var source = image.source;
+      var terms = parse(source.datapath.split('?')[1]);
+      var zoom = image.viewportToImageZoom(vp.getZoom(true));
+      var level = Math.floor(Math.log2(1/zoom));
+      var blevel = Math.max(0, Math.min(level, source.maxLevel));
+      var scale = Math.pow(2, blevel);
+      var rect = image.viewportToImageRectangle(vp.getBounds(true));
+      terms.z = source.z;
+      terms.resolution = blevel;
+      terms.tile = [source.tileSize, source.tileSize];
+      terms.bounds = [rect.x, rect.y, rect.x+rect.width, rect.y+rect.height];
+      terms.bounds = terms.bounds.map(function(b){
+        return Math.floor(b/scale);
+      });
+      this.socket.subscribe(terms);
+    },this);
+  },
   findIndex: function(zb){
     var found = []
     for (var layi in this.preset){
@@ -17,6 +17,15 @@ function ImageJob ( options ) {
 ImageJob.prototype = {
     errorMsg: null,
     start: function(){
+        if ( this.socket ) {
+            this.socket.take( this.src ).then( this.begin.bind( this ) );
+            return;
+        }
+        this.begin( null );
+    },
+
+    // Use the tile from the socket if given
+    begin: function( tile ){
         var _this = this;
 
         this.image = new Image();
@@ -38,6 +47,11 @@ ImageJob.prototype = {
             _this.finish( false );
         }, this.timeout);
 
+        if ( tile ) {
+            this.blob = URL.createObjectURL( new Blob( [tile] ) );
+            this.image.src = this.blob;
+            return;
+        }
         this.image.src = this.src;
     },
 
@@ -50,6 +64,9 @@ ImageJob.prototype = {
         if ( this.jobId ) {
             window.clearTimeout( this.jobId );
         }
+        if ( this.blob ) {
+            URL.revokeObjectURL( this.blob );
+        }
 
         this.callback( this );
     }
@@ -0,0 +1,106 @@
+// private class
+function TileSocket( where ) {
+
+    var secure = window.location.protocol == 'https:';
+    var host = where || window.location.host;
+    var url = (secure? 'wss://': 'ws://') + host + '/ws/tiles';
+
+    this.tiles = {};
+    this.order = [];
+    this.active = {};
+    this.waiting = {};
+    this.socket = new WebSocket(url);
+    this.socket.binaryType = 'arraybuffer';
+    this.socket.onmessage = this.receive.bind(this);
+}
+
+TileSocket.prototype = {
+    // Most unclaimed tiles to keep
+    maxTiles: 512,
+    // Milliseconds to wait for a tile before using http
+    timeout: 250,
+    keys: ['channel', 'x', 'y', 'z', 'resolution', 'width', 'height'],
+    layer: ['channel', 'z', 'resolution'],
+
+    ready: function() {
+        return this.socket.readyState == WebSocket.OPEN;
+    },
+
+    // Ask for all tiles in bounds, cancelling any for the last bounds
+    subscribe: function(terms) {
+        if (this.ready()) {
+            this.active[terms.channel] = terms;
+            this.socket.send(JSON.stringify(terms));
+        }
+    },
+
+    keyer: function(terms, keys) {
+        return (keys || this.keys).map(function(key) {
+            return terms[key];
+        }).join('-');
+    },
+
+    receive: function(e) {
+        if (typeof e.data == 'string') {
+            return;
+        }
+        var size = new DataView(e.data).getUint32(0);
+        var text = new Uint8Array(e.data, 4, size);
+        var head = JSON.parse(new TextDecoder().decode(text));
+        var tile = e.data.slice(4 + size);
+        var key = this.keyer(head);
+
+        if (key in this.waiting) {
+            this.waiting[key](tile);
+            delete this.waiting[key];
+            return;
+        }
+        this.tiles[key] = tile;
+        this.order.push(key);
+        while (this.order.length > this.maxTiles) {
+            delete this.tiles[this.order.shift()];
+        }
+    },
+
+    inView: function(terms) {
+        var active = this.active[terms.channel];
+        if (!active) {
+            return false;
+        }
+        var layer = this.keyer(terms, this.layer);
+        var [x0, y0, x1, y1] = active.bounds;
+        var [x, y] = [terms.x, terms.y].map(Number);
+        var inX = x + Number(terms.width) > x0 && x < x1;
+        var inY = y + Number(terms.height) > y0 && y < y1;
+        return layer == this.keyer(active, this.layer) && inX && inY;
+    },
+
+    // Get the tile for a url as a promise, or null after the timeout
+    take: function(src) {
+        var terms = ZipJob.prototype.parse(src);
+        var key = this.keyer(terms);
+        var waiting = this.waiting;
+        var tiles = this.tiles;
+        var timeout = this.timeout;
+        // Only wait for tiles in view of the last subscription
+        var ready = this.ready() && this.inView(terms);
+
+        return new Promise(function(done) {
+            if (key in tiles) {
+                var tile = tiles[key];
+                delete tiles[key];
+                return done(tile);
+            }
+            if (!ready) {
+                return done(null);
+            }
+            waiting[key] = done;
+            window.setTimeout(function() {
+                if (waiting[key] === done) {
+                    delete waiting[key];
+                    done(null);
+                }
+            }, timeout);
+        });
+    }
+}
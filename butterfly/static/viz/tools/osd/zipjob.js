@@ -45,12 +45,43 @@ ZipJob.prototype = {
 
     unzip: function(){
 
+        var unlabel = this.unlabel;
+        var label = this.src.indexOf('&format=label') >= 0;
         var unzip = function(blob){
             var compressed = new Zlib.Inflate(new Uint8Array(blob));
-            return compressed.decompress();
+            var raw = compressed.decompress();
+            return label? unlabel(raw): raw;
         }
 
-        return this.get(this.src).then(unzip);
+        var socket = this.socket;
+        var src = this.src;
+        var get = this.get.bind(this);
+        if (socket) {
+            var fetch = function(tile){
+                return tile || get(src);
+            };
+            return socket.take(src).then(fetch).then(unzip);
+        }
+        return get(src).then(unzip);
+    },
+
+    // Turn a palette and index image into bytes of uint32 ids
+    unlabel: function(raw) {
+        // Typed arrays must start at a multiple of their size
+        if (raw.byteOffset % 4) {
+            raw = raw.slice();
+        }
+        var head = new Uint32Array(raw.buffer, raw.byteOffset, 4);
+        var [width, height, count, bytes] = head;
+        var start = raw.byteOffset + 16;
+        var palette = new Uint32Array(raw.buffer, start, count);
+        var Index = {1: Uint8Array, 2: Uint16Array, 4: Uint32Array}[bytes];
+        var index = new Index(raw.buffer, start + 4*count, width*height);
+        var ids = new Uint32Array(width*height);
+        for (var i = 0; i < ids.length; i++) {
+            ids[i] = palette[index[i]];
+        }
+        return new Uint8Array(ids.buffer);
     },
 
     // Get a file as a promise
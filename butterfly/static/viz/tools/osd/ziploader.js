@@ -11,6 +11,10 @@ function ZipLoader( options ) {
     this.viaGL.vShader = '../shaders/vertex/square.glsl';
     this.viaGL.fShader = '../shaders/fragment/ids.glsl';
     this.viaGL.init();
+    // Get tiles streamed for each viewport when possible
+    if ( window.WebSocket ) {
+        this.socket = new TileSocket();
+    }
     OpenSeadragon.extend( true, this, {
         jobLimit:       OpenSeadragon.DEFAULT_SETTINGS.imageLoaderLimit,
         jobQueue:       [],
@@ -40,8 +44,14 @@ ZipLoader.prototype = {
                 callback: complete,
                 abort: options.abort
             };
+        if (options.src.indexOf('/api/data?') >= 0) {
+            jobOptions.socket = this.socket;
+        }
         // Cool Hack from 2016-09-26
-        if (options.src.indexOf('&format=zip') >= 0) {
+        var zipped = ['&format=zip', '&format=label'].some(function(fmt) {
+            return options.src.indexOf(fmt) >= 0;
+        });
+        if (zipped) {
             var newJob = new ZipJob( this.viaGL, jobOptions );
         }
         else {
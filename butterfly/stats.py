@@ -0,0 +1,182 @@
+'''Time each stage of each request as histograms by label'''
+
+import time
+import bisect
+import threading
+
+'''Upper bounds in seconds of each histogram bucket'''
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+'''Quantiles to estimate for /api/stats'''
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram(object):
+    '''Count durations in fixed buckets'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        '''
+        Estimate a quantile by interpolating within its bucket
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[i - 1] if i else 0.0
+                # The last bucket has no upper bound
+                upper = BUCKETS[i] if i < len(BUCKETS) else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+class Timer(object):
+    '''Observe the time spent within a with block'''
+
+    def __init__(self, stats, stage, labels):
+        self._stats = stats
+        self._stage = stage
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.time() - self._start
+        self._stats.observe(self._stage, seconds, **self._labels)
+
+
+class Context(object):
+    '''Add labels to all observations in this thread within a with block'''
+
+    def __init__(self, local, labels):
+        self._local = local
+        self._labels = labels
+
+    def __enter__(self):
+        self._outer = getattr(self._local, 'labels', {})
+        self._local.labels = dict(self._outer, **self._labels)
+
+    def __exit__(self, *args):
+        self._local.labels = self._outer
+
+
+class Stats(object):
+    '''Collect timings and counts labeled by datasource and zoom level
+
+    Each stage of a request is timed with a label for the class of the
+    datasource and the zoom level w, taken from the current context if
+    not given. Observations are kept as histograms with fixed BUCKETS.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._histograms = {}
+        self._counters = {}
+
+    def _key(self, name, labels):
+        if hasattr(self._local, 'labels'):
+            labels = dict(self._local.labels, **labels)
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def context(self, **labels):
+        '''
+        Label all observations in this thread within a with block
+        '''
+        return Context(self._local, labels)
+
+    def timer(self, stage, **labels):
+        '''
+        Time a stage within a with block
+        '''
+        return Timer(self, stage, labels)
+
+    def observe(self, stage, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(stage, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._start = time.time()
+
+    def to_json(self):
+        '''
+        Summarize each histogram and counter in milliseconds
+        '''
+        stages = []
+        counters = []
+        with self._lock:
+            for (stage, labels), hist in sorted(self._histograms.items()):
+                summary = dict(labels, stage=stage, count=hist.count,
+                               sum_ms=hist.sum * 1000,
+                               mean_ms=hist.sum * 1000 / hist.count)
+                for q in QUANTILES:
+                    summary['p%d_ms' % (q * 100)] = hist.quantile(q) * 1000
+                stages.append(summary)
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.append(dict(labels, name=name, value=value))
+        return {
+            'uptime_s': time.time() - self._start,
+            'stages': stages,
+            'counters': counters
+        }
+
+    def to_prometheus(self, prefix='bfly'):
+        '''
+        Write each histogram and counter in the Prometheus text format
+        '''
+        def series(name, labels, value):
+            text = ','.join('%s="%s"' % (k, v) for k, v in labels)
+            return '%s{%s} %s' % (name, text, repr(value))
+
+        stage = prefix + '_stage_seconds'
+        events = prefix + '_events_total'
+        lines = ['# HELP %s Seconds spent in each stage' % stage,
+                 '# TYPE %s histogram' % stage]
+        with self._lock:
+            for (name, labels), hist in sorted(self._histograms.items()):
+                labels = (('stage', name),) + labels
+                total = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    total += count
+                    le = labels + (('le', bound),)
+                    lines.append(series(stage + '_bucket', le, total))
+                lines.append(series(stage + '_sum', labels, hist.sum))
+                lines.append(series(stage + '_count', labels, hist.count))
+            lines += ['# HELP %s Count of each event' % events,
+                      '# TYPE %s counter' % events]
+            for (name, labels), value in sorted(self._counters.items()):
+                labels = (('event', name),) + labels
+                lines.append(series(events, labels, value))
+        return '\n'.join(lines) + '\n'
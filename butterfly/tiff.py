@@ -0,0 +1,328 @@
+'''A tiled or pyramidal TIFF data source'''
+
+import os
+import zlib
+import logging
+import tifffile
+import numpy as np
+from eventlog import log
+from tilecache import bypassed
+
+from .datasource import DataSource
+
+'''The first bytes of little and big endian TIFF and BigTIFF files'''
+MAGIC = ('II*\x00', 'MM\x00*', 'II+\x00', 'MM\x00+')
+
+'''TIFF compression of tiles that need no decoding'''
+NONE = 1
+
+'''TIFF compressions of tiles decoded by zlib'''
+DEFLATE = (8, 32946)
+
+'''TIFF predictor of tiles stored as differences of each row'''
+HORIZONTAL = 2
+
+
+def _tag(page, *names):
+    '''
+    Get the value of the first of the named tags the page has
+    '''
+    for name in names:
+        if name in page.tags:
+            return page.tags[name].value
+    return None
+
+
+def _pages(tif):
+    '''
+    List the pages of each resolution for each plane
+
+    :returns: the pages of each plane, from full to lowest resolution
+    '''
+    # Newer tifffile finds the levels of OME and SubIFD pyramids
+    if all(hasattr(series, 'levels') for series in tif.series):
+        planes = []
+        for series in tif.series:
+            # Light frames of repeated pages lack most tags
+            levels = [[getattr(p, 'aspage', lambda: p)() for p in level.pages]
+                      for level in series.levels]
+            planes += [list(pages) for pages in zip(*levels)]
+        return planes
+    planes = []
+    for page in tif.pages:
+        # Reduced pages follow the page of their plane
+        if page.is_reduced and planes:
+            planes[-1].append(page)
+        else:
+            planes.append([page])
+    return planes
+
+
+class TiffDataSource(DataSource):
+    '''A data source of one tiled or pyramidal TIFF file
+
+    Each full resolution page is a plane, and reduced resolution pages
+    after it, or the levels of its OME or SubIFD pyramid, are stored
+    zoom levels of that plane. The index keeps the offsets of all tiles
+    or strips of each page, so a cutout reads only the tiles it covers.
+
+    Uncompressed tiles are views of a memory map of the file. Deflate
+    tiles are decoded by zlib and tiles in any other compression by
+    tifffile, one tile at a time, and kept in the tile cache. With a
+    tifffile too old to decode single tiles, pages are decoded whole
+    and only cached if they fit in the tile cache.
+
+    Only pages with one sample per pixel are supported.
+    '''
+
+    def __init__(self, core, datapath):
+        self._map = None
+        self._decoders = {}
+        super(TiffDataSource, self).__init__(core, datapath)
+
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+        '''
+        if not os.path.isfile(datapath):
+            return 0
+        try:
+            with open(datapath, 'rb') as fd:
+                return int(fd.read(4) in MAGIC)
+        except IOError:
+            return 0
+
+    def index(self):
+        '''
+        @override
+        '''
+        self._levels = []
+        with tifffile.TiffFile(self._datapath) as tif:
+            byteorder = tif.byteorder
+            for z, pages in enumerate(_pages(tif)):
+                levels = [self._index_page(p, byteorder, z, l)
+                          for l, p in enumerate(pages)]
+                # The scale of each level as a power of two
+                width = float(levels[0]['shape'][1])
+                for level in levels:
+                    ratio = width / level['shape'][1]
+                    level['zoom'] = int(round(np.log2(ratio)))
+                self._levels.append(levels)
+        if not self._levels:
+            raise IndexError("TIFF %s has no pages" % self._datapath)
+        full = self._levels[0][0]
+        self._size_y, self._size_x = full['shape']
+        self._size_z = len(self._levels)
+        self.blocksize = full['tile'][::-1]
+        self.max_zoom = len(self._levels[0]) - 1
+        self._dtype = full['dtype'].newbyteorder('=')
+        super(TiffDataSource, self).index()
+
+    def _index_page(self, page, byteorder, z, level):
+        '''
+        Get the shape, dtype, tile size and tile offsets of a page
+        '''
+        if page.samplesperpixel != 1:
+            raise IndexError("TIFF %s has %d samples per pixel" % (
+                self._datapath, page.samplesperpixel))
+        shape = (page.imagelength, page.imagewidth)
+        if page.is_tiled:
+            tile = (page.tilelength, page.tilewidth)
+            offsets = _tag(page, 'TileOffsets', 'tile_offsets')
+            counts = _tag(page, 'TileByteCounts', 'tile_byte_counts')
+        else:
+            rows = _tag(page, 'RowsPerStrip', 'rows_per_strip')
+            tile = (min(rows or shape[0], shape[0]), shape[1])
+            offsets = _tag(page, 'StripOffsets', 'strip_offsets')
+            counts = _tag(page, 'StripByteCounts', 'strip_byte_counts')
+        compression = int(page.compression)
+        predictor = int(_tag(page, 'Predictor', 'predictor') or 1)
+        if compression != NONE and compression not in DEFLATE and \
+                not hasattr(page, 'decode'):
+            log.event('index', logging.INFO,
+                      'TIFF %s page %d level %d will decode whole pages',
+                      self._datapath, z, level)
+        return {
+            'shape': shape,
+            'tile': tile,
+            'grid': (-(-shape[0] // tile[0]), -(-shape[1] // tile[1])),
+            'offsets': np.array(offsets, np.uint64).ravel(),
+            'counts': np.array(counts, np.uint64).ravel(),
+            'compression': compression,
+            'predictor': predictor,
+            'dtype': np.dtype(page.dtype).newbyteorder(byteorder)
+        }
+
+    def get_state(self):
+        '''
+        @override
+        '''
+        state = super(TiffDataSource, self).get_state()
+        # Each process maps the file and makes its decoders itself
+        state['_map'] = None
+        state['_decoders'] = {}
+        return state
+
+    def get_type(self):
+        '''
+        @override
+        '''
+        return self._dtype
+
+    def get_boundaries(self):
+        '''
+        @override
+        '''
+        return (self._size_x, self._size_y, self._size_z)
+
+    def _choose_level(self, z, w):
+        '''
+        Get the stored level closest to zoom w without passing it
+
+        :returns: the level and the zoom levels left to subsample
+        '''
+        best = 0
+        for level, page in enumerate(self._levels[z]):
+            if page['zoom'] <= w and page['zoom'] > \
+                    self._levels[z][best]['zoom']:
+                best = level
+        return best, w - self._levels[z][best]['zoom']
+
+    def _read_bytes(self, page, index):
+        if self._map is None:
+            self._map = np.memmap(self._datapath, np.uint8, 'r')
+        start = int(page['offsets'][index])
+        return self._map[start:start + int(page['counts'][index])]
+
+    def _decoder(self, z, level):
+        '''
+        Get the tifffile decoder of the tiles of a page once
+
+        :returns: the decoder, or None if tifffile decodes whole pages,
+            and the JPEG tables of the page
+        '''
+        key = (z, level)
+        if key not in self._decoders:
+            with tifffile.TiffFile(self._datapath) as tif:
+                page = _pages(tif)[z][level]
+                self._decoders[key] = (getattr(page, 'decode', None),
+                                       getattr(page, 'jpegtables', None))
+        return self._decoders[key]
+
+    def _decode(self, z, level, index):
+        '''
+        Decode one tile or strip of a page with tifffile
+        '''
+        page = self._levels[z][level]
+        decode, jpegtables = self._decoder(z, level)
+        data = self._read_bytes(page, index).tostring()
+        tile, _, shape = decode(data or None, index, jpegtables=jpegtables)
+        if tile is None:
+            return np.zeros(shape[1:3], dtype=self._dtype)
+        return tile.reshape(shape[1:3])
+
+    def _tile(self, z, level, ty, tx):
+        '''
+        Read one tile or strip of a page
+        '''
+        page = self._levels[z][level]
+        tw = page['tile'][1]
+        dtype = page['dtype']
+        index = ty * page['grid'][1] + tx
+        if page['compression'] == NONE:
+            data = self._read_bytes(page, index)
+            rows = data.size // (tw * dtype.itemsize)
+            return data[:rows * tw * dtype.itemsize].view(dtype).reshape(
+                rows, tw)
+        whole = self._whole(z, level)
+        key = (self._datapath, z, level, ty, tx)
+        if whole:
+            key = (self._datapath, z, level)
+        tile = self._core._cache.get(key)
+        if tile is not None:
+            return tile
+        if page['compression'] in DEFLATE:
+            data = zlib.decompress(self._read_bytes(page, index).tostring())
+            tile = np.frombuffer(data, dtype)
+            rows = tile.size // tw
+            tile = tile[:rows * tw].reshape(rows, tw)
+            if page['predictor'] == HORIZONTAL:
+                tile = np.cumsum(tile, axis=1, dtype=tile.dtype)
+        elif whole:
+            with tifffile.TiffFile(self._datapath) as tif:
+                tile = _pages(tif)[z][level].asarray()
+            # A whole page larger than the cache would evict all of it
+            if tile.nbytes > self._core._cache.max_size:
+                return tile
+        else:
+            tile = self._decode(z, level, index)
+        if not bypassed():
+            self._core._cache.put(key, tile)
+        return tile
+
+    def _whole(self, z, level):
+        '''
+        Check if a page can only be decoded whole by tifffile
+        '''
+        page = self._levels[z][level]
+        if page['compression'] in DEFLATE + (NONE,):
+            return False
+        return self._decoder(z, level)[0] is None
+
+    def _read_region(self, z, level, y0, y1, x0, x1):
+        '''
+        Read a region of a page from the tiles covering it
+        '''
+        page = self._levels[z][level]
+        result = np.zeros((y1 - y0, x1 - x0), dtype=self._dtype)
+        [height, width] = page['shape']
+        [th, tw] = page['tile']
+        y0c, y1c = max(y0, 0), min(y1, height)
+        x0c, x1c = max(x0, 0), min(x1, width)
+        if y0c >= y1c or x0c >= x1c:
+            return result
+        if self._whole(z, level):
+            tile = self._tile(z, level, 0, 0)
+            result[y0c - y0:y1c - y0, x0c - x0:x1c - x0] = tile[y0c:y1c,
+                                                                x0c:x1c]
+            return result
+        for ty in range(y0c // th, -(-y1c // th)):
+            for tx in range(x0c // tw, -(-x1c // tw)):
+                tile = self._tile(z, level, ty, tx)
+                # The overlap of the tile and the region
+                ty0, tx0 = ty * th, tx * tw
+                ya, yb = max(y0c, ty0), min(y1c, ty0 + tile.shape[0])
+                xa, xb = max(x0c, tx0), min(x1c, tx0 + tile.shape[1])
+                if ya >= yb or xa >= xb:
+                    continue
+                result[ya - y0:yb - y0, xa - x0:xb - x0] = \
+                    tile[ya - ty0:yb - ty0, xa - tx0:xb - tx0]
+        return result
+
+    def load_cutout(self, x0, x1, y0, y1, z, w, out=None):
+        '''
+        @override
+        '''
+        scale = 2 ** w
+        shape = ((y1 - y0) // scale, (x1 - x0) // scale)
+        if z < 0 or z >= self._size_z:
+            return self.write_out(np.zeros(shape, dtype=self._dtype), out)
+        level, left = self._choose_level(z, w)
+        factor = 2 ** (w - left)
+        step = 2 ** left
+        # Read the region from the stored level, then subsample the rest
+        region = self._read_region(z, level, y0 // factor, y1 // factor,
+                                   x0 // factor, x1 // factor)
+        if out is None:
+            out = np.zeros(shape, dtype=self._dtype)
+        return self.write_out(region[::step, ::step], out)
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+        (bx, by) = self.blocksize
+        [x0, y0] = [x * bx * 2 ** w, y * by * 2 ** w]
+        return self.load_cutout(x0, x0 + bx * 2 ** w, y0, y0 + by * 2 ** w,
+                                z, w)
@@ -0,0 +1,512 @@
+'''Keep recently loaded tiles in memory'''
+
+import mmap
+import contextlib
+import zlib
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+
+import labeltile
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def bypass(active=True):
+    '''
+    Read through the caches without adding tiles in this thread
+
+    Bulk reads such as exports use each tile once, so adding their
+    tiles would only push out the tiles of interactive viewers.
+
+    :param active: whether to bypass, so callers can pass a flag
+    '''
+    was = bypassed()
+    _local.bypass = was or bool(active)
+    try:
+        yield
+    finally:
+        _local.bypass = was
+
+
+def bypassed():
+    '''
+    Check if the caches should not add tiles loaded by this thread
+    '''
+    return getattr(_local, 'bypass', False)
+
+
+class FrequencySketch(object):
+    '''Estimate how often each key was used with little memory
+
+    A count-min sketch of DEPTH rows of 8-bit counters. The estimate
+    of a key is its least counter, which may count too high but never
+    too low. All counters halve once the sketch has counted ten times
+    its width, so old use counts for less than recent use.
+    '''
+
+    DEPTH = 4
+
+    '''Odd numbers to hash each key differently for each row'''
+    SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width):
+        # Use a power of two to mask hashes into columns
+        self._width = 1 << max(int(width) - 1, 1).bit_length()
+        self._counts = np.zeros((self.DEPTH, self._width), np.uint8)
+        self._added = 0
+
+    def _columns(self, key):
+        h = hash(key)
+        mask = self._width - 1
+        return [((h ^ seed) * seed >> 16) & mask for seed in self.SEEDS]
+
+    def add(self, key):
+        rows = range(self.DEPTH)
+        columns = self._columns(key)
+        counts = self._counts[rows, columns]
+        # Add only to the least counters to count too high less often
+        least = counts.min()
+        if least < 255:
+            self._counts[rows, columns] = np.where(counts == least,
+                                                   counts + 1, counts)
+        self._added += 1
+        if self._added >= 10 * self._width:
+            self._counts >>= 1
+            self._added //= 2
+
+    def estimate(self, key):
+        return int(self._counts[range(self.DEPTH), self._columns(key)].min())
+
+    def clear(self):
+        self._counts[:] = 0
+        self._added = 0
+
+
+class TileCache(object):
+    '''Keep the most recently used tiles up to a total size
+
+    Each tile is a numpy array stored under a key of its path and zoom
+    level. The size of the cache is the sum of the bytes of its tiles,
+    as in the SharedTileCache.
+
+    The policy chooses which tiles to keep:
+
+    - "lru" removes the least recently used tile.
+    - "slru" adds new tiles to a probation segment and moves tiles used
+      again to a protected segment of PROTECTED of the max size. Tiles
+      used once leave first, so one scan of many tiles only replaces
+      the probation segment.
+    - "tinylfu" adds new tiles to a window of WINDOW of the max size,
+      kept by lru, in front of an "slru" main cache. It also counts the
+      use of every key in a FrequencySketch. A tile leaving the window
+      only enters the full main cache if its key was used more often
+      than the main tile it would remove. New tiles always get a time
+      in the window to be used again, while a scan can't push out
+      tiles used more often.
+    '''
+
+    POLICIES = ('lru', 'slru', 'tinylfu')
+
+    '''Share of the main cache for tiles used more than once'''
+    PROTECTED = 0.8
+
+    '''Share of the max size for the window of new tiles with tinylfu'''
+    WINDOW = 0.01
+
+    '''Average bytes of a tile used to size the FrequencySketch'''
+    TILE_SIZE = 512 * 512
+
+    def __init__(self, max_size, policy='lru'):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown cache policy: %s' % policy)
+        self.max_size = max_size
+        self.policy = policy
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # With lru, all tiles stay in probation
+        self._window = OrderedDict()
+        self._window_size = 0
+        self._window_max = 0
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._protected_size = 0
+        self._protected_max = 0
+        self._sketch = None
+        if policy == 'tinylfu':
+            self._window_max = int(max_size * self.WINDOW)
+            self._sketch = FrequencySketch(max(max_size // self.TILE_SIZE,
+                                               256) * 4)
+        if policy != 'lru':
+            main_size = max_size - self._window_max
+            self._protected_max = int(main_size * self.PROTECTED)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._window) + len(self._probation) + \
+            len(self._protected)
+
+    def get(self, key):
+        '''
+        Get a tile and mark it as most recently used
+
+        :returns: the tile or None if not in the cache
+        '''
+        with self._lock:
+            if self._sketch:
+                self._sketch.add(key)
+            if key in self._window:
+                tile = self._window.pop(key)
+                self._window[key] = tile
+            elif key in self._protected:
+                tile = self._protected.pop(key)
+                self._protected[key] = tile
+            elif key in self._probation:
+                tile = self._probation.pop(key)
+                if self._protected_max:
+                    self._protect(key, tile)
+                else:
+                    # Move most recently accesed items to the top
+                    self._probation[key] = tile
+            else:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return tile
+
+    def _protect(self, key, tile):
+        '''
+        Move a tile from probation to the protected segment
+        '''
+        self._protected[key] = tile
+        self._protected_size += tile.nbytes
+        # Move the oldest protected tiles back to probation
+        while self._protected_size > self._protected_max:
+            old_key, old = self._protected.popitem(last=False)
+            self._protected_size -= old.nbytes
+            self._probation[old_key] = old
+
+    def _victim(self):
+        '''
+        Get the key of the next tile to remove from the main cache
+        '''
+        for tiles in (self._probation, self._protected):
+            if tiles:
+                return next(iter(tiles))
+        return None
+
+    def _remove(self, key):
+        '''
+        Remove a tile from any segment
+        '''
+        if key in self._window:
+            tile = self._window.pop(key)
+            self._window_size -= tile.nbytes
+        elif key in self._probation:
+            tile = self._probation.pop(key)
+        elif key in self._protected:
+            tile = self._protected.pop(key)
+            self._protected_size -= tile.nbytes
+        else:
+            return
+        self.size -= tile.nbytes
+
+    def _admit(self):
+        '''
+        Move the oldest tiles of a full window to the main cache if
+        they were used more often than the tiles they would remove
+        '''
+        while self._window_size > self._window_max and \
+                len(self._window) > 1:
+            key, tile = self._window.popitem(last=False)
+            self._window_size -= tile.nbytes
+            victim = self._victim()
+            if self.size > self.max_size and victim is not None:
+                if self._sketch.estimate(key) <= \
+                        self._sketch.estimate(victim):
+                    self.size -= tile.nbytes
+                    continue
+                # Remove the main tiles the new tile replaces
+                while self.size > self.max_size and victim is not None:
+                    self._remove(victim)
+                    victim = self._victim()
+            self._probation[key] = tile
+
+    def put(self, key, tile):
+        '''
+        Add a tile, removing the least recently used tiles to fit it
+        '''
+        # Many datasources may index at once
+        with self._lock:
+            self._remove(key)
+            # A tile larger than the cache would remove all others
+            if tile.nbytes > self.max_size:
+                return
+            self.size += tile.nbytes
+            if self._sketch:
+                self._window[key] = tile
+                self._window_size += tile.nbytes
+                self._admit()
+            else:
+                self._probation[key] = tile
+
+            # Remove items in cache until everything fits
+            while self.size > self.max_size and len(self):
+                tiles = self._probation or self._protected or self._window
+                oldest = tiles.popitem(last=False)[1]
+                self.size -= oldest.nbytes
+                if tiles is self._protected:
+                    self._protected_size -= oldest.nbytes
+                elif tiles is self._window:
+                    self._window_size -= oldest.nbytes
+
+    def clear(self):
+        '''
+        Remove all tiles and reset the counts
+        '''
+        with self._lock:
+            self._window.clear()
+            self._probation.clear()
+            self._protected.clear()
+            self._window_size = 0
+            self._protected_size = 0
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            if self._sketch:
+                self._sketch.clear()
+
+
+class PackedTile(object):
+    '''Keep a label tile as its palette and a compressed index'''
+
+    def __init__(self, tile, level=1):
+        palette, index = labeltile.pack(tile)
+        self._palette = palette
+        self._index = zlib.compress(index.tostring(), level)
+        self._index_dtype = index.dtype
+        self._shape = tile.shape
+        self.nbytes = palette.nbytes + len(self._index)
+
+    def unpack(self):
+        index = np.frombuffer(zlib.decompress(self._index), self._index_dtype)
+        return self._palette[index.reshape(self._shape)]
+
+
+'''The codec to pack tiles of each dtype, or raw if not listed'''
+CODECS = dict((np.dtype(t), PackedTile) for t in (
+    np.uint16, np.uint32, np.uint64, np.int16, np.int32, np.int64))
+
+
+class CompressedTileCache(TileCache):
+    '''Keep tiles packed by the codec for their dtype
+
+    Label tiles are mostly long runs of few ids, so their palette and
+    compressed index take a small part of their size. Tiles that do not
+    get smaller are kept raw. A sample of each tile is checked first,
+    so images like uint16 EM with many values skip the packing.
+    '''
+
+    '''Pixels between the samples of each row and column of a tile'''
+    SAMPLE_STEP = 16
+
+    '''Most share of distinct values in the sample of a packed tile'''
+    SAMPLE_DISTINCT = 0.25
+
+    def get(self, key):
+        '''
+        @override
+        '''
+        tile = super(CompressedTileCache, self).get(key)
+        if isinstance(tile, PackedTile):
+            return tile.unpack()
+        return tile
+
+    def _few_values(self, tile):
+        '''
+        Check if a sample of a tile has few enough values to pack
+        '''
+        sample = tile[::self.SAMPLE_STEP, ::self.SAMPLE_STEP]
+        distinct = len(np.unique(sample))
+        return distinct <= max(sample.size * self.SAMPLE_DISTINCT, 1)
+
+    def put(self, key, tile):
+        '''
+        @override
+        '''
+        codec = CODECS.get(tile.dtype)
+        if codec and tile.ndim == 2 and self._few_values(tile):
+            packed = codec(tile)
+            if packed.nbytes < tile.nbytes:
+                tile = packed
+        super(CompressedTileCache, self).put(key, tile)
+
+
+class SharedTileCache(object):
+    '''Keep tiles in a memory map shared by forked processes
+
+    The memory map has a header, a table of slots, and an arena of tile
+    data written in a ring. Each key hashes to a set of WAYS slots, and
+    a new tile replaces the least recently used slot of its set. The
+    data of a slot is valid until the ring writes over it, so the oldest
+    tiles leave first. One process lock guards all reads and writes.
+
+    Create the cache before forking so all processes share it.
+    '''
+
+    '''Number of slots that may hold each key'''
+    WAYS = 4
+
+    '''Average bytes per tile used to count the slots'''
+    TILE_BYTES = 64 * 1024
+
+    HEADER = np.dtype([
+        ('head', '<u8'),
+        ('tick', '<u8'),
+        ('hits', '<u8'),
+        ('misses', '<u8')
+    ])
+
+    SLOT = np.dtype([
+        ('digest', '<u8', 2),
+        ('start', '<u8'),
+        ('nbytes', '<u8'),
+        ('used', '<u8'),
+        ('dtype', 'S8'),
+        ('shape', '<u4', 2)
+    ])
+
+    def __init__(self, max_size, slots=None):
+        '''
+        :param max_size: the bytes of tile data to keep
+        :param slots: the most tiles to keep (default by TILE_BYTES)
+        '''
+        slots = slots or max(max_size // self.TILE_BYTES, 1) * self.WAYS
+        self._sets = max(slots // self.WAYS, 1)
+        n_slots = self._sets * self.WAYS
+        table = self.HEADER.itemsize + n_slots * self.SLOT.itemsize
+        self.max_size = int(max_size)
+        self._map = mmap.mmap(-1, table + self.max_size)
+        self._header = np.frombuffer(self._map, self.HEADER, 1)
+        self._slots = np.frombuffer(self._map, self.SLOT, n_slots,
+                                    self.HEADER.itemsize)
+        self._arena = np.frombuffer(self._map, np.uint8, self.max_size,
+                                    table)
+        self._lock = multiprocessing.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return int(np.count_nonzero(self._live()))
+
+    @property
+    def size(self):
+        '''
+        The bytes of tiles still in the cache, not counting ring space
+        left by replaced tiles or tiles no slot refers to
+        '''
+        with self._lock:
+            return int(self._slots['nbytes'][self._live()].sum())
+
+    def _live(self):
+        '''
+        Mark the slots whose data the ring has not written over
+        '''
+        head = int(self._header['head'][0])
+        nbytes = self._slots['nbytes']
+        fresh = self._slots['start'] + self.max_size >= head
+        return (nbytes > 0) & fresh
+
+    @property
+    def hits(self):
+        return int(self._header['hits'][0])
+
+    @property
+    def misses(self):
+        return int(self._header['misses'][0])
+
+    def _digest(self, key):
+        return np.frombuffer(hashlib.md5(repr(key)).digest(), '<u8')
+
+    def _find(self, digest):
+        '''
+        Get the first slot of the set for a key and the key's slot in it
+        '''
+        first = int(digest[0] % self._sets) * self.WAYS
+        ways = self._slots[first:first + self.WAYS]
+        for i, slot in enumerate(ways):
+            if (slot['digest'] == digest).all() and self._valid(slot):
+                return first, first + i
+        return first, None
+
+    def _valid(self, slot):
+        head = int(self._header['head'][0])
+        return slot['nbytes'] and slot['start'] + self.max_size >= head
+
+    def get(self, key):
+        '''
+        Get a copy of a tile and mark it as most recently used
+
+        :returns: the tile or None if not in the cache
+        '''
+        digest = self._digest(key)
+        with self._lock:
+            header = self._header[0]
+            first, index = self._find(digest)
+            if index is None:
+                header['misses'] += 1
+                return None
+            slot = self._slots[index]
+            header['tick'] += 1
+            slot['used'] = header['tick']
+            header['hits'] += 1
+            offset = int(slot['start'] % self.max_size)
+            data = self._arena[offset:offset + int(slot['nbytes'])]
+            dtype = np.dtype(slot['dtype'])
+            shape = tuple(int(s) for s in slot['shape'])
+            return data.view(dtype).reshape(shape).copy()
+
+    def put(self, key, tile):
+        '''
+        Write a 2D tile to the ring, unless it is too large
+        '''
+        tile = np.ascontiguousarray(tile)
+        if tile.ndim != 2 or tile.nbytes > self.max_size // 4:
+            return
+        digest = self._digest(key)
+        with self._lock:
+            header = self._header[0]
+            head = int(header['head'])
+            # Start tiles that would cross the end of the ring at its start
+            offset = head % self.max_size
+            if offset + tile.nbytes > self.max_size:
+                head += self.max_size - offset
+                offset = 0
+            self._arena[offset:offset + tile.nbytes] = tile.view(np.uint8).ravel()
+            header['head'] = head + tile.nbytes
+
+            first, index = self._find(digest)
+            if index is None:
+                ways = self._slots[first:first + self.WAYS]
+                valid = [self._valid(slot) for slot in ways]
+                # Replace an empty slot or else the least recently used
+                index = first + int(np.lexsort((ways['used'], valid))[0])
+            header['tick'] += 1
+            slot = self._slots[index]
+            slot['digest'] = digest
+            slot['start'] = head
+            slot['nbytes'] = tile.nbytes
+            slot['used'] = header['tick']
+            slot['dtype'] = tile.dtype.str
+            slot['shape'] = tile.shape
+
+    def clear(self):
+        '''
+        Remove all tiles and reset the counts
+        '''
+        with self._lock:
+            self._slots[:] = np.zeros(1, self.SLOT)
+            self._header[:] = np.zeros(1, self.HEADER)
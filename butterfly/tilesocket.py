@@ -0,0 +1,146 @@
+'''Stream the tiles of a viewport over a WebSocket'''
+
+import json
+import math
+import struct
+import tornado.gen
+import tornado.websocket
+from urllib2 import HTTPError
+
+import rh_logger
+import settings
+from restapi import RestAPIHandler
+
+
+class TileSocketHandler(tornado.websocket.WebSocketHandler, RestAPIHandler):
+    '''Send the tiles of each viewport a client subscribes to
+
+    Each message from the client is a JSON subscription with these keys:
+
+    experiment, sample, dataset, channel, format, view, profile: as for
+    /api/data
+    z, resolution: the slice and zoom level of the viewport
+    bounds: the x0, y0, x1, y1 of the viewport at the zoom level
+    tile: the largest width and height of each tile (default 512)
+
+    Every subscription replaces the last one for the same channel. The
+    tiles overlapping the bounds are sent in order from the center out.
+    Each binary message is a big-endian uint32 length, a JSON header
+    with the x, y, z, resolution, width, height and channel of the
+    tile, and the tile encoded like /api/data. Any tile not yet sent
+    when a channel gets a new subscription is dropped.
+    '''
+
+    Q_BOUNDS = "bounds"
+    Q_TILE = "tile"
+
+    def open(self):
+        self._terms = {}
+        self._generations = {}
+
+    def check_origin(self, origin):
+        '''Allow all origins like the REST API'''
+        return True
+
+    def get_query_argument(self, name, default=None, strip=True):
+        '''Read the terms of the current subscription'''
+        return self._terms.get(name, default)
+
+    def on_close(self):
+        self._generations.clear()
+
+    def on_message(self, message):
+        try:
+            self._terms = json.loads(message)
+            if not isinstance(self._terms, dict):
+                raise TypeError('Subscription is not an object')
+            channel = self._get_channel_config()
+            fmt, view = self._get_format_and_view(channel)
+            profile = self._get_profile(channel)
+            z = self._get_int_necessary_param(self.Q_Z)
+            w = self._get_int_query_argument(self.Q_RESOLUTION)
+            bounds = self._get_necessary_param(self.Q_BOUNDS)
+            tile = self._terms.get(self.Q_TILE, [512, 512])
+            tiles = self._plan(channel, bounds, tile, w)
+        except (ValueError, TypeError):
+            self.write_message(json.dumps({'error': 'Bad subscription'}))
+            return
+        except HTTPError, http_error:
+            self.write_message(json.dumps({'error': http_error.msg}))
+            return
+
+        # Stop sending tiles from the last subscription
+        key = tuple(self._terms.get(q) for q in (
+            self.Q_EXPERIMENT, self.Q_SAMPLE, self.Q_DATASET, self.Q_CHANNEL))
+        generation = self._generations.get(key, 0) + 1
+        self._generations[key] = generation
+
+        args = (channel, fmt, profile, view, z, w, tiles)
+        self._stream(key, generation, *args)
+
+    def _plan(self, channel, bounds, tile, w):
+        '''
+        List the x, y, width, height of each tile in bounds from the center
+        '''
+        [x0, y0, x1, y1] = [int(b) for b in bounds]
+        [tile_x, tile_y] = [int(t) for t in tile]
+        [x0, y0] = [max(x0, 0), max(y0, 0)]
+        # Only list tiles within the channel if its size is known
+        dimensions = channel.get(self.DIMENSIONS, {})
+        if self.X in dimensions and self.Y in dimensions:
+            scale = 2.0 ** w
+            x1 = min(x1, int(math.ceil(dimensions[self.X] / scale)))
+            y1 = min(y1, int(math.ceil(dimensions[self.Y] / scale)))
+        center = [(x0 + x1) / 2.0, (y0 + y1) / 2.0]
+        # The nearest tiles are no more than half the most tiles away
+        # along either axis, so huge bounds list a bounded number
+        reach = settings.MAX_BATCH_TILES // 2 + 1
+        left = max(x0, int(center[0]) - reach * tile_x)
+        top = max(y0, int(center[1]) - reach * tile_y)
+        right = min(x1, int(center[0]) + reach * tile_x)
+        down = min(y1, int(center[1]) + reach * tile_y)
+
+        tiles = []
+        for y in range(top - top % tile_y, down, tile_y):
+            for x in range(left - left % tile_x, right, tile_x):
+                width = tile_x
+                height = tile_y
+                if self.X in dimensions and self.Y in dimensions:
+                    width = min(tile_x, x1 - x)
+                    height = min(tile_y, y1 - y)
+                middle = [x + width / 2.0 - center[0],
+                          y + height / 2.0 - center[1]]
+                distance = middle[0] ** 2 + middle[1] ** 2
+                tiles.append((distance, x, y, width, height))
+        tiles.sort()
+        return [t[1:] for t in tiles[:settings.MAX_BATCH_TILES]]
+
+    @tornado.gen.coroutine
+    def _stream(self, key, generation, channel, fmt, profile, view, z, w,
+                tiles):
+        '''
+        Send each tile unless the channel has a newer subscription
+        '''
+        for x, y, width, height in tiles:
+            # Allow new subscriptions to arrive between tiles
+            yield tornado.gen.moment
+            if self._generations.get(key) != generation:
+                return
+            try:
+                vol = self.core.get(channel[self.PATH], [x, y, z],
+                                    [width, height, 1], w=w, view=view)
+                content = yield self.core._encoder.submit(vol, fmt, profile)
+            except Exception:
+                rh_logger.logger.report_exception(
+                    msg="Could not stream tile %d, %d" % (x, y))
+                continue
+            header = json.dumps({
+                self.Q_X: x, self.Q_Y: y, self.Q_Z: z,
+                self.Q_RESOLUTION: w, self.Q_WIDTH: width,
+                self.Q_HEIGHT: height, self.Q_CHANNEL: channel[self.NAME]
+            })
+            message = struct.pack('>I', len(header)) + header + content
+            try:
+                yield self.write_message(message, binary=True)
+            except tornado.websocket.WebSocketClosedError:
+                return
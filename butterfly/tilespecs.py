@@ -26,6 +26,14 @@ class Tilespecs(DataSource):
 
         super(Tilespecs, self).__init__(core, datapath)
 
+    @classmethod
+    def probe(cls, datapath):
+        '''
+        @override
+        '''
+        ts_fnames = os.path.join(datapath, '*.json')
+        return int(os.path.isdir(datapath) and bool(glob.glob(ts_fnames)))
+
     def index(self):
         '''
         @override
@@ -74,26 +82,60 @@ class Tilespecs(DataSource):
 
         super(Tilespecs, self).index()
 
+    def get_sources(self):
+        '''
+        @override
+        '''
+        ts_fnames = glob.glob(os.path.join(self._datapath, '*.json'))
+        return [self._datapath] + ts_fnames
+
+    def get_state(self):
+        '''
+        @override
+
+        The renderers may not pickle, so each layer makes its renderer
+        again from the kept tilespecs on its first use.
+        '''
+        state = super(Tilespecs, self).get_state()
+        del state['layer_renderer']
+        return state
+
+    def set_state(self, state):
+        '''
+        @override
+        '''
+        super(Tilespecs, self).set_state(state)
+        self.layer_renderer = {}
+
+    def get_renderer(self, z):
+        '''
+        Get the renderer of a layer, making it on first use
+        '''
+        if z not in self.layer_renderer:
+            self.layer_renderer[z] = TilespecRenderer(self.layer_ts[z],
+                                                      self.dtype)
+        return self.layer_renderer[z]
+
     def get_type(self):
         '''
         @override
         '''
         return self.load(0,0,0,0).single_tiles[0].render()[0].dtype
 
-    def load_cutout(self, x0, x1, y0, y1, z, w):
+    def load_cutout(self, x0, x1, y0, y1, z, w, out=None):
         '''
         @override
         '''
         cutout_bounds = np.array([x0, y0, x1, y1])/(2.0 ** w)
         cutout_bounds = cutout_bounds.astype(np.uint32)-(0,0,1,1)
         img = self.load(0,0,z,w).single_tiles[0].crop(*cutout_bounds)[0]
-        return img
+        return self.write_out(img, out)
 
     def load(self, x, y, z, w):
         '''
         @override
         '''
-        plane_rendered = deepcopy(self.layer_renderer[z])
+        plane_rendered = deepcopy(self.get_renderer(z))
         if w > 0:
             model = AffineModel(m=np.eye(3) / 2.0 ** w)
             plane_rendered.add_transformation(model)
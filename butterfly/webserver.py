@@ -5,9 +5,11 @@ import socket
 import tornado
 import tornado.gen
 import tornado.web
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
 import tornado.websocket
 import numpy as np
-import cv2
 import mimetypes
 import posixpath
 import StringIO
@@ -17,6 +19,9 @@ import settings
 from requestparser import RequestParser
 from urllib2 import HTTPError
 from restapi import RestAPIHandler
+from tilesocket import TileSocketHandler
+from profiler import Profiler, INTERVAL
+from eventlog import log
 
 
 class WebServerHandler(tornado.web.RequestHandler):
@@ -29,7 +34,7 @@ class WebServerHandler(tornado.web.RequestHandler):
     def get(self, uri):
         '''
         '''
-        self._webserver.handle(self)
+        yield self._webserver.handle(self)
 
 
 #
@@ -59,11 +64,14 @@ class PkgResourcesHandler(tornado.web.RequestHandler):
 
 class WebServer:
 
-    def __init__(self, core, port=2001):
+    def __init__(self, core, port=2001, workers=1):
         '''
+        :param workers: the number of server processes, or 0 for one per cpu
         '''
         self._core = core
         self._port = port
+        self._workers = workers
+        self._profiler = Profiler()
 
     def start(self):
         '''
@@ -72,11 +80,22 @@ class WebServer:
         ip = socket.gethostbyname('')
         port = self._port
 
-        webapp = tornado.web.Application([
+        routes = [
+            (r'/ws/tiles', TileSocketHandler, dict(core=self._core)),
             (r'/api/(.*)', RestAPIHandler, dict(core=self._core)),
             (r'/metainfo/(.*)', WebServerHandler, dict(webserver=self)),
             (r'/data/(.*)', WebServerHandler, dict(webserver=self)),
             (r'/stop/(.*)', WebServerHandler, dict(webserver=self)),
+        ]
+        if settings.STATS_PROMETHEUS:
+            routes += [
+                (r'/metrics(.*)', WebServerHandler, dict(webserver=self)),
+            ]
+        if settings.PROFILER:
+            routes += [
+                (r'/profile/(.*)', WebServerHandler, dict(webserver=self)),
+            ]
+        routes += [
             (r'/(.*\.html)', PkgResourcesHandler, {}),
             (r'/(.*\.js)', PkgResourcesHandler, {}),
             (r'/(.*\.css)', PkgResourcesHandler, {}),
@@ -84,10 +103,20 @@ class WebServer:
             (r'/(.*\.png)', PkgResourcesHandler, {}),
             (r'/(.*\.ico)', PkgResourcesHandler, {}),
             (r'(/)', PkgResourcesHandler, {})
-
-        ])
-
-        webapp.listen(port, max_buffer_size=1024 * 1024 * 150000)
+        ]
+        webapp = tornado.web.Application(routes)
+
+        max_buffer_size = 1024 * 1024 * 150000
+        if self._workers != 1:
+            # Forked workers share the tile cache and the listening socket
+            self._core.share_cache()
+            sockets = tornado.netutil.bind_sockets(port)
+            tornado.process.fork_processes(self._workers)
+            server = tornado.httpserver.HTTPServer(
+                webapp, max_buffer_size=max_buffer_size)
+            server.add_sockets(sockets)
+        else:
+            webapp.listen(port, max_buffer_size=max_buffer_size)
         startup_msg = ('Starting webserver at \033[93mhttp://' + ip + ':' +
                        str(port) + '\033[0m')
 
@@ -115,6 +144,34 @@ class WebServer:
             handler.set_header("Content-type", "text/plain")
             handler.write("stop")
             return
+        elif splitted_request[1] == 'profile':
+            # /profile/start?mode=sample|cprofile, /profile/stop?focus=regex
+            command = handler.request.path.split('/')[2]
+            handler.set_header("Content-type", "text/plain")
+            try:
+                # Each worker has its own profiler, so requests to start
+                # and stop may reach different processes
+                if self._workers != 1:
+                    raise ValueError('Profiling needs workers: 1')
+                if command == 'start':
+                    mode = handler.get_query_argument('mode', 'sample')
+                    interval = float(handler.get_query_argument(
+                        'interval', INTERVAL))
+                    self._profiler.start(mode, interval)
+                    content = 'Started %s profile\n' % mode
+                elif command == 'stop':
+                    focus = handler.get_query_argument('focus', None)
+                    content = self._profiler.stop(focus)
+                else:
+                    mode = self._profiler.mode
+                    content = ('Profiling with %s\n' % mode if mode
+                               else 'Not profiling\n')
+            except ValueError, err:
+                handler.set_status(400)
+                content = str(err) + '\n'
+        elif splitted_request[1] == 'metrics':
+            content = self._core._stats.to_prometheus()
+            handler.set_header("Content-type", "text/plain; version=0.0.4")
 
         # image data request
         elif splitted_request[1] == 'data':
@@ -151,22 +208,21 @@ class WebServer:
                     content = output.getvalue()
                     content_type = 'application/octet-stream'
                 elif output_format in image_formats:
+                    encoder = self._core._encoder
                     if color:
                         volume = volume[:, :, :, [2, 1, 0]]
-                        content = cv2.imencode(
-                            '.' + output_format,
+                        content = yield encoder.submit_image(
                             volume[
                                 :,
                                 :,
                                 0,
-                                :].astype(out_dtype))[1].tostring()
+                                :].astype(out_dtype), output_format)
                     else:
-                        content = cv2.imencode(
-                            '.' + output_format,
+                        content = yield encoder.submit_image(
                             volume[
                                 :,
                                 :,
-                                0].astype(out_dtype))[1].tostring()
+                                0].astype(out_dtype), output_format)
                     content_type = 'image/' + output_format
                 else:
                     raise HTTPError(handler.request.uri,
@@ -176,8 +232,8 @@ class WebServer:
 
                 # Show some basic statistics
 
-                rh_logger.logger.report_event(
-                    'Total volume shape: %s' % str(volume.shape))
+                log.event('request', logging.DEBUG,
+                          'Total volume shape: %s', volume.shape)
                 handler.set_header('Content-Type', content_type)
 
             except (KeyError, ValueError):
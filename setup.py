@@ -45,6 +45,10 @@ setup(
     entry_points=dict(console_scripts=[
         'bfly = butterfly.cli:main',
         'bfly_query = butterfly.cli:query',
+        'bfly_bench = butterfly.benchmark.run:main',
+        'bfly_load = butterfly.benchmark.loadtest:main',
+        'bfly_convert = butterfly.convert:main',
+        'bfly_index = butterfly.labelindex:main',
     ]),
     package_data=dict(butterfly=butterfly_package_data),
     zip_safe=False
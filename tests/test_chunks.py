@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from butterfly import chunks
+from butterfly.stats import Stats
+from butterfly.tilecache import TileCache
+
+
+class FakeCore(object):
+    '''The parts of the core a chunk datasource uses'''
+
+    def __init__(self):
+        self._cache = TileCache(10 ** 7, 'lru')
+        self._stats = Stats(False)
+
+
+def write_plane(folder, header, w, z, plane):
+    '''
+    Write a plane of a zoom level the way bfly_convert does
+    '''
+    [ch, cw] = header['chunk']
+    [rows, cols] = chunks.grid_shape(header, w)
+    shard = header['shard']
+    os.makedirs(os.path.join(folder, str(w), str(z)))
+    for s_row in range(0, rows, shard):
+        for s_col in range(0, cols, shard):
+            parts = []
+            for i in range(shard ** 2):
+                row, col = s_row + i // shard, s_col + i % shard
+                chunk = plane[row * ch:(row + 1) * ch,
+                              col * cw:(col + 1) * cw]
+                data = None
+                if row < rows and col < cols and chunk.any():
+                    data = chunks.encode_chunk(header, chunk)
+                parts.append(data)
+            path, index = chunks.chunk_file(folder, header, w, z,
+                                            s_row, s_col)
+            if index is not None:
+                chunks.write_shard(path, parts)
+            elif parts[0] is not None:
+                chunks.write_file(path, parts[0])
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plane = np.random.RandomState(0).randint(0, 2 ** 16,
+                                                      (100, 130))
+        self.plane = self.plane.astype(np.uint16)
+        # Leave one chunk empty
+        self.plane[:32, :32] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def open(self, shard, compression='zlib'):
+        header = chunks.make_header((1,) + self.plane.shape, np.uint16,
+                                    (32, 32), 2, shard, compression)
+        write_plane(self.folder, header, 0, 0, self.plane)
+        write_plane(self.folder, header, 1, 0, self.plane[::2, ::2])
+        chunks.write_header(self.folder, header)
+        source = chunks.ChunkDataSource(FakeCore(), self.folder)
+        source.index()
+        return source
+
+    def test_encode_round_trip(self):
+        header = chunks.make_header((1, 64, 64), np.uint8, (32, 32), 1)
+        chunk = np.arange(20 * 30, dtype=np.uint8).reshape(20, 30)
+        full = chunks.decode_chunk(header, chunks.encode_chunk(header, chunk))
+        np.testing.assert_array_equal(full[:20, :30], chunk)
+        self.assertFalse(full[20:].any() or full[:, 30:].any())
+
+    def test_cutout_round_trip(self):
+        for shard, compression in [(1, 'zlib'), (2, 'none'), (3, 'zlib')]:
+            source = self.open(shard, compression)
+            cutout = source.load_cutout(10, 120, 5, 95, 0, 0)
+            np.testing.assert_array_equal(cutout, self.plane[5:95, 10:120])
+            shutil.rmtree(self.folder)
+            os.makedirs(self.folder)
+
+    def test_levels_and_tiles(self):
+        source = self.open(2)
+        # The stored level and the level subsampled above it
+        np.testing.assert_array_equal(source.load_cutout(0, 128, 0, 96, 0, 1),
+                                      self.plane[:96:2, :128:2])
+        np.testing.assert_array_equal(source.load_cutout(0, 128, 0, 96, 0, 2),
+                                      self.plane[:96:4, :128:4])
+        # Tiles are indexed by chunk at each zoom level
+        np.testing.assert_array_equal(source.load(1, 0, 0, 1),
+                                      self.plane[:64:2, 64:128:2])
+        np.testing.assert_array_equal(source.load(0, 0, 0, 0),
+                                      np.zeros((32, 32), np.uint16))
+
+    def test_rewritten_shard(self):
+        source = self.open(2)
+        source.load_cutout(0, 64, 0, 64, 0, 0)
+        # Write the shard again with other chunks and a later time
+        header = source._header
+        path = chunks.chunk_file(self.folder, header, 0, 0, 0, 0)[0]
+        chunk = chunks.encode_chunk(header, np.ones((32, 32), np.uint16))
+        chunks.write_shard(path, [None, None, None, chunk])
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        source._core._cache.clear()
+        cutout = source.load_cutout(0, 64, 0, 64, 0, 0)
+        self.assertEqual(cutout[32:, 32:].tolist(), np.ones((32, 32)).tolist())
+        self.assertFalse(cutout[:32].any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+import tifffile
+import numpy as np
+
+from butterfly.stats import Stats
+from butterfly.tiff import TiffDataSource
+from butterfly.tilecache import TileCache
+
+
+class FakeCore(object):
+    '''The parts of the core a TIFF datasource uses'''
+
+    def __init__(self):
+        self._cache = TileCache(10 ** 7, 'lru')
+        self._stats = Stats(False)
+
+
+class TestTiff(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        # Tiles of 16 x 16 that don't evenly cover the planes
+        self.volume = rng.randint(0, 2 ** 16, (3, 70, 90)).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def open(self, compress=0):
+        path = os.path.join(self.folder, 'volume.tif')
+        tifffile.imsave(path, self.volume, tile=(16, 16), compress=compress,
+                        photometric='minisblack')
+        source = TiffDataSource(FakeCore(), path)
+        source.index()
+        return source
+
+    def check_cutouts(self, source):
+        for z, bounds in [(0, (5, 60, 3, 40)), (1, (15, 17, 31, 33)),
+                          (2, (0, 90, 0, 70)), (1, (70, 90, 60, 70))]:
+            [x0, x1, y0, y1] = bounds
+            cutout = source.load_cutout(x0, x1, y0, y1, z, 0)
+            np.testing.assert_array_equal(cutout,
+                                          self.volume[z, y0:y1, x0:x1])
+
+    def test_uncompressed_cutouts(self):
+        source = self.open()
+        self.assertEqual(source.get_boundaries(), (90, 70, 3))
+        self.check_cutouts(source)
+
+    def test_deflate_cutouts(self):
+        source = self.open(compress=6)
+        self.check_cutouts(source)
+        # Each tile is decoded once into the tile cache
+        self.check_cutouts(source)
+        self.assertGreater(source._core._cache.hits, 0)
+
+    def test_outside_and_zoomed(self):
+        source = self.open(compress=6)
+        cutout = source.load_cutout(80, 100, -10, 10, 0, 0)
+        expected = np.zeros((20, 20), np.uint16)
+        expected[10:, :10] = self.volume[0, :10, 80:90]
+        np.testing.assert_array_equal(cutout, expected)
+        # Levels above the stored pages are subsampled
+        np.testing.assert_array_equal(source.load_cutout(8, 72, 4, 68, 1, 2),
+                                      self.volume[1, 4:68:4, 8:72:4])
+        self.assertFalse(source.load_cutout(0, 16, 0, 16, 3, 0).any())
+
+    def test_load_tiles(self):
+        source = self.open()
+        np.testing.assert_array_equal(source.load(2, 1, 0, 0),
+                                      self.volume[0, 16:32, 32:48])
+        np.testing.assert_array_equal(source.load(1, 0, 2, 1),
+                                      self.volume[2, :32:2, 32:64:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
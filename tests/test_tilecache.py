@@ -0,0 +1,167 @@
+import unittest
+import numpy as np
+
+from butterfly.tilecache import TileCache, CompressedTileCache, PackedTile
+from butterfly.tilecache import SharedTileCache, bypass, bypassed
+
+
+def tile(value, nbytes=1000):
+    return np.full(nbytes, value, np.uint8)
+
+
+def request(cache, key):
+    '''
+    Get a tile like a datasource, adding it to the cache on a miss
+    '''
+    found = cache.get(key)
+    if found is None:
+        cache.put(key, tile(hash(key) % 256))
+    return found is not None
+
+
+class TestTileCache(unittest.TestCase):
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, TileCache, 10000, 'fifo')
+
+    def test_lru_removes_least_recently_used(self):
+        cache = TileCache(3000, 'lru')
+        for key in 'abc':
+            cache.put(key, tile(1))
+        cache.get('a')
+        cache.put('d', tile(1))
+        self.assertIsNone(cache.get('b'))
+        for key in 'acd':
+            self.assertIsNotNone(cache.get(key))
+        self.assertEqual(cache.size, 3000)
+
+    def test_size_counts_bytes(self):
+        cache = TileCache(10000, 'lru')
+        cache.put('a', np.zeros(100, np.uint32))
+        cache.put('a', np.zeros(200, np.uint32))
+        self.assertEqual(cache.size, 800)
+        self.assertEqual(len(cache), 1)
+
+    def test_tile_larger_than_cache(self):
+        cache = TileCache(3000, 'lru')
+        cache.put('a', tile(1))
+        cache.put('big', tile(2, 4000))
+        self.assertIsNone(cache.get('big'))
+        self.assertIsNotNone(cache.get('a'))
+
+    def test_slru_resists_scan(self):
+        cache = TileCache(10000, 'slru')
+        hot = ['hot%d' % i for i in range(5)]
+        for key in hot:
+            request(cache, key)
+            request(cache, key)
+        # A scan of tiles used once only replaces the probation segment
+        for i in range(100):
+            request(cache, 'scan%d' % i)
+        for key in hot:
+            self.assertIsNotNone(cache.get(key))
+
+    def test_tinylfu_resists_scan(self):
+        cache = TileCache(10000, 'tinylfu')
+        hot = ['hot%d' % i for i in range(8)]
+        for _ in range(3):
+            for key in hot:
+                request(cache, key)
+        for i in range(100):
+            request(cache, 'scan%d' % i)
+        hits = sum(cache.get(key) is not None for key in hot)
+        self.assertEqual(hits, len(hot))
+
+    def test_tinylfu_admits_new_hot_key(self):
+        cache = TileCache(10000, 'tinylfu')
+        # Fill the cache with tiles used once
+        for i in range(50):
+            request(cache, 'old%d' % i)
+        self.assertGreaterEqual(cache.size, 9000)
+        # A new key is cached on its first miss and stays while used
+        self.assertFalse(request(cache, 'new'))
+        self.assertTrue(request(cache, 'new'))
+        for i in range(30):
+            request(cache, 'scan%d' % i)
+            self.assertTrue(request(cache, 'new'))
+
+    def test_tinylfu_admits_prefetched_tile(self):
+        cache = TileCache(10000, 'tinylfu')
+        for i in range(50):
+            request(cache, 'old%d' % i)
+        # Prefetched tiles are put after one miss, then used by viewers
+        request(cache, 'prefetched')
+        self.assertIsNotNone(cache.get('prefetched'))
+
+    def test_clear(self):
+        cache = TileCache(10000, 'tinylfu')
+        for key in 'abc':
+            request(cache, key)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size, cache.hits), (0, 0, 0))
+
+
+class TestCompressedTileCache(unittest.TestCase):
+
+    def test_packs_label_tiles(self):
+        labels = np.repeat(np.arange(8, dtype=np.uint32), 64 * 512)
+        labels = labels.reshape(512, 512)
+        cache = CompressedTileCache(10 ** 7)
+        cache.put('labels', labels)
+        self.assertLess(cache.size, labels.nbytes // 10)
+        np.testing.assert_array_equal(cache.get('labels'), labels)
+
+    def test_keeps_images_raw(self):
+        image = np.random.RandomState(0).randint(0, 4096, (512, 512))
+        image = image.astype(np.uint16)
+        cache = CompressedTileCache(10 ** 7)
+        cache.put('image', image)
+        self.assertEqual(cache.size, image.nbytes)
+        np.testing.assert_array_equal(cache.get('image'), image)
+
+    def test_packed_tile_round_trip(self):
+        labels = np.array([[0, 5, 5], [2 ** 40, 5, 0]], np.uint64)
+        np.testing.assert_array_equal(PackedTile(labels).unpack(), labels)
+
+
+class TestSharedTileCache(unittest.TestCase):
+
+    def test_round_trip(self):
+        cache = SharedTileCache(10 ** 6)
+        labels = np.arange(12, dtype=np.uint32).reshape(3, 4)
+        cache.put('labels', labels)
+        np.testing.assert_array_equal(cache.get('labels'), labels)
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_size_counts_live_tiles(self):
+        cache = SharedTileCache(10 ** 6)
+        # Writing a key again leaves the old copy in the ring unused
+        for value in range(3):
+            cache.put('a', tile(value).reshape(10, 100))
+        cache.put('b', tile(3).reshape(10, 100))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 2000)
+
+    def test_size_drops_overwritten_tiles(self):
+        cache = SharedTileCache(10000, slots=64)
+        for i in range(30):
+            cache.put(i, tile(i).reshape(10, 100))
+        self.assertLessEqual(cache.size, cache.max_size)
+        self.assertEqual(cache.size, 1000 * len(cache))
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(29))
+
+
+class TestBypass(unittest.TestCase):
+
+    def test_bypass_nests(self):
+        self.assertFalse(bypassed())
+        with bypass():
+            with bypass(False):
+                self.assertTrue(bypassed())
+        self.assertFalse(bypassed())
+
+
+if __name__ == '__main__':
+    unittest.main()